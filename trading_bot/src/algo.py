@@ -1,14 +1,30 @@
 import alpaca_trade_api as tradeapi
 import requests
-import time
-import functools
+import os
 import asyncio
+import functools
+import logging
+import time
+import uuid
+import pandas as pd
 import stock_data
-from ta.trend import macd
-import numpy as np
-from datetime import datetime, timedelta
-from pytz import timezone
 from credentials import alpaca
+from bar_store import MinuteBars
+from engine import Cancel, Liquidate, StrategyEngine, Submit, Unwatch
+from gateway import OrderGateway
+from scheduler import LIQUIDATE, RequestScheduler
+from screener import Screener
+from session import SessionClock, TradingCalendar
+from bar_writer import BarWriter, CacheBackend, MySQLBackend
+from bar_cache import NY, BarCache
+from fetcher import fetch_all, print_progress
+from throttle import TokenBucket
+from replay import EventRecorder
+from metrics import Metrics, report, write_snapshot
+from journal import Journal, reconcile
+from reconnect import StreamSupervisor, minute_recovery
+from decode import FastStreamConn
+from subscriptions import MINUTES, SECONDS, SubscriptionManager
 
 base_url = 'https://paper-api.alpaca.markets'
 api_key_id = alpaca['api_key']
@@ -26,373 +42,368 @@ min_share_price = 5.0
 max_share_price = 50
 # Minimum previous-day dollar volume for a stock we might consider
 min_last_dv = 1000000
-# Stop limit to default to
-default_stop = .95
-# How much of our portfolio to allocate to any one position
-max_allocation = 0.01
+# Minimum percent change on the day for a stock we might consider
+min_change = 3.5
+# Seconds between re-screens for new movers during the buy window
+rescreen_interval = 60
+# Concurrent requests and requests per second used to warm up history
+history_workers = 8
+history_rate = 10
 
+screener = Screener(api, min_share_price, max_share_price, min_last_dv, min_change)
 
-@functools.lru_cache(maxsize=128)
-def get_current_portfolio_value():
-	return float(api.get_account().portfolio_value)
 
-
-def get_1000m_history_data(symbols):
+def get_1000m_history_data(symbols, api=None, cache=None, workers=history_workers, rate=history_rate):
 	print('Getting historical data...')
-	minute_history = {}
-	c = 0
-	for symbol in symbols:
-		minute_history[symbol] = stock_data.get_minute_historical(symbol, num_minutes=1000)
-		c += 1
-		print('{}/{}'.format(c, len(symbols)))
+	if api is None:
+		api = stock_data.get_alpaca_api()
+	bucket = TokenBucket(rate)
+	frames, failures = fetch_all(
+		symbols,
+		lambda symbol: stock_data.get_minute_historical(
+			symbol, num_minutes=1000, api=api, cache=cache, bucket=bucket
+		),
+		workers=workers,
+		progress=print_progress('History')
+	)
+	for symbol, e in failures.items():
+		print('Failed to get history for {}: {}'.format(symbol, e))
 	print('Success.')
-	return minute_history
+	return {symbol: MinuteBars.from_frame(df) for symbol, df in frames.items()}
 
 
 def get_tickers():
+	# frame of screened symbols with prev_close and today's volume
 	print('Getting current ticker data...')
-	assets = api.list_assets()
-	symbols = {asset.symbol for asset in assets if asset.tradable}
-	tickers = api.polygon.all_tickers()
+	tickers = screener.screen()
 	print('Success.')
-	
-	return [ticker for ticker in tickers if (
-			ticker.ticker in symbols and
-			ticker.lastTrade['p'] >= min_share_price and
-			ticker.lastTrade['p'] <= max_share_price and
-			ticker.prevDay['v'] * ticker.lastTrade['p'] > min_last_dv and
-			ticker.todaysChangePerc >= 3.5
-	)]
-
+	return tickers
 
-def find_stop(current_value, minute_history, now):
-	# this functions finds the price of the most recent price valley eg. 26 -> {24} -> 25
-	# otherwise limit our loss to 5%
-	series = minute_history['low'][-100:]
-	diff = np.diff(series.values)
-	low_index = np.where((diff[:-1] <= 0) & (diff[1:] > 0))[0] + 1
-	if len(low_index) > 0:
-		return series[low_index[-1]] - 0.01
-	return current_value * default_stop
 
-
-def run(tickers, market_open_dt, market_close_dt):
-	# Establish streaming connection
-	conn = tradeapi.StreamConn(base_url=base_url, key_id=api_key_id, secret_key=api_secret)
-	# Update initial state with information from tickers
-	volume_today = {}
-	prev_closes = {}
-	for ticker in tickers:
-		symbol = ticker.ticker
-		prev_closes[symbol] = ticker.prevDay['c']
-		volume_today[symbol] = ticker.day['v']
+def run(tickers, clock, record_path=None):
+	# Establish streaming connection; bar handlers get decode.BarRecords
+	conn = FastStreamConn(base_url=base_url, key_id=api_key_id, secret_key=api_secret)
+	# Orders and account reads go through the gateway so the loop never waits
+	# on Alpaca; the engine reads its cached account snapshot
+	scheduler = RequestScheduler()
+	gateway = OrderGateway(api, scheduler=scheduler)
+	gateway.load()
+	engine = StrategyEngine(clock, gateway)
+	# Drops the second bars of symbols that can no longer act
+	subscriptions = SubscriptionManager(engine)
+	# Handler timings, bar staleness and queue depths, served by the
+	# trading_bot app's metrics view
+	metrics = Metrics()
+	metrics.probe('broker_queue', lambda: scheduler.depth)
+	metrics.probe('symbols', lambda: len(engine.symbols))
+	metrics.probe('subscriptions.seconds', lambda: subscriptions.counts()[SECONDS])
+	metrics.probe('subscriptions.minutes', lambda: subscriptions.counts()[MINUTES])
+	metrics.probe('subscriptions.saved_per_sec', lambda: subscriptions.saved_per_second)
+	# second bars merged while waiting for the handlers, and the backlog
+	metrics.probe('inbox.received', lambda: conn.inbox.received)
+	metrics.probe('inbox.merged', lambda: conn.inbox.merged)
+	metrics.probe('inbox.depth', lambda: len(conn.inbox))
+	metrics.probe('inbox.max_depth', lambda: conn.inbox.max_depth)
+	# Optionally record every event for replay.py
+	recorder = EventRecorder(record_path) if record_path else None
+	if recorder is not None:
+		recorder.record('session', {'open': clock.market_open_dt.isoformat(), 'close': clock.market_close_dt.isoformat()})
+	
+	def watch(tickers, minute_history):
+		# Update state with information from tickers; symbols we couldn't get
+		# history for can't be evaluated
+		watched = []
+		for symbol, prev_close, volume in zip(tickers['symbol'], tickers['prev_close'], tickers['volume']):
+			if symbol in minute_history:
+				engine.watch(symbol, minute_history[symbol], prev_close, volume)
+				watched.append(symbol)
+				if recorder is not None:
+					recorder.record('watch', {'symbol': symbol, 'prev_close': prev_close, 'volume': volume})
+		return watched
 	
 	# generate our list of watched symbols
-	symbols = {ticker.ticker for ticker in tickers}
+	symbols = set(tickers['symbol'])
 	print('Tracking {} symbols.'.format(len(symbols)))
-	minute_history = get_1000m_history_data(symbols)
-	open_orders = {}
-	positions = {}
+	cache = BarCache()
+	cache.evict()
+	watch(tickers, get_1000m_history_data(symbols, cache=cache))
 	
-	# Cancel any existing open orders on watched symbols
-	existing_orders = api.list_orders(limit=500)
-	for order in existing_orders:
-		if order.symbol in symbols:
-			api.cancel_order(order.id)
+	def history_for(symbol):
+		return MinuteBars.from_frame(stock_data.get_minute_historical(symbol, num_minutes=1000, cache=cache))
 	
-	stop_prices = {}
-	latest_cost_basis = {}
+	# Orders, fills, stops and targets are journaled as they happen. After a
+	# restart today's journal restores them, and one listing of today's
+	# orders catches up on what the broker did while we were down.
+	journal = Journal(clock.market_open_dt.strftime('%Y-%m-%d'))
+	states = journal.load()
+	if states:
+		start = time.perf_counter()
+		restored, unknown = reconcile(
+			engine, states, api.list_orders(status='all', after=clock.market_open_dt.isoformat(), limit=500),
+			history_for
+		)
+		for order_id in unknown:
+			api.cancel_order(order_id)
+		for symbol in restored:
+			journal.record('reconciled', symbol, engine.symbol_state(symbol))
+		print('Restored {} symbols from the journal in {:.0f}ms'.format(
+			len(restored), (time.perf_counter() - start) * 1e3
+		))
+	else:
+		# Cancel any existing open orders on watched symbols
+		existing_orders = api.list_orders(limit=500)
+		for order in existing_orders:
+			if order.symbol in engine.symbols:
+				api.cancel_order(order.id)
+		
+		# Track any positions bought during previous executions
+		existing_positions = api.list_positions()
+		for position in existing_positions:
+			history = None
+			if position.symbol not in engine.minute_history:
+				history = history_for(position.symbol)
+			engine.add_position(position.symbol, float(position.qty), float(position.cost_basis), history)
+			journal.record('position', position.symbol, engine.symbol_state(position.symbol))
+	if recorder is not None:
+		for symbol, qty in engine.positions.items():
+			if qty:
+				recorder.record('position', {
+					'symbol': symbol, 'qty': qty, 'cost_basis': engine.latest_cost_basis.get(symbol)
+				})
+	# Minute bars are persisted in the background, to the db and to the local
+	# cache that a restart rebuilds minute_history from
+	bar_writers = [
+		BarWriter(MySQLBackend()),
+		BarWriter(CacheBackend(cache), flush_interval=5.0)
+	]
+	metrics.probe('db_queue.mysql', lambda: bar_writers[0].depth)
+	metrics.probe('db_queue.cache', lambda: bar_writers[1].depth)
+	metrics.probe('db_dropped.mysql', lambda: bar_writers[0].dropped)
+	metrics.probe('db_dropped.cache', lambda: bar_writers[1].dropped)
+	# liquidation orders in flight
+	pending = []
 	
-	# Track any positions bought during previous executions
-	existing_positions = api.list_positions()
-	for position in existing_positions:
-		symbols.add(position.symbol)
-		# if position.symbol in symbols:
-		positions[position.symbol] = float(position.qty)
-		# Recalculate cost basis and stop price
-		latest_cost_basis[position.symbol] = float(position.cost_basis)
-		stop_prices[position.symbol] = (
-				float(position.cost_basis) * default_stop
-		)  # limit our loss to 5% from cost basis
-		if position.symbol not in minute_history:
-			minute_history[position.symbol] = stock_data.get_minute_historical(position.symbol, num_minutes=1000)
-	# Keep track of what we're buying/selling
-	target_prices = {}
-	partial_fills = {}
+	async def submit(intent, origin):
+		print('Submitting {} for {} shares of {} at {}'.format(
+			intent.side, intent.qty, intent.symbol, intent.limit_price
+		))
+		# journaled before it goes out, with an id to find it by after a crash
+		client_order_id = uuid.uuid4().hex
+		journal.record(
+			'intent', intent.symbol, dict(engine.symbol_state(intent.symbol), client_order_id=client_order_id),
+			side=intent.side, qty=intent.qty, limit_price=intent.limit_price
+		)
+		try:
+			o = await gateway.submit_order(
+				intent.symbol, intent.qty, intent.side, intent.type,
+				limit_price=intent.limit_price, client_order_id=client_order_id
+			)
+			if origin is not None:
+				metrics.on_order(intent.symbol, intent.side, origin[0], origin[1], time.time())
+			engine.on_order_submitted(intent.symbol, o)
+			journal.record('submitted', intent.symbol, engine.symbol_state(intent.symbol), order_id=o.id)
+		except Exception as e:
+			print(e)
+			engine.on_order_rejected(intent.symbol)
+			journal.record('rejected', intent.symbol, engine.symbol_state(intent.symbol))
+	
+	async def cancel(intent):
+		try:
+			await gateway.cancel_order(intent.order_id)
+		except Exception as e:
+			print(e)
+	
+	async def liquidate(intent):
+		# Liquidate remaining positions on watched symbols at market
+		position = await gateway.get_position(intent.symbol, lane=LIQUIDATE)
+		if position is None:
+			return
+		print('Trading over, liquidating remaining position in {}'.format(
+			intent.symbol)
+		)
+		try:
+			await gateway.submit_order(intent.symbol, position.qty, 'sell', 'market', lane=LIQUIDATE)
+		except Exception as e:
+			print(e)
+	
+	# Carry out what the engine asks for. Broker calls run as their own tasks
+	# so the handler returns to the loop straight away. origin is the (bar
+	# end, handler entry) epoch seconds of the event that led to the intents.
+	async def execute(intents, origin=None):
+		retired = False
+		for intent in intents:
+			if isinstance(intent, Submit):
+				asyncio.ensure_future(submit(intent, origin))
+			elif isinstance(intent, Cancel):
+				asyncio.ensure_future(cancel(intent))
+			elif isinstance(intent, Liquidate):
+				pending.append(asyncio.ensure_future(liquidate(intent)))
+			elif isinstance(intent, Unwatch):
+				retired = True
+				channels = subscriptions.unwatch(intent.symbol)
+				if channels:
+					await conn.unsubscribe(channels)
+		if retired and engine.done:
+			# let the last liquidations go out before stopping
+			await asyncio.gather(*pending)
+			await scheduler.close()
+			for bar_writer in bar_writers:
+				await bar_writer.close()
+			asyncio.get_event_loop().stop()
+	
+	async def store(bar):
+		# queue bar for the minute_stocks db; the one datetime built per bar
+		row = (
+			pd.Timestamp(bar.start, unit='ms', tz=NY).to_pydatetime(),
+			bar.symbol,
+			bar.open,
+			bar.high,
+			bar.low,
+			bar.close,
+			bar.volume
+		)
+		for bar_writer in bar_writers:
+			bar_writer.put(row)
+	
+	async def update_subscriptions():
+		# bring each symbol's channels in line with what it can still do
+		subscribe, unsubscribe, intents = subscriptions.update(int(time.time()) // 60)
+		if subscribe:
+			await conn.subscribe(subscribe)
+		if unsubscribe:
+			await conn.unsubscribe(unsubscribe)
+			print('Streaming minute bars only for {} idle symbols, saving ~{:.1f} messages/sec'.format(
+				subscriptions.counts()[MINUTES], subscriptions.saved_per_second
+			))
+		await execute(intents)
+	
+	async def prune_subscriptions():
+		# check every symbol just after each minute turns
+		while not engine.done:
+			await asyncio.sleep(61 - time.time() % 60)
+			await update_subscriptions()
+	
+	def symbol_channels():
+		return ['trade_updates'] + subscriptions.channels()
+	
+	# Reconnects with backoff and backfills the minute bars a drop cost us
+	supervisor = StreamSupervisor(
+		conn, symbol_channels, minute_recovery(engine, api, store), stale_after=60, metrics=metrics
+	)
+	
+	@conn.on(r'status')
+	async def handle_status(conn, channel, data):
+		supervisor.on_status(data._raw.get('status'))
 	
 	# Use trade updates to keep track of our portfolio
 	@conn.on(r'trade_update')
 	async def handle_trade_update(conn, channel, data):
+		entry = time.time()
+		t0 = time.perf_counter()
+		if recorder is not None:
+			recorder.record('trade_update', data._raw)
+		gateway.on_trade_update(data.event, data.order)
+		await execute(engine.on_trade_update(data.event, data.order))
 		symbol = data.order['symbol']
-		last_order = open_orders.get(symbol)
-		if last_order is not None:
-			event = data.event
-			if event == 'partial_fill':
-				qty = int(data.order['filled_qty'])
-				if data.order['side'] == 'sell':
-					qty = qty * -1
-				positions[symbol] = (
-						positions.get(symbol, 0) - partial_fills.get(symbol, 0)
-				)
-				partial_fills[symbol] = qty
-				positions[symbol] += qty
-				open_orders[symbol] = data.order
-				print(f"Filled partial {data.order['side']} order. {abs(qty)} shares of {symbol} @ {data.order['filled_avg_price']} ")
-			
-			elif event == 'fill':
-				qty = int(data.order['filled_qty'])
-				if data.order['side'] == 'sell':
-					qty = qty * -1
-				positions[symbol] = (
-						positions.get(symbol, 0) - partial_fills.get(symbol, 0)
-				)
-				partial_fills[symbol] = 0
-				positions[symbol] += qty
-				open_orders[symbol] = None
-				print(f"Filled {data.order['side']} order. {abs(qty)} shares of {symbol} @ {data.order['filled_avg_price']} ")
-			elif event == 'canceled' or event == 'rejected':
-				partial_fills[symbol] = 0
-				open_orders[symbol] = None
+		if symbol in engine.sessions:
+			journal.record(
+				'trade_update', symbol, engine.symbol_state(symbol), event=data.event, order_id=data.order['id']
+			)
+		metrics.on_event('trade_update', None, entry, time.perf_counter() - t0)
+		if data.event == 'partial_fill' or data.event == 'fill':
+			# a position on a symbol streaming minute bars only needs its
+			# second bars back
+			await update_subscriptions()
+			print(f"Filled {'partial ' if data.event == 'partial_fill' else ''}{data.order['side']} order. {data.order['filled_qty']} shares of {data.order['symbol']} @ {data.order['filled_avg_price']} ")
 	
 	@conn.on(r'A$')
-	async def handle_second_bar(conn, channel, data):
-		# First, aggregate 1s bars for up-to-date MACD calculations
-		ts = data.start
-		ts -= timedelta(seconds=ts.second, microseconds=ts.microsecond)
-		try:
-			current = minute_history[data.symbol].loc[ts]
-		except KeyError:
-			current = None
-		if current is None:
-			new_data = [
-				data.open,
-				data.high,
-				data.low,
-				data.close,
-				data.volume
-			]
-		else:
-			new_data = [
-				current.open,
-				max(data.high, current.high),
-				min(data.low, current.low),
-				data.close,
-				current.volume + data.volume
-			]
-		minute_history[data.symbol].loc[ts] = new_data
-		# Next, check for existing orders for the stock
-		existing_order = open_orders.get(data.symbol)
-		if existing_order is not None:
-			# Make sure the order's not too old
-			submission_ts = existing_order.submitted_at.astimezone(
-				timezone('America/New_York')
-			)
-			order_lifetime = ts - submission_ts
-			if order_lifetime.seconds // 60 > 1:
-				# Cancel it so we can try again for a fill
-				api.cancel_order(existing_order.id)
-			return
-		
-		# Now we check to see if it might be time to buy or sell
-		since_market_open = ts - market_open_dt
-		until_market_close = market_close_dt - ts
-		if (
-				15 < since_market_open.seconds // 60 < 60
-		):
-			# Check for buy signals
-			# See if we've already bought in first
-			if positions.get(data.symbol, 0) > 0:
-				print(f"Existing order for {data.symbol}")
-				return
-			
-			# See how high the price went during the first 15 minutes
-			lbound = market_open_dt
-			ubound = lbound + timedelta(minutes=15)
+	async def handle_second_bar(conn, channel, bar):
+		entry = time.time()
+		t0 = time.perf_counter()
+		supervisor.touch()
+		subscriptions.on_second_bar(bar.symbol)
+		if recorder is not None:
+			recorder.record('A', bar.raw())
+		bar_end = bar.end / 1000
+		await execute(engine.on_second_bar(bar), (bar_end, entry))
+		metrics.on_event('A', bar_end, entry, time.perf_counter() - t0)
+	
+	# Replace aggregated 1s bars with incoming 1m bars
+	@conn.on(r'AM$')
+	async def handle_minute_bar(conn, channel, bar):
+		entry = time.time()
+		t0 = time.perf_counter()
+		supervisor.touch()
+		if recorder is not None:
+			recorder.record('AM', bar.raw())
+		bar_end = bar.end / 1000
+		await execute(engine.on_minute_bar(bar), (bar_end, entry))
+		await store(bar)
+		metrics.on_event('AM', bar_end, entry, time.perf_counter() - t0)
+	
+	# Pick up stocks that start moving after the open while we can still buy
+	async def add_movers():
+		loop = asyncio.get_event_loop()
+		while clock.minutes_since_open() < 60:
+			await asyncio.sleep(rescreen_interval)
 			try:
-				high_15m = minute_history[data.symbol][lbound:ubound]['high'].max()
-			except Exception as e:
-				# Because we're aggregating on the fly, sometimes the datetime
-				# index can get messy until it's healed by the minute bars
-				return
-			
-		
-			# Get the change since yesterday's market close
-			daily_pct_change = (
-					(data.close - prev_closes[data.symbol]) / prev_closes[data.symbol]
-			)
-			if (
-					daily_pct_change > .04 and
-					data.close > high_15m and
-					volume_today[data.symbol] > 30000
-			):
-				# check for a positive, increasing MACD
-				hist = macd(
-					minute_history[data.symbol]['close'].dropna(),
-					n_fast=12,
-					n_slow=26
-				)
-				if (
-						hist[-1] < 0 or
-						not (hist[-3] < hist[-2] < hist[-1])
-				):
-					return
-				hist = macd(
-					minute_history[data.symbol]['close'].dropna(),
-					n_fast=40,
-					n_slow=60
-				)
-				if hist[-1] < 0 or np.diff(hist)[-1] < 0:
-					return
-				
-				# Stock has passed all checks; figure out how much to buy
-				stop_price = find_stop(
-					data.close, minute_history[data.symbol], ts
+				# everything watched today, including retired symbols
+				movers = await loop.run_in_executor(None, screener.rescreen, list(engine.minute_history))
+				if not len(movers):
+					continue
+				history = await loop.run_in_executor(
+					None, functools.partial(get_1000m_history_data, list(movers['symbol']), cache=cache)
 				)
-				stop_prices[symbol] = stop_price
-				target_prices[data.symbol] = data.close + (
-						(data.close - stop_price) * 3
-				)
-				# buy enough shares to account for 1% of portfolio
-				shares_to_buy = get_current_portfolio_value() * max_allocation // data.close
-				
-				if shares_to_buy == 0:
-					shares_to_buy = 1
-				shares_to_buy -= positions.get(data.symbol, 0)
-				
-				if shares_to_buy < 1 or data.close - stop_price <= 0 or shares_to_buy * data.close > float(api.get_account().cash):
-					# do not buy if the price is below or stop price
-					# or we do not have enough cash
-					return
-					
-				print('Submitting buy for {} shares of {} at {}'.format(
-					shares_to_buy, data.symbol, data.close
-				))
-				try:
-					o = api.submit_order(
-						symbol=data.symbol, qty=str(shares_to_buy), side='buy',
-						type='limit', time_in_force='day',
-						limit_price=str(data.close)
-					)
-					open_orders[symbol] = o
-					latest_cost_basis[data.symbol] = data.close
-				except Exception as e:
-					print(e)
-				return
-		if (
-				since_market_open.seconds // 60 >= 15 and
-				until_market_close.seconds // 60 > 15
-		):
-			# Check for liquidation signals
-			
-			# We can't liquidate if there's no position
-			if positions.get(data.symbol, 0) == 0:
-				return
-			
-			# Sell for a loss if it's fallen below our stop price
-			# Sell for a loss if it's below our cost basis and MACD < 0
-			# Sell for a profit if it's above our target price
-			hist = macd(
-				minute_history[data.symbol]['close'].dropna(),
-				n_fast=12,
-				n_slow=21
-			)
-			if (
-					data.close <= stop_prices[data.symbol] or
-					(data.close >= target_prices[data.symbol] and hist[-1] <= 0) or
-					(data.close <= latest_cost_basis[data.symbol] and hist[-1] <= 0)
-			):
-				print('Submitting sell for {} shares of {} at {}'.format(
-					positions.get(data.symbol, 0), data.symbol, data.close
-				))
-				try:
-					o = api.submit_order(
-						symbol=data.symbol, qty=str(positions.get(data.symbol, 0)), side='sell',
-						type='limit', time_in_force='day',
-						limit_price=str(data.close)
-					)
-					open_orders[data.symbol] = o
-					latest_cost_basis[data.symbol] = data.close
-				except Exception as e:
-					print(e)
-			return
-		elif until_market_close.seconds // 60 <= 15:
-			# Liquidate remaining positions on watched symbols at market
-			try:
-				position = api.get_position(data.symbol)
 			except Exception as e:
-				# Exception here indicates that we have no position
-				return
-			print('Trading over, liquidating remaining position in {}'.format(
-				data.symbol)
-			)
-			api.submit_order(
-				symbol=data.symbol, qty=position.qty, side='sell',
-				type='market', time_in_force='day'
-			)
-			symbols.remove(data.symbol)
-			if len(symbols) <= 0:
-				conn.close()
-			conn.deregister([
-				'A.{}'.format(data.symbol),
-				'AM.{}'.format(data.symbol)
-			])
-
-	# Replace aggregated 1s bars with incoming 1m bars
-	@conn.on(r'AM$')
-	async def handle_minute_bar(conn, channel, data):
-		ts = data.start
-		ts -= timedelta(microseconds=ts.microsecond)
-		minute_history[data.symbol].loc[ts] = [
-			data.open,
-			data.high,
-			data.low,
-			data.close,
-			data.volume
-		]
-		# insert bar into minute_stock db
-		
-		minute_data = {
-			'timestamp': ts.to_pydatetime(),
-			'symbol': data.symbol,
-			'open': data.open,
-			'high': data.high,
-			'low': data.low,
-			'close': data.close,
-			'volume': data.volume
-		}
-		loop = asyncio.get_running_loop()
-		await stock_data.a_insert(loop, "minute_stocks", minute_data)
-		volume_today[data.symbol] += data.volume
+				print(e)
+				continue
+			added = watch(movers, history)
+			if added:
+				print('Adding {} new movers: {}'.format(len(added), ', '.join(added)))
+				await update_subscriptions()
 	
-	channels = ['trade_updates']
-	for symbol in symbols:
-		symbol_channels = ['A.{}'.format(symbol), 'AM.{}'.format(symbol)]
-		channels += symbol_channels
-	print('Watching {} symbols.'.format(len(symbols)))
-	if len(symbols) > 0:
-		run_ws(conn, channels)
-
-
-# Handle failed websocket connections by reconnecting
-def run_ws(conn, channels):
-	try:
-		conn.run(channels)
-	except Exception as e:
-		print(e)
-		print("Reconnecting...")
-		conn.close()
-		run_ws(conn, channels)
+	print('Watching {} symbols.'.format(len(engine.symbols)))
+	if len(engine.symbols) > 0:
+		# the supervisor subscribes these channels when it connects
+		subscriptions.update(int(time.time()) // 60)
+		conn.loop.create_task(add_movers())
+		conn.loop.create_task(prune_subscriptions())
+		conn.loop.create_task(report(metrics))
+		try:
+			# drive the loop here rather than with conn.run(), which closes the
+			# loop and would leave nothing to drain the bar writers on
+			supervisor.run()
+		finally:
+			# write out any bars still queued before exiting
+			for bar_writer in bar_writers:
+				conn.loop.run_until_complete(bar_writer.close())
+			conn.loop.run_until_complete(conn.close())
+			conn.loop.run_until_complete(scheduler.close())
+			print('Broker requests: {}'.format(scheduler.metrics()))
+			print('Stream inbox: {}'.format(conn.inbox.counts()))
+			journal.close()
+			write_snapshot(metrics.snapshot())
+			gateway.close()
+			if recorder is not None:
+				recorder.close()
 
 
 def main():
-	market_open, market_close = stock_data.trading_times()
+	# metrics and order timings are logged as JSON lines
+	logging.basicConfig(level=logging.INFO, format='%(message)s')
+	clock = SessionClock.for_day(TradingCalendar(api))
+	if clock is None or clock.minutes_until_close() <= 0:
+		print('Market is closed today.')
+		return
 	# Wait until just before we might want to trade
-	current_dt = datetime.today().astimezone(timezone('America/New_York'))
-	since_market_open = current_dt - market_open
-	while since_market_open.seconds // 60 <= 14:
-		time.sleep(1)
-		since_market_open = current_dt - market_open
-	run(get_tickers(), market_open, market_close)
+	clock.sleep_until(clock.open_ts + 15 * 60)
+	workers = int(os.environ.get('SHARD_WORKERS', 0))
+	if workers > 1:
+		# spread the symbols over several stream processes
+		import shards
+		shards.run(get_tickers(), clock, workers)
+	else:
+		run(get_tickers(), clock, os.environ.get('RECORD_EVENTS'))
 
 
 if __name__ == "__main__":
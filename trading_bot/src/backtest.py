@@ -0,0 +1,283 @@
+import itertools
+import sys
+import time
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from indicators import macd_2d, valley_lows
+
+
+# Vectorized backtest of the momentum/MACD strategy in algo.run. Bars are laid
+# out as (symbol, day, minute of session) arrays and every entry and exit
+# condition is computed for all of them at once; only the position state is
+# stepped, one session minute at a time across every symbol-day together.
+#
+# Differences from live trading: signals are checked on minute closes rather
+# than on each second bar, limit orders fill at the signal bar's close, every
+# position is sized off a fixed equity with no cash check, and only regular
+# session bars feed the indicators.
+
+NY = 'America/New_York'
+SESSION_MINUTES = 390
+
+Params = namedtuple('Params', [
+	'equity',
+	'max_allocation',
+	'default_stop',
+	'min_change',
+	'min_volume',
+	'opening_range',
+	'buy_window_end',
+	'liquidate_minutes',
+	'target_multiple',
+	'stop_lookback',
+	'macd_fast',
+	'macd_slow',
+	'macd_exit',
+])
+
+# The values algo.run trades with
+DEFAULT_PARAMS = Params(
+	equity=100000.,
+	max_allocation=0.01,
+	default_stop=.95,
+	min_change=.04,
+	min_volume=30000,
+	opening_range=15,
+	buy_window_end=60,
+	liquidate_minutes=15,
+	target_multiple=3,
+	stop_lookback=100,
+	macd_fast=(12, 26),
+	macd_slow=(40, 60),
+	macd_exit=(12, 21),
+)
+
+TRADE_COLUMNS = ['symbol', 'day', 'entry_minute', 'exit_minute', 'entry_price', 'exit_price', 'stop', 'shares', 'pnl']
+
+
+class Panel:
+	# Regular-session minute bars as (symbol, day, minute) arrays. Missing
+	# bars are NaN (volume 0).
+
+	def __init__(self, symbols, days, open, high, low, close, volume):
+		self.symbols = symbols
+		self.days = days
+		self.open = open
+		self.high = high
+		self.low = low
+		self.close = close
+		self.volume = volume
+		# last close of the previous session in the panel
+		last = pd.DataFrame(close.reshape(-1, close.shape[2]).T).ffill().values[-1]
+		last = last.reshape(close.shape[:2])
+		self.prev_close = np.full(last.shape, np.nan)
+		self.prev_close[:, 1:] = last[:, :-1]
+
+	@property
+	def shape(self):
+		return self.close.shape
+
+	@classmethod
+	def from_bars(cls, bars):
+		# bars: long frame with timestamp, symbol, open, high, low, close and
+		# volume columns. Naive timestamps are New York time, which is how the
+		# minute_stocks table stores them.
+		ts = pd.to_datetime(bars['timestamp'])
+		if ts.dt.tz is None:
+			ts = ts.dt.tz_localize(NY)
+		else:
+			ts = ts.dt.tz_convert(NY)
+		day = ts.dt.normalize()
+		minute = ((ts - day) // pd.Timedelta(minutes=1) - (9 * 60 + 30)).values
+		keep = (minute >= 0) & (minute < SESSION_MINUTES)
+		bars = bars[keep]
+		minute = minute[keep]
+		day = day[keep].dt.tz_localize(None).values
+		symbols = np.unique(bars['symbol'].values)
+		days = np.unique(day)
+		s = np.searchsorted(symbols, bars['symbol'].values)
+		d = np.searchsorted(days, day)
+		shape = (len(symbols), len(days), SESSION_MINUTES)
+		columns = {}
+		for field in ('open', 'high', 'low', 'close', 'volume'):
+			columns[field] = np.zeros(shape) if field == 'volume' else np.full(shape, np.nan)
+			columns[field][s, d, minute] = bars[field].values
+		return cls(symbols, days, **columns)
+
+
+def load_bars_from_db(start, end, symbols=None, engine=None):
+	# minute bars the live bot recorded in minute_stocks
+	if engine is None:
+		from stock_data import get_db_connection
+		engine = get_db_connection()
+	sql = 'SELECT timestamp, symbol, open, high, low, close, volume FROM minute_stocks WHERE timestamp >= %s AND timestamp < %s'
+	params = [start, end]
+	if symbols:
+		sql += ' AND symbol IN ({})'.format(', '.join(['%s'] * len(symbols)))
+		params += list(symbols)
+	return pd.read_sql(sql, engine, params=params)
+
+
+def load_bars_from_cache(cache, symbols, start=None):
+	frames = []
+	for symbol in symbols:
+		df = cache.read('minute', symbol, start=start)
+		if df is not None:
+			df = df.reset_index()
+			df.insert(1, 'symbol', symbol)
+			frames.append(df)
+	return pd.concat(frames, ignore_index=True)
+
+
+def shifted(values, n=1):
+	# values n minutes earlier along the flattened (day, minute) axis
+	out = np.full(values.shape, np.nan)
+	out[:, n:] = values[:, :-n]
+	return out
+
+
+def backtest(panel, params=DEFAULT_PARAMS, macd_cache=None):
+	S, D, M = panel.shape
+	T = D * M
+	close = panel.close
+	if macd_cache is None:
+		macd_cache = {}
+
+	def macd(window):
+		if window not in macd_cache:
+			macd_cache[window] = macd_2d(close.reshape(S, T), *window)
+		return macd_cache[window]
+
+	# Entry: a >4% gapper breaking its opening range high with rising MACDs
+	fast = macd(params.macd_fast)
+	fast_1 = shifted(fast)
+	fast_2 = shifted(fast, 2)
+	rising_fast = (fast >= 0) & (fast_2 < fast_1) & (fast_1 < fast)
+	slow = macd(params.macd_slow)
+	rising_slow = ~((slow < 0) | (slow - shifted(slow) < 0))
+	opening_high = np.fmax.reduce(panel.high[:, :, :params.opening_range + 1], axis=2)
+	change = (close - panel.prev_close[:, :, None]) / panel.prev_close[:, :, None]
+	volume_today = np.cumsum(panel.volume, axis=2)
+	valley = valley_lows(panel.low.reshape(S, T), params.stop_lookback).reshape(S, D, M)
+	stops = np.where(np.isnan(valley), close * params.default_stop, valley - 0.01)
+	entries = (
+		(change > params.min_change) &
+		(close > opening_high[:, :, None]) &
+		(volume_today > params.min_volume) &
+		rising_fast.reshape(S, D, M) &
+		rising_slow.reshape(S, D, M) &
+		(close - stops > 0)
+	)
+	exit_macd = macd(params.macd_exit).reshape(S, D, M)
+
+	# Step the positions of every symbol-day through the session together
+	shares = np.zeros((S, D))
+	entry_price = np.zeros((S, D))
+	entry_minute = np.zeros((S, D), dtype=int)
+	stop = np.zeros((S, D))
+	target = np.zeros((S, D))
+	trades = []
+
+	def close_out(s, d, minute, exit_price):
+		trades.append(np.column_stack((
+			s, d, entry_minute[s, d], minute,
+			entry_price[s, d], exit_price, stop[s, d], shares[s, d],
+			shares[s, d] * (exit_price - entry_price[s, d])
+		)))
+		shares[s, d] = 0
+
+	last_exit_minute = M - params.liquidate_minutes
+	for m in range(params.opening_range, M):
+		price = close[:, :, m]
+		held = shares > 0
+		if m >= last_exit_minute:
+			# liquidate at market
+			exits = held & ~np.isnan(price)
+		elif m == params.opening_range or m >= params.buy_window_end:
+			weak = exit_macd[:, :, m] <= 0
+			exits = held & (
+				(price <= stop) |
+				((price >= target) & weak) |
+				((price <= entry_price) & weak)
+			)
+		else:
+			exits = None
+		if exits is not None and exits.any():
+			s, d = np.nonzero(exits)
+			close_out(s, d, np.full(len(s), m), price[s, d])
+		if params.opening_range < m < params.buy_window_end:
+			buys = entries[:, :, m] & (shares == 0)
+			if buys.any():
+				s, d = np.nonzero(buys)
+				p = price[s, d]
+				shares[s, d] = np.maximum(params.equity * params.max_allocation // p, 1)
+				entry_price[s, d] = p
+				entry_minute[s, d] = m
+				stop[s, d] = stops[s, d, m]
+				target[s, d] = p + (p - stop[s, d]) * params.target_multiple
+
+	# A symbol whose bars stop before the liquidation window (a halt, a
+	# delisting, a gap in the data) is still held; close it at the day's
+	# last close like the live bot's liquidation would
+	if (shares > 0).any():
+		s, d = np.nonzero(shares > 0)
+		seen = ~np.isnan(close[s, d])
+		last = M - 1 - np.argmax(seen[:, ::-1], axis=1)
+		close_out(s, d, last, close[s, d, last])
+
+	if trades:
+		rows = np.concatenate(trades)
+	else:
+		rows = np.empty((0, len(TRADE_COLUMNS)))
+	result = pd.DataFrame(rows, columns=TRADE_COLUMNS)
+	result['symbol'] = panel.symbols[result['symbol'].astype(int)]
+	result['day'] = panel.days[result['day'].astype(int)]
+	return result
+
+
+def summarize(trades):
+	risk = (trades['entry_price'] - trades['stop']) * trades['shares']
+	return {
+		'trades': len(trades),
+		'pnl': trades['pnl'].sum(),
+		'win_rate': (trades['pnl'] > 0).mean() if len(trades) else np.nan,
+		'avg_r': (trades['pnl'] / risk).mean() if len(trades) else np.nan,
+	}
+
+
+def sweep(panels, grid, base=DEFAULT_PARAMS):
+	# Run every combination of the values in `grid` ({param: [values]}) over
+	# each panel. MACDs are computed once per panel and window and shared by
+	# the runs that use them, so pass panels in symbol chunks to bound memory.
+	names = sorted(grid)
+	combos = [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+	trades = [[] for _ in combos]
+	for panel in panels:
+		macd_cache = {}
+		for i, combo in enumerate(combos):
+			trades[i].append(backtest(panel, base._replace(**combo), macd_cache))
+	rows = []
+	for combo, combo_trades in zip(combos, trades):
+		row = dict(combo)
+		row.update(summarize(pd.concat(combo_trades, ignore_index=True)))
+		rows.append(row)
+	return pd.DataFrame(rows)
+
+
+def iter_panels(load, symbols, chunk_size=100):
+	for i in range(0, len(symbols), chunk_size):
+		yield Panel.from_bars(load(symbols[i:i + chunk_size]))
+
+
+if __name__ == '__main__':
+	# python backtest.py 2019-01-01 2020-01-01
+	start_time = time.time()
+	start, end = sys.argv[1:3]
+	panel = Panel.from_bars(load_bars_from_db(start, end))
+	trades = backtest(panel)
+	print(trades)
+	print(summarize(trades))
+	print(f'Completed in {time.time() - start_time} seconds ')
@@ -0,0 +1,144 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from bar_store import EPOCH, FIELDS, ONE_MINUTE
+
+
+# On-disk bar cache, one .npy file of fixed-width rows per symbol and
+# partition: minute bars are split by trading date and daily bars by year.
+# Files are read memory-mapped and rewritten atomically, so a crash mid-write
+# leaves the previous partition in place.
+#
+#   <root>/minute/<SYMBOL>/2020-01-02.npy
+#   <root>/day/<SYMBOL>/2020.npy
+
+NY = 'America/New_York'
+DEFAULT_ROOT = os.environ.get(
+	'BAR_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bar_cache')
+)
+PARTITIONS = {'minute': '%Y-%m-%d', 'day': '%Y'}
+# rows are keyed by epoch minute of the bar's start, like MinuteBars
+DTYPE = np.dtype([('t', 'i8')] + [(field, 'f8') for field in FIELDS])
+
+
+def to_ny(ts):
+	ts = pd.Timestamp(ts)
+	return ts.tz_convert(NY) if ts.tzinfo is not None else ts.tz_localize(NY)
+
+
+def frame_to_rows(df):
+	rows = np.empty(len(df), dtype=DTYPE)
+	rows['t'] = np.asarray((df.index - EPOCH) // ONE_MINUTE, dtype=np.int64)
+	for field in FIELDS:
+		rows[field] = df[field].values
+	return rows
+
+
+def rows_to_frame(rows):
+	index = pd.to_datetime(rows['t'] * 60, unit='s', utc=True).tz_convert(NY)
+	index.name = 'timestamp'
+	return pd.DataFrame({field: rows[field] for field in FIELDS}, index=index, columns=FIELDS)
+
+
+class BarCache:
+
+	def __init__(self, root=DEFAULT_ROOT, max_age_days=30, max_bytes=2 * 1024 ** 3):
+		self.root = root
+		self.max_age_days = max_age_days
+		self.max_bytes = max_bytes
+
+	def read(self, kind, symbol, start=None):
+		# cached bars at or after `start` as a frame like the Polygon .df ones,
+		# or None if nothing is cached
+		parts = self._partitions(kind, symbol)
+		if start is not None:
+			start = to_ny(start)
+			first = start.strftime(PARTITIONS[kind])
+			parts = [part for part in parts if part >= first]
+		if not parts:
+			return None
+		rows = np.concatenate([
+			np.load(self._path(kind, symbol, part), mmap_mode='r') for part in parts
+		])
+		df = rows_to_frame(rows)
+		if start is not None:
+			df = df[df.index >= start]
+		return df if len(df) else None
+
+	def write(self, kind, symbol, df):
+		if len(df):
+			self.write_rows(kind, symbol, frame_to_rows(df))
+
+	def write_rows(self, kind, symbol, rows):
+		# merge rows into their partitions; on a clash the new row wins
+		if not len(rows):
+			return
+		labels = pd.to_datetime(rows['t'] * 60, unit='s', utc=True).tz_convert(NY).strftime(PARTITIONS[kind])
+		labels = np.asarray(labels)
+		for part in np.unique(labels):
+			new = rows[labels == part]
+			path = self._path(kind, symbol, part)
+			if os.path.exists(path):
+				new = np.concatenate((new, np.load(path)))
+			# np.unique keeps the first occurrence, which is the new row
+			_, first = np.unique(new['t'], return_index=True)
+			self._save(path, new[first])
+
+	def last_timestamp(self, kind, symbol):
+		parts = self._partitions(kind, symbol)
+		if not parts:
+			return None
+		rows = np.load(self._path(kind, symbol, parts[-1]), mmap_mode='r')
+		if not len(rows):
+			return None
+		return rows_to_frame(rows[-1:]).index[-1]
+
+	def evict(self):
+		# drop minute partitions older than max_age_days, then the least
+		# recently written files until the cache fits in max_bytes
+		files = []
+		for kind in PARTITIONS:
+			base = os.path.join(self.root, kind)
+			if not os.path.isdir(base):
+				continue
+			for symbol in os.listdir(base):
+				for name in os.listdir(os.path.join(base, symbol)):
+					path = os.path.join(base, symbol, name)
+					stat = os.stat(path)
+					files.append((stat.st_mtime, stat.st_size, kind, name[:-4], path))
+		removed = 0
+		if self.max_age_days is not None:
+			oldest = (pd.Timestamp.now(tz=NY) - pd.Timedelta(days=self.max_age_days)).strftime(PARTITIONS['minute'])
+			for entry in list(files):
+				if entry[2] == 'minute' and entry[3] < oldest:
+					os.remove(entry[4])
+					files.remove(entry)
+					removed += 1
+		if self.max_bytes is not None:
+			files.sort()
+			total = sum(entry[1] for entry in files)
+			for entry in files:
+				if total <= self.max_bytes:
+					break
+				os.remove(entry[4])
+				total -= entry[1]
+				removed += 1
+		return removed
+
+	def _partitions(self, kind, symbol):
+		base = os.path.join(self.root, kind, symbol)
+		if not os.path.isdir(base):
+			return []
+		return sorted(name[:-4] for name in os.listdir(base) if name.endswith('.npy'))
+
+	def _path(self, kind, symbol, part):
+		return os.path.join(self.root, kind, symbol, part + '.npy')
+
+	def _save(self, path, rows):
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		tmp = '{}.{}.tmp'.format(path, os.getpid())
+		with open(tmp, 'wb') as f:
+			np.save(f, rows)
+		os.replace(tmp, path)
@@ -0,0 +1,167 @@
+import numpy as np
+import pandas as pd
+
+
+# Fixed-capacity minute bar history for one symbol. Bars live in preallocated
+# NumPy columns used as a ring; `slots` maps an epoch minute to its position so
+# updating the forming minute is a dict lookup and five scalar writes.
+
+FIELDS = ('open', 'high', 'low', 'close', 'volume')
+EPOCH = pd.Timestamp(0, tz='UTC')
+ONE_MINUTE = pd.Timedelta(minutes=1)
+# 1000 minutes of warm-up history plus a full session, with some slack
+DEFAULT_CAPACITY = 1440
+
+
+def to_minute(ts):
+	return int(ts.timestamp()) // 60
+
+
+class MinuteBars:
+
+	def __init__(self, capacity=DEFAULT_CAPACITY):
+		self.capacity = capacity
+		self.minute = np.full(capacity, -1, dtype=np.int64)
+		self.open = np.full(capacity, np.nan)
+		self.high = np.full(capacity, np.nan)
+		self.low = np.full(capacity, np.nan)
+		self.close = np.full(capacity, np.nan)
+		self.volume = np.zeros(capacity)
+		self.clear()
+
+	def clear(self):
+		# positions only ever increase; a position's slot is position % capacity
+		self.slots = {}
+		self.end = 0
+		self.size = 0
+		self.minute.fill(-1)
+
+	@classmethod
+	def from_frame(cls, df, capacity=DEFAULT_CAPACITY):
+		bars = cls(capacity)
+		df = df.iloc[-capacity:]
+		bars.load(
+			np.asarray((df.index - EPOCH) // ONE_MINUTE, dtype=np.int64),
+			*(df[field].values for field in FIELDS)
+		)
+		return bars
+
+	def __len__(self):
+		return self.size
+
+	def __contains__(self, minute):
+		return minute in self.slots
+
+	@property
+	def last_minute(self):
+		if self.size == 0:
+			return None
+		return int(self.minute[(self.end - 1) % self.capacity])
+
+	def load(self, minutes, opens, highs, lows, closes, volumes):
+		# replace the contents with bars already sorted by minute
+		self.clear()
+		n = min(len(minutes), self.capacity)
+		for column, values in zip(
+				(self.minute, self.open, self.high, self.low, self.close, self.volume),
+				(minutes, opens, highs, lows, closes, volumes)
+		):
+			column[:n] = np.asarray(values)[len(values) - n:]
+		self.slots = {int(m): i for i, m in enumerate(self.minute[:n])}
+		self.end = n
+		self.size = n
+
+	def set_bar(self, minute, open, high, low, close, volume):
+		# insert or overwrite the bar for `minute`; True if it was new
+		slot, new = self._slot(minute)
+		if slot is None:
+			return False
+		self.open[slot] = open
+		self.high[slot] = high
+		self.low[slot] = low
+		self.close[slot] = close
+		self.volume[slot] = volume
+		return new
+
+	def merge_bar(self, minute, open, high, low, close, volume):
+		# fold a partial (e.g. 1s) bar into the bar for `minute`
+		slot, new = self._slot(minute)
+		if slot is None:
+			return False
+		if new:
+			self.open[slot] = open
+			self.high[slot] = high
+			self.low[slot] = low
+			self.volume[slot] = volume
+		else:
+			if high > self.high[slot]:
+				self.high[slot] = high
+			if low < self.low[slot]:
+				self.low[slot] = low
+			self.volume[slot] += volume
+		self.close[slot] = close
+		return new
+
+	def get(self, minute):
+		pos = self.slots.get(minute)
+		if pos is None:
+			return None
+		slot = pos % self.capacity
+		return tuple(getattr(self, field)[slot] for field in FIELDS)
+
+	def column(self, field, n=None):
+		# the newest `n` values of a column (all of them by default), oldest first
+		n = self.size if n is None else min(n, self.size)
+		start = (self.end - n) % self.capacity
+		values = getattr(self, field)
+		if start + n <= self.capacity:
+			return values[start:start + n].copy()
+		return np.concatenate((values[start:], values[:start + n - self.capacity]))
+
+	def lows(self, n):
+		return self.column('low', n)
+
+	def closes(self):
+		return self.column('close')
+
+	def high_between(self, first_minute, last_minute):
+		# max high over [first_minute, last_minute], NaN if there are no bars
+		mask = (self.minute >= first_minute) & (self.minute <= last_minute)
+		if not mask.any():
+			return np.nan
+		return np.nanmax(self.high[mask])
+
+	def low_between(self, first_minute, last_minute):
+		# min low over [first_minute, last_minute], NaN if there are no bars
+		mask = (self.minute >= first_minute) & (self.minute <= last_minute)
+		if not mask.any():
+			return np.nan
+		return np.nanmin(self.low[mask])
+
+	def _slot(self, minute):
+		pos = self.slots.get(minute)
+		if pos is not None:
+			return pos % self.capacity, False
+		if self.size and minute < self.last_minute:
+			return self._insert_older(minute), True
+		if self.size == self.capacity:
+			oldest = (self.end - self.capacity) % self.capacity
+			del self.slots[int(self.minute[oldest])]
+		else:
+			self.size += 1
+		slot = self.end % self.capacity
+		self.slots[minute] = self.end
+		self.end += 1
+		self.minute[slot] = minute
+		return slot, True
+
+	def _insert_older(self, minute):
+		# a bar arriving behind the newest one (late or backfilled); re-lay the
+		# ring out in order, which is O(capacity) but off the usual path
+		columns = [self.column(name) for name in ('minute',) + FIELDS]
+		i = int(np.searchsorted(columns[0], minute))
+		if self.size == self.capacity and i == 0:
+			return None
+		columns = [np.insert(column, i, value) for column, value in zip(columns, (minute, np.nan, np.nan, np.nan, np.nan, 0.))]
+		self.load(*columns)
+		return self.slots[minute] % self.capacity
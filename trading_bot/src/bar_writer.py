@@ -0,0 +1,266 @@
+import asyncio
+import sqlite3
+
+import aiomysql
+import numpy as np
+
+from bar_cache import DTYPE
+from bar_store import FIELDS
+from credentials import rds
+from stock_data import db_host
+
+
+# Background persistence for streamed bars. Handlers put() rows on a bounded
+# queue and return; a single task drains it into multi-row INSERTs, flushing
+# when a batch fills up or when the oldest queued row has waited
+# flush_interval seconds. put() never waits: once max_queue rows are queued,
+# e.g. while the database is down and the writer keeps retrying to open it,
+# further rows are dropped and counted, so persistence can't hold up trading.
+
+MINUTE_COLUMNS = ('timestamp', 'symbol', 'open', 'high', 'low', 'close', 'volume')
+
+_STOP = object()
+
+
+def insert_sql(table, columns, rows, placeholder='%s'):
+	row = '( {} )'.format(', '.join([placeholder] * len(columns)))
+	return 'INSERT INTO {} ( {} ) VALUES {}'.format(
+		table, ', '.join(columns), ', '.join([row] * rows)
+	)
+
+
+class MySQLBackend:
+	# One connection pool shared by every batch for the life of the writer
+
+	def __init__(self, db='mydb', minsize=1, maxsize=4):
+		self.db = db
+		self.minsize = minsize
+		self.maxsize = maxsize
+		self.pool = None
+
+	async def open(self, loop):
+		self.pool = await aiomysql.create_pool(
+			user=rds['user'], password=rds['password'], host=db_host, port=3306,
+			db=self.db, minsize=self.minsize, maxsize=self.maxsize, loop=loop
+		)
+
+	async def write(self, table, columns, rows):
+		sql = insert_sql(table, columns, len(rows))
+		async with self.pool.acquire() as conn:
+			async with conn.cursor() as cur:
+				await cur.execute(sql, [value for row in rows for value in row])
+			await conn.commit()
+
+	async def close(self):
+		if self.pool is not None:
+			self.pool.close()
+			await self.pool.wait_closed()
+			self.pool = None
+
+
+class SQLiteBackend:
+	# Local stand-in for MySQL when testing or benchmarking the writer. sqlite
+	# calls are quick enough on a local file that they run on the loop.
+
+	def __init__(self, path=':memory:'):
+		self.path = path
+		self.conn = None
+
+	async def open(self, loop):
+		self.conn = sqlite3.connect(self.path)
+
+	async def write(self, table, columns, rows):
+		self.conn.execute('CREATE TABLE IF NOT EXISTS {} ( {} )'.format(table, ', '.join(columns)))
+		# sqlite caps bound parameters per statement, so split large batches
+		step = max(1, 999 // len(columns))
+		for i in range(0, len(rows), step):
+			chunk = rows[i:i + step]
+			self.conn.execute(
+				insert_sql(table, columns, len(chunk), placeholder='?'),
+				[value for row in chunk for value in row]
+			)
+		self.conn.commit()
+
+	async def close(self):
+		if self.conn is not None:
+			self.conn.close()
+			self.conn = None
+
+
+class CacheBackend:
+	# Keeps the local bar cache current with streamed bars so a restart can
+	# rebuild history from disk. Rows must be in MINUTE_COLUMNS order. Each
+	# symbol's partition is loaded, merged and rewritten on the loop's
+	# executor, so the disk IO doesn't stall the stream; symbols are written
+	# concurrently, since each has its own files.
+
+	def __init__(self, cache):
+		self.cache = cache
+		self.loop = None
+
+	async def open(self, loop):
+		self.loop = loop
+
+	async def write(self, table, columns, rows):
+		by_symbol = {}
+		for row in rows:
+			by_symbol.setdefault(row[1], []).append(row)
+		writes = []
+		for symbol, symbol_rows in by_symbol.items():
+			bars = np.empty(len(symbol_rows), dtype=DTYPE)
+			bars['t'] = [int(row[0].timestamp()) // 60 for row in symbol_rows]
+			for i, field in enumerate(FIELDS):
+				bars[field] = [row[2 + i] for row in symbol_rows]
+			writes.append(self.loop.run_in_executor(None, self.cache.write_rows, 'minute', symbol, bars))
+		await asyncio.gather(*writes)
+
+	async def close(self):
+		pass
+
+
+class MemoryBackend:
+
+	def __init__(self):
+		self.rows = []
+		self.batches = 0
+
+	async def open(self, loop):
+		pass
+
+	async def write(self, table, columns, rows):
+		self.rows.extend(rows)
+		self.batches += 1
+
+	async def close(self):
+		pass
+
+
+class BarWriter:
+
+	def __init__(self, backend, table='minute_stocks', columns=MINUTE_COLUMNS,
+	             batch_size=500, flush_interval=1.0, max_queue=10000, retries=3):
+		self.backend = backend
+		self.table = table
+		self.columns = columns
+		self.batch_size = batch_size
+		self.flush_interval = flush_interval
+		self.max_queue = max_queue
+		self.retries = retries
+		self.written = 0
+		self.dropped = 0
+		self._queue = None
+		self._task = None
+		self._closing = False
+		# in the backoff between attempts to open the backend
+		self._retrying = False
+
+	@property
+	def depth(self):
+		return self._queue.qsize() if self._queue is not None else 0
+
+	def start(self):
+		# must be called from the loop the writer will run on
+		if self._task is None:
+			# put() bounds it, so close() always has room for _STOP
+			self._queue = asyncio.Queue()
+			self._closing = False
+			self._task = asyncio.ensure_future(self._run())
+			self._task.add_done_callback(self._on_done)
+
+	def put(self, row):
+		# drops row if the queue is full or the writer has died
+		self.start()
+		if self._task.done() or self._queue.qsize() >= self.max_queue:
+			self.dropped += 1
+			return
+		self._queue.put_nowait(row)
+
+	async def close(self):
+		# flush everything queued so far, then release the backend
+		if self._task is None:
+			return
+		task, self._task = self._task, None
+		self._closing = True
+		if not task.done():
+			self._queue.put_nowait(_STOP)
+			if self._retrying:
+				# the backend never came up; don't wait for it to
+				task.cancel()
+		try:
+			await task
+		except asyncio.CancelledError:
+			pass
+		except Exception:
+			# already reported by _on_done
+			pass
+		# whatever the task didn't get to
+		while not self._queue.empty():
+			if self._queue.get_nowait() is not _STOP:
+				self.dropped += 1
+
+	def _on_done(self, task):
+		if not task.cancelled() and task.exception() is not None:
+			print('{} writer stopped: {!r}'.format(self.table, task.exception()))
+
+	async def _open(self, loop):
+		# Keep trying until the backend is up, e.g. the database reachable.
+		# Returns False if the writer is closed first.
+		attempt = 0
+		while True:
+			try:
+				await self.backend.open(loop)
+				return True
+			except Exception as e:
+				print('Could not open {} writer: {}'.format(self.table, e))
+			if self._closing:
+				return False
+			self._retrying = True
+			try:
+				await asyncio.sleep(min(2 ** attempt, 30))
+			finally:
+				self._retrying = False
+			attempt += 1
+
+	async def _run(self):
+		loop = asyncio.get_event_loop()
+		if not await self._open(loop):
+			return
+		stopping = False
+		try:
+			while not stopping:
+				row = await self._queue.get()
+				if row is _STOP:
+					break
+				batch = [row]
+				deadline = loop.time() + self.flush_interval
+				while len(batch) < self.batch_size:
+					if not self._queue.empty():
+						row = self._queue.get_nowait()
+					else:
+						timeout = deadline - loop.time()
+						if timeout <= 0:
+							break
+						try:
+							row = await asyncio.wait_for(self._queue.get(), timeout)
+						except asyncio.TimeoutError:
+							break
+					if row is _STOP:
+						stopping = True
+						break
+					batch.append(row)
+				await self._flush(batch)
+		finally:
+			await self.backend.close()
+
+	async def _flush(self, batch):
+		for attempt in range(self.retries + 1):
+			try:
+				await self.backend.write(self.table, self.columns, batch)
+				self.written += len(batch)
+				return
+			except Exception as e:
+				print(e)
+				if attempt < self.retries:
+					await asyncio.sleep(min(2 ** attempt, 10))
+		print('Dropped {} rows for {}'.format(len(batch), self.table))
+		self.dropped += len(batch)
@@ -0,0 +1,588 @@
+import asyncio
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+import requests
+
+from bar_writer import BarWriter, MemoryBackend, SQLiteBackend
+from engine import Bar
+
+
+# Local benchmarks for the bot's hot paths. None of them touch the network
+# or the production database.
+# usage: python bench.py [name ...]
+
+
+def bar_rows(n, symbols=100):
+	start = datetime(2020, 1, 2, 9, 30)
+	return [
+		(start + timedelta(minutes=i // symbols), 'SYM{}'.format(i % symbols), 10., 10.5, 9.5, 10.2, 1000)
+		for i in range(n)
+	]
+
+
+def bench_bar_writer(n=100000):
+	rows = bar_rows(n)
+	for name, backend in (('memory', MemoryBackend()), ('sqlite', SQLiteBackend())):
+		for batch_size in (1, 100, 1000):
+			writer = BarWriter(backend, batch_size=batch_size, max_queue=10000)
+
+			async def produce():
+				for row in rows:
+					# keep up with the writer rather than have it drop rows
+					while writer.depth >= writer.max_queue:
+						await asyncio.sleep(0)
+					writer.put(row)
+				await writer.close()
+
+			start = time.perf_counter()
+			asyncio.run(produce())
+			elapsed = time.perf_counter() - start
+			print('bar_writer {:6} batch={:5} {:10.0f} rows/s'.format(name, batch_size, writer.written / elapsed))
+
+
+class FakeResult:
+
+	def __init__(self, df):
+		self.df = df
+
+
+class FakePolygon:
+	# Answers history requests after `latency` seconds and, like the real API,
+	# responds 429 once more than `limit` requests arrive within a second.
+
+	def __init__(self, latency=0.05, limit=50):
+		self.latency = latency
+		self.limit = limit
+		self.requests = 0
+		self.throttled = 0
+		self._recent = deque()
+		self._lock = threading.Lock()
+		self._frames = {}
+
+	def _check_rate(self):
+		with self._lock:
+			self.requests += 1
+			now = time.monotonic()
+			while self._recent and now - self._recent[0] > 1:
+				self._recent.popleft()
+			if len(self._recent) >= self.limit:
+				self.throttled += 1
+				response = requests.Response()
+				response.status_code = 429
+				response.headers['Retry-After'] = '1'
+				raise requests.HTTPError('429 Too Many Requests', response=response)
+			self._recent.append(now)
+
+	def _frame(self, limit, freq):
+		if (limit, freq) not in self._frames:
+			end = pd.Timestamp.now(tz='America/New_York').floor(freq)
+			index = pd.date_range(end=end, periods=limit, freq=freq, name='timestamp')
+			close = 20 + np.cumsum(np.random.RandomState(0).normal(0, .05, limit))
+			self._frames[limit, freq] = pd.DataFrame({
+				'open': close, 'high': close + .05, 'low': close - .05, 'close': close, 'volume': 1000.
+			}, index=index)
+		return self._frames[limit, freq].copy()
+
+	def get(self, path, params=None, version='v1'):
+		# raw JSON for /aggs/ticker/<symbol>/range/1/<timespan>/<from>/<to>
+		self._check_rate()
+		time.sleep(self.latency)
+		timespan = path.split('/')[6]
+		df = self._frame(1000, 'min' if timespan == 'minute' else 'D')
+		t = df.index.asi8 // 10 ** 6
+		return {'results': [
+			{'t': int(t[i]), 'o': o, 'h': h, 'l': l, 'c': c, 'v': v}
+			for i, (o, h, l, c, v) in enumerate(df[['open', 'high', 'low', 'close', 'volume']].values.tolist())
+		]}
+
+	def historic_agg(self, size, symbol, _from=None, to=None, limit=None):
+		self._check_rate()
+		time.sleep(self.latency)
+		return FakeResult(self._frame(limit or 1000, 'min' if size == 'minute' else 'D'))
+
+	def historic_agg_v2(self, symbol, multiplier, timespan, _from, to, unadjusted=False, limit=None):
+		self._check_rate()
+		time.sleep(self.latency)
+		return FakeResult(self._frame(limit or 1000, 'min' if timespan == 'minute' else 'D'))
+
+
+class FakeAPI:
+
+	def __init__(self, latency=0.05, limit=50):
+		self.polygon = FakePolygon(latency, limit)
+
+
+def bench_warmup(n=200):
+	import algo
+	symbols = ['SYM{}'.format(i) for i in range(n)]
+	for workers, rate in ((1, 1000), (8, 45), (32, 45), (32, 1000)):
+		api = FakeAPI(latency=0.05, limit=50)
+		start = time.perf_counter()
+		history = algo.get_1000m_history_data(symbols, api=api, workers=workers, rate=rate)
+		elapsed = time.perf_counter() - start
+		print('warmup workers={:3} rate={:5} {:6.2f}s for {} symbols ({} requests, {} throttled)'.format(
+			workers, rate, elapsed, len(history), api.polygon.requests, api.polygon.throttled
+		))
+
+
+def bench_restart(n=200):
+	# cold start against an empty cache, then a restart that reads it back
+	import algo
+	from bar_cache import BarCache
+	symbols = ['SYM{}'.format(i) for i in range(n)]
+	with tempfile.TemporaryDirectory() as root:
+		cache = BarCache(root)
+		for label in ('cold', 'warm'):
+			api = FakeAPI(latency=0.05, limit=50)
+			start = time.perf_counter()
+			algo.get_1000m_history_data(symbols, api=api, cache=cache, rate=45)
+			elapsed = time.perf_counter() - start
+			print('restart {} cache {:6.2f}s for {} symbols ({} requests)'.format(label, elapsed, n, api.polygon.requests))
+
+
+def bench_screen(n=10000):
+	# the old per-ticker filter over entities against the column masks
+	from alpaca_trade_api.polygon.entity import Ticker
+	from screener import Screener, snapshot_frame
+	rng = np.random.RandomState(0)
+	raw = [{
+		'ticker': 'SYM{}'.format(i),
+		'lastTrade': {'p': rng.uniform(1, 80)},
+		'prevDay': {'c': 10., 'v': rng.uniform(0, 500000)},
+		'day': {'v': 1000.},
+		'todaysChangePerc': rng.normal(0, 4),
+	} for i in range(n)]
+	symbols = {t['ticker'] for t in raw}
+
+	start = time.perf_counter()
+	tickers = [Ticker(t) for t in raw]
+	old = [ticker for ticker in tickers if (
+		ticker.ticker in symbols and
+		ticker.lastTrade['p'] >= 5.0 and
+		ticker.lastTrade['p'] <= 50 and
+		ticker.prevDay['v'] * ticker.lastTrade['p'] > 1000000 and
+		ticker.todaysChangePerc >= 3.5
+	)]
+	old_elapsed = time.perf_counter() - start
+
+	screener = Screener(None)
+	screener.tradable = lambda: list(symbols)
+	start = time.perf_counter()
+	new = screener.screen(snapshot_frame(raw))
+	new_elapsed = time.perf_counter() - start
+	assert len(old) == len(new)
+	print('screen {} tickers: entities {:.1f}ms, columns {:.1f}ms'.format(n, old_elapsed * 1e3, new_elapsed * 1e3))
+
+
+def bench_ingest(n=200):
+	# the old loop (one symbol, one engine and one to_sql at a time) against
+	# the concurrent upsert pipeline, both into a local SQLite file
+	from sqlalchemy import create_engine
+	from ingest import ingest_daily
+	symbols = ['SYM{}'.format(i) for i in range(n)]
+	with tempfile.TemporaryDirectory() as root:
+		url = 'sqlite:///{}/stocks.db'.format(root)
+		api = FakeAPI(latency=0.02, limit=1000)
+		start = time.perf_counter()
+		for symbol in symbols:
+			df = api.polygon.historic_agg_v2(symbol, 1, 'day', _from='2019-01-01', to='2020-01-01', limit=250).df
+			df.insert(0, column='symbol', value=symbol)
+			df = df.reset_index().rename(columns={'index': 'timestamp'})
+			df['timestamp'] = df['timestamp'].dt.date
+			# a fresh connection per symbol, as get_historical_stock_data made
+			con = sqlite3.connect('{}/stocks.db'.format(root))
+			df.to_sql(name='old_stocks', con=con, if_exists='append', chunksize=1000, index=False)
+			con.close()
+		elapsed = time.perf_counter() - start
+		print('ingest loop   {:6.2f}s for {} symbols'.format(elapsed, n))
+
+		api = FakeAPI(latency=0.02, limit=1000)
+		polygon = api.polygon
+		fetch = polygon.historic_agg_v2
+		polygon.historic_agg_v2 = lambda *args, **kwargs: fetch(*args, **dict(kwargs, limit=250))
+		summary = ingest_daily(symbols, '2019-01-01', '2020-01-01', create_engine(url), api=api, rate=500)
+		print('ingest upsert {:6.2f}s for {} symbols, {} rows'.format(summary.elapsed, n, summary.rows))
+
+
+def peak_rss(mode, n):
+	# run in a fresh process: peak RSS in MB after loading n symbols of
+	# daily history (1000 days each) the old way or streamed to a CSV file
+	import resource
+	import stock_data
+	from ingest import CsvSink
+	api = FakeAPI(latency=0, limit=10 ** 9)
+	symbols = ['SYM{}'.format(i) for i in range(n)]
+	if mode == 'frame':
+		rows = len(stock_data.get_historical_stock_data(symbols, api=api))
+	else:
+		with tempfile.TemporaryDirectory() as root:
+			rows = stock_data.stream_historical_stock_data(CsvSink(root + '/stocks.csv'), symbols, api=api)
+	print(rows, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+
+
+def bench_memory(sizes=(50, 500, 2000)):
+	import subprocess
+	for n in sizes:
+		for mode in ('frame', 'stream'):
+			out = subprocess.run(
+				[sys.executable, __file__, '_rss', mode, str(n)], stdout=subprocess.PIPE, check=True
+			).stdout.decode().split()
+			print('history {:6} {:9} rows  peak RSS {:7.1f}MB'.format(mode, int(out[-2]), float(out[-1])))
+
+
+def bench_tick(n=20000):
+	# per-tick cost of a second bar for a symbol with an open order: the old
+	# handler's datetime floor, tz-aware .loc aggregation and pytz order age
+	# check against the engine's integer minute keys
+	from pytz import timezone
+	from engine import OpenOrder, StaticAccount, StrategyEngine
+	from session import SessionClock
+	open_dt = pd.Timestamp('2020-01-02 09:30', tz='America/New_York')
+	open_ms = int(open_dt.timestamp()) * 1000
+	starts = [open_ms + (20 * 60 + i) * 1000 for i in range(n)]
+	submitted_at = (open_dt + pd.Timedelta(minutes=20)).to_pydatetime()
+
+	index = pd.date_range(open_dt - pd.Timedelta(minutes=1000), periods=1000, freq='min')
+	history = pd.DataFrame(10., index=index, columns=['open', 'high', 'low', 'close', 'volume'])
+	start = time.perf_counter()
+	for ms in starts:
+		# the stream entity built a Timestamp on every .start access
+		ts = pd.Timestamp(ms, tz='America/New_York', unit='ms')
+		ts -= timedelta(seconds=ts.second, microseconds=ts.microsecond)
+		try:
+			current = history.loc[ts]
+		except KeyError:
+			current = None
+		if current is None:
+			new_data = [10., 10., 10., 10., 100]
+		else:
+			new_data = [current.open, max(10., current.high), min(10., current.low), 10., current.volume + 100]
+		history.loc[ts] = new_data
+		submission_ts = submitted_at.astimezone(timezone('America/New_York'))
+		(ts - submission_ts).seconds // 60 > 1
+	old_elapsed = time.perf_counter() - start
+
+	engine = StrategyEngine(SessionClock.from_datetimes(open_dt, open_dt + pd.Timedelta(minutes=390)), StaticAccount(1e5))
+	engine.watch('AAA')
+	engine.open_orders['AAA'] = OpenOrder('o1', submitted_at.timestamp(), 'buy', 10.)
+	bars = [Bar('AAA', 10., 10., 10., 10., 100, ms) for ms in starts]
+	start = time.perf_counter()
+	for bar in bars:
+		engine.on_second_bar(bar)
+	new_elapsed = time.perf_counter() - start
+	print('tick {} second bars: datetime keys {:6.1f}us/tick, minute keys {:6.1f}us/tick'.format(
+		n, old_elapsed / n * 1e6, new_elapsed / n * 1e6
+	))
+
+
+def bench_signals(n=500, minutes=1000):
+	# one minute's entry and exit checks for n symbols: ta's macd and
+	# find_stop per symbol against the engine's vectorized pass
+	from ta.trend import macd
+	from bar_store import MinuteBars
+	from engine import StaticAccount, StrategyEngine, find_stop
+	from session import SessionClock
+	rng = np.random.RandomState(0)
+	open_dt = pd.Timestamp('2020-01-02 09:30', tz='America/New_York')
+	engine = StrategyEngine(SessionClock.from_datetimes(open_dt, open_dt + pd.Timedelta(minutes=390)), StaticAccount(1e6))
+	first = int(open_dt.timestamp()) // 60 + 30 - minutes
+	symbols = ['SYM{}'.format(i) for i in range(n)]
+	for symbol in symbols:
+		closes = 20 + np.cumsum(rng.normal(0, 0.05, minutes))
+		history = MinuteBars()
+		history.load(np.arange(first, first + minutes), closes, closes + .02, closes - .02, closes, np.full(minutes, 500.))
+		engine.watch(symbol, history, prev_close=19., volume=50000)
+		engine.add_position(symbol, 10, 20.)
+
+	start = time.perf_counter()
+	for symbol in symbols:
+		history = engine.minute_history[symbol]
+		closes = pd.Series(history.closes())
+		for n_fast, n_slow in ((12, 26), (40, 60), (12, 21)):
+			macd(closes, n_fast=n_fast, n_slow=n_slow).values[-3:]
+		find_stop(closes.values[-1], history, None)
+	old_elapsed = time.perf_counter() - start
+
+	start = time.perf_counter()
+	entries = engine.rank_entries(symbols)
+	exits = engine.rank_exits(symbols)
+	new_elapsed = time.perf_counter() - start
+	print('signals {} symbols x {} minutes: per symbol {:7.1f}ms, vectorized {:7.1f}ms ({} entries, {} exits)'.format(
+		n, minutes, old_elapsed * 1e3, new_elapsed * 1e3, len(entries), len(exits)
+	))
+
+
+def stream_events(symbols=200, minutes=390, per_minute=5, seed=0):
+	# a recording of random-walk second and minute bars for `symbols`
+	# symbols, each gapping up 5% on the day
+	rng = np.random.RandomState(seed)
+	open_dt = pd.Timestamp('2020-01-02 09:30', tz='America/New_York')
+	open_ms = int(open_dt.timestamp()) * 1000
+	names = ['SYM{}'.format(i) for i in range(symbols)]
+	events = [{'ev': 'session', 'open': open_dt.isoformat(), 'close': (open_dt + pd.Timedelta(minutes=390)).isoformat()}]
+	events += [{'ev': 'watch', 'symbol': symbol, 'prev_close': 19., 'volume': 50000} for symbol in names]
+	prices = 20 + np.cumsum(rng.normal(0, 0.01, (minutes * per_minute, symbols)), axis=0)
+	step = 60000 // per_minute
+	for m in range(minutes):
+		for k in range(per_minute):
+			row = prices[m * per_minute + k]
+			for symbol, price in zip(names, row.tolist()):
+				events.append({
+					'ev': 'A', 'symbol': symbol, 'open': price, 'high': price, 'low': price, 'close': price,
+					'volume': 100, 'start': open_ms + m * 60000 + k * step
+				})
+		block = prices[m * per_minute:(m + 1) * per_minute]
+		for i, symbol in enumerate(names):
+			events.append({
+				'ev': 'AM', 'symbol': symbol, 'open': float(block[0, i]), 'high': float(block[:, i].max()),
+				'low': float(block[:, i].min()), 'close': float(block[-1, i]), 'volume': 100 * per_minute,
+				'start': open_ms + m * 60000
+			})
+	return events
+
+
+def bench_shards(workers=(1, 2, 4)):
+	# replay one recording in a single process, then sharded over more and
+	# more worker processes; throughput should scale with free cores
+	from replay import ReplayAdapter, build_engine
+	from shards import replay_sharded
+	events = stream_events()
+	stats = ReplayAdapter(build_engine(events)).run(events)
+	print('shards single process {:9.0f} events/s ({} events)'.format(stats.events_per_second, stats.events))
+	for n in workers:
+		stats, _ = replay_sharded(events, n)
+		print('shards {} workers      {:9.0f} events/s  p99 {:6.1f}us ({} cores)'.format(
+			n, stats.events_per_second, stats.percentile(99) * 1e6, os.cpu_count()
+		))
+
+
+def polygon_frames(n, per_frame=20, symbols=200):
+	# raw Polygon frames of per_frame second bars each, as the stream sends them
+	start = int(pd.Timestamp('2020-01-02 09:30', tz='America/New_York').timestamp()) * 1000
+	frames = []
+	for f in range(n // per_frame):
+		frames.append(json.dumps([
+			{
+				'ev': 'A', 'sym': 'SYM{}'.format(i % symbols), 'v': 100, 'av': 50000, 'op': 19.5, 'vw': 20.01,
+				'o': 20., 'c': 20.02, 'h': 20.03, 'l': 19.99, 'a': 20., 'z': 50,
+				's': start + f * 1000, 'e': start + f * 1000 + 1000
+			}
+			for i in range(f * per_frame, (f + 1) * per_frame)
+		]))
+	return frames
+
+
+def bench_decode(n=200000):
+	# messages a second from raw frame to what the handlers read: the
+	# library's json.loads, _cast to an Agg entity and to_bar, against
+	# decode.py's records and structured rows
+	from alpaca_trade_api.polygon.streamconn import StreamConn as PolygonStreamConn
+	from decode import decode_bars, decode_frame, loads
+	from engine import to_bar
+	frames = polygon_frames(n)
+	n = sum(1 for frame in frames for _ in loads(frame))
+	cast = PolygonStreamConn._cast
+
+	start = time.perf_counter()
+	for frame in frames:
+		for msg in json.loads(frame):
+			raw = cast(None, msg['ev'], msg)._raw
+			to_bar(raw)
+			raw.get('end', raw['start'] + 1000)
+	old_elapsed = time.perf_counter() - start
+
+	start = time.perf_counter()
+	for frame in frames:
+		decode_frame(frame)
+	record_elapsed = time.perf_counter() - start
+
+	start = time.perf_counter()
+	for frame in frames:
+		decode_bars(frame)
+	rows_elapsed = time.perf_counter() - start
+	print('decode {} messages: entities {:9.0f} msgs/s, records {:9.0f} msgs/s, structured rows {:9.0f} msgs/s ({})'.format(
+		n, n / old_elapsed, n / record_elapsed, n / rows_elapsed, loads.__module__
+	))
+
+
+def bench_journal(symbols=200, events=5000):
+	# restart from a day's journal: load the snapshot and log, then restore
+	# every symbol into a fresh engine
+	from engine import OpenOrder, StaticAccount, StrategyEngine
+	from journal import Journal, reconcile
+	from session import SessionClock
+	open_dt = pd.Timestamp('2020-01-02 09:30', tz='America/New_York')
+
+	def engine():
+		return StrategyEngine(SessionClock.from_datetimes(open_dt, open_dt + pd.Timedelta(minutes=390)), StaticAccount(1e6))
+
+	names = ['SYM{}'.format(i) for i in range(symbols)]
+	source = engine()
+	with tempfile.TemporaryDirectory() as root:
+		journal = Journal('2020-01-02', root)
+		for i in range(events):
+			symbol = names[i % symbols]
+			source.positions[symbol] = i
+			source.stop_prices[symbol] = 19.
+			source.open_orders[symbol] = OpenOrder('o{}'.format(i), 1577977000 + i, 'buy', 20.)
+			journal.record('trade_update', symbol, source.symbol_state(symbol))
+		start = time.perf_counter()
+		restored, _ = reconcile(engine(), Journal('2020-01-02', root).load(), [])
+		elapsed = time.perf_counter() - start
+		journal.close()
+	print('journal restart {} symbols after {} events: {:6.1f}ms'.format(len(restored), events, elapsed * 1e3))
+
+
+# where bench_suite keeps its results, one JSON file per run
+RESULTS_DIR = os.environ.get('BENCH_RESULTS_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_results'))
+SUITE_SIZES = (10, 100, 1000)
+
+
+def rss_mb():
+	# current resident set size; Linux only, None elsewhere
+	try:
+		with open('/proc/self/statm') as f:
+			return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 ** 2
+	except OSError:
+		return None
+
+
+def suite_run(symbols, minutes, seed):
+	# run in a fresh process so the peak RSS is this size's alone: replay a
+	# synthetic market through the engine and print the figures as JSON
+	import resource
+	from replay import ReplayAdapter, build_engine
+	from synthetic import SyntheticMarket
+	market = SyntheticMarket(symbols, minutes, seed)
+	adapter = ReplayAdapter(build_engine(market.header(), history=market.history))
+	bars = list(market.bars())
+	del market
+	before = rss_mb()
+	stats = adapter.play(bars)
+	# what the engine's state and the latencies grew by
+	growth = rss_mb() - before if before is not None else None
+	result = {
+		'symbols': symbols,
+		'events': stats.events,
+		'events_per_second': stats.events_per_second,
+		'p50_us': stats.percentile(50) * 1e6,
+		'p99_us': stats.percentile(99) * 1e6,
+		'channels': {
+			channel: {'p50_us': stats.percentile(50, channel) * 1e6, 'p99_us': stats.percentile(99, channel) * 1e6}
+			for channel, values in stats.latencies.items() if len(values)
+		},
+		'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+		'replay_mb': growth,
+		'orders': adapter.broker.orders,
+	}
+	print(json.dumps(result))
+
+
+def git_revision():
+	import subprocess
+	try:
+		return subprocess.run(
+			['git', 'rev-parse', '--short', 'HEAD'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True,
+			cwd=os.path.dirname(os.path.abspath(__file__))
+		).stdout.decode().strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+
+def last_results(minutes, seed):
+	# the newest saved run made with the same market, or None
+	try:
+		names = sorted(name for name in os.listdir(RESULTS_DIR) if name.endswith('.json'))
+	except OSError:
+		return None
+	for name in reversed(names):
+		with open(os.path.join(RESULTS_DIR, name)) as f:
+			run = json.load(f)
+		if run['minutes'] == minutes and run['seed'] == seed:
+			return run
+	return None
+
+
+def change(new, old):
+	return '{:+6.1f}%'.format((new - old) / old * 100) if old else '     -'
+
+
+def bench_suite(sizes=SUITE_SIZES, minutes=90, seed=0):
+	# Handler throughput, p50/p99 per-event latency and peak memory for a
+	# synthetic market of each size, from the open through the buy window and
+	# the gappers' fade. Each run is saved to RESULTS_DIR and compared with
+	# the last one saved for the same market.
+	import platform
+	import subprocess
+	previous = last_results(minutes, seed)
+	before = {result['symbols']: result for result in previous['results']} if previous else {}
+	results = []
+	for n in sizes:
+		out = subprocess.run(
+			[sys.executable, __file__, '_suite', str(n), str(minutes), str(seed)], stdout=subprocess.PIPE, check=True
+		).stdout.decode().splitlines()
+		result = json.loads(out[-1])
+		results.append(result)
+		line = 'suite {:5} symbols {:8} events {:9.0f} events/s  p50 {:6.1f}us  p99 {:6.1f}us  peak RSS {:7.1f}MB (replay +{:.1f}MB)  {:4} orders'.format(
+			n, result['events'], result['events_per_second'], result['p50_us'], result['p99_us'],
+			result['peak_rss_mb'], result['replay_mb'] or 0, result['orders']
+		)
+		old = before.get(n)
+		if old is not None:
+			line += '  vs {}: {} events/s, p99 {}, RSS {}'.format(
+				previous['revision'] or previous['at'], change(result['events_per_second'], old['events_per_second']),
+				change(result['p99_us'], old['p99_us']), change(result['peak_rss_mb'], old['peak_rss_mb'])
+			)
+		print(line)
+	run = {
+		'at': datetime.now().isoformat(timespec='seconds'),
+		'revision': git_revision(),
+		'python': platform.python_version(),
+		'machine': platform.platform(),
+		'cpus': os.cpu_count(),
+		'minutes': minutes,
+		'seed': seed,
+		'results': results,
+	}
+	os.makedirs(RESULTS_DIR, exist_ok=True)
+	path = os.path.join(RESULTS_DIR, 'suite-{}.json'.format(datetime.now().strftime('%Y%m%d-%H%M%S')))
+	with open(path, 'w') as f:
+		json.dump(run, f, indent=1)
+	print('saved {}'.format(path))
+
+
+BENCHMARKS = {
+	'writer': bench_bar_writer,
+	'warmup': bench_warmup,
+	'restart': bench_restart,
+	'screen': bench_screen,
+	'ingest': bench_ingest,
+	'memory': bench_memory,
+	'tick': bench_tick,
+	'signals': bench_signals,
+	'shards': bench_shards,
+	'decode': bench_decode,
+	'journal': bench_journal,
+	'suite': bench_suite,
+}
+
+
+if __name__ == '__main__':
+	if sys.argv[1:2] == ['_rss']:
+		peak_rss(sys.argv[2], int(sys.argv[3]))
+		sys.exit()
+	if sys.argv[1:2] == ['_suite']:
+		suite_run(*[int(arg) for arg in sys.argv[2:5]])
+		sys.exit()
+	for name in sys.argv[1:] or BENCHMARKS:
+		BENCHMARKS[name]()
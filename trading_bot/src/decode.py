@@ -0,0 +1,225 @@
+import asyncio
+import json
+
+import numpy as np
+from alpaca_trade_api import StreamConn
+from alpaca_trade_api.polygon.streamconn import StreamConn as PolygonStreamConn
+
+from inbox import ConflatingInbox
+
+try:
+	# optional; several times faster than json on the stream's frames
+	import orjson
+	loads = orjson.loads
+except ImportError:
+	loads = json.loads
+
+
+# Decodes the Polygon stream's bar messages straight into BarRecords. The
+# library builds a renamed dict and an Agg entity for every message and
+# turns start and end into Timestamps on each read; here a frame is parsed
+# once and each A/AM message becomes a slotted record with epoch ms ints,
+# which the engine takes as it takes a Bar. Other messages (status, trades)
+# keep the library's entities.
+
+# the Polygon message fields behind BarRecord's attributes
+FIELDS = (('sym', 'symbol'), ('o', 'open'), ('h', 'high'), ('l', 'low'), ('c', 'close'), ('v', 'volume'),
+          ('s', 'start'), ('e', 'end'))
+# bar length in ms, for messages without an end
+SPANS = {'A': 1000, 'AM': 60000}
+# events dispatched between chances for the reader to queue (and merge) more
+YIELD_EVERY = 8
+
+# a frame's bars as rows of a structured array, for batch consumers
+BAR_DTYPE = np.dtype([
+	('ev', 'U2'), ('symbol', 'U8'), ('open', 'f8'), ('high', 'f8'), ('low', 'f8'), ('close', 'f8'),
+	('volume', 'i8'), ('start', 'i8'), ('end', 'i8')
+])
+
+
+class BarRecord:
+	# start and end are epoch milliseconds
+
+	__slots__ = ('symbol', 'open', 'high', 'low', 'close', 'volume', 'start', 'end')
+
+	def __init__(self, symbol, open, high, low, close, volume, start, end):
+		self.symbol = symbol
+		self.open = open
+		self.high = high
+		self.low = low
+		self.close = close
+		self.volume = volume
+		self.start = start
+		self.end = end
+
+	def merge(self, later):
+		# fold a later bar of the same minute into this one
+		if later.high > self.high:
+			self.high = later.high
+		if later.low < self.low:
+			self.low = later.low
+		self.close = later.close
+		self.volume += later.volume
+		self.end = later.end
+
+	def raw(self):
+		# the fields as the library's Agg names them, e.g. for EventRecorder
+		return {name: getattr(self, name) for _, name in FIELDS}
+
+	def __repr__(self):
+		return 'BarRecord({})'.format(self.raw())
+
+
+def decode_bar(msg):
+	# an A or AM message dict to a BarRecord
+	start = msg['s']
+	end = msg.get('e')
+	if end is None:
+		end = start + SPANS[msg['ev']]
+	return BarRecord(msg['sym'], msg['o'], msg['h'], msg['l'], msg['c'], msg['v'], start, end)
+
+
+def decode_frame(frame):
+	# [(ev, BarRecord or message dict), ...] for a raw frame (str or bytes)
+	return [
+		(msg.get('ev'), decode_bar(msg) if msg.get('ev') in SPANS else msg)
+		for msg in loads(frame)
+	]
+
+
+def decode_bars(frame):
+	# the A and AM messages of a raw frame as a BAR_DTYPE array
+	rows = []
+	for msg in loads(frame):
+		ev = msg.get('ev')
+		if ev in SPANS:
+			start = msg['s']
+			end = msg.get('e')
+			rows.append((
+				ev, msg['sym'], msg['o'], msg['h'], msg['l'], msg['c'], msg['v'], start,
+				start + SPANS[ev] if end is None else end
+			))
+	return np.array(rows, dtype=BAR_DTYPE)
+
+
+class FastPolygonStream(PolygonStreamConn):
+	# Handlers registered for bar channels get BarRecords instead of Agg
+	# entities. The handlers for a channel are looked up once, not matched
+	# against every pattern for every message. Messages go through inbox: a
+	# reader queues them as fast as the socket delivers them and a
+	# dispatcher hands them to the handlers, so second bars that pile up
+	# behind a slow handler are merged while they wait.
+
+	def __init__(self, key_id=None, inbox=None):
+		super().__init__(key_id)
+		self._routes = {}
+		self.inbox = ConflatingInbox() if inbox is None else inbox
+		self._queued = asyncio.Event()
+
+	async def _consume_msg(self):
+		dispatcher = asyncio.ensure_future(self._drain())
+		dispatcher.add_done_callback(self._on_drain_done)
+		try:
+			async for data in self._stream:
+				channel = data.get('ev')
+				if channel in SPANS:
+					self.inbox.put(channel, decode_bar(data))
+				elif channel:
+					self.inbox.put(channel, data)
+				elif data.get('status') == 'disconnected':
+					# as the library: Polygon sends this without an 'ev'
+					data['ev'] = 'status'
+					await self._dispatch(data)
+					raise ConnectionResetError('Polygon terminated connection: ({})'.format(data.get('message')))
+				else:
+					continue
+				self._queued.set()
+		finally:
+			dispatcher.cancel()
+
+	async def _drain(self):
+		inbox = self.inbox
+		while True:
+			await self._queued.wait()
+			self._queued.clear()
+			dispatched = 0
+			while inbox:
+				channel, event = inbox.get()
+				if channel in SPANS:
+					await self._dispatch_bar(channel, event)
+				else:
+					await self._dispatch(event)
+				dispatched += 1
+				if dispatched % YIELD_EVERY == 0:
+					await asyncio.sleep(0)
+
+	def _on_drain_done(self, task):
+		# a handler's exception would otherwise only surface when the task is
+		# collected
+		if not task.cancelled() and task.exception() is not None:
+			self.loop.call_exception_handler({
+				'message': 'Stream dispatch failed', 'exception': task.exception(), 'task': task
+			})
+
+	async def _recv(self):
+		# As the library's, with the faster parser, but a dropped connection
+		# isn't reconnected here: the disconnected status tells the
+		# StreamSupervisor, which reconnects through a new FastPolygonStream.
+		# Reconnecting this one as well would leave two connections
+		# dispatching into the shared inbox.
+		try:
+			while True:
+				r = await self._ws.recv()
+				for update in loads(r):
+					yield update
+		except Exception as e:
+			await self._dispatch({
+				'ev': 'status', 'status': 'disconnected', 'message': f'Polygon Disconnected Unexpectedly ({e})'
+			})
+			await self.close()
+
+	async def _dispatch(self, msg):
+		channel = msg.get('ev')
+		if channel not in SPANS:
+			return await super()._dispatch(msg)
+		await self._dispatch_bar(channel, decode_bar(msg))
+
+	async def _dispatch_bar(self, channel, bar):
+		handlers = self._routes.get(channel)
+		if handlers is None:
+			handlers = self._routes[channel] = [
+				(handler, self._handler_symbols.get(handler))
+				for pat, handler in self._handlers.items() if pat.match(channel)
+			]
+		for handler, symbols in handlers:
+			if symbols is None or bar.symbol in symbols:
+				await handler(self, channel, bar)
+
+	def register(self, channel_pat, func, symbols=None):
+		super().register(channel_pat, func, symbols)
+		self._routes.clear()
+
+	def deregister(self, channel_pat):
+		super().deregister(channel_pat)
+		self._routes.clear()
+
+
+class FastStreamConn(StreamConn):
+	# alpaca_trade_api's StreamConn with its Polygon connection decoding
+	# bars through FastPolygonStream. The inbox outlives reconnects, and
+	# with it the merge counters.
+
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		self.inbox = ConflatingInbox()
+
+	async def _ensure_polygon(self):
+		if self.polygon is not None:
+			return
+		key_id = self._key_id
+		if 'staging' in self._base_url:
+			key_id += '-staging'
+		self.polygon = FastPolygonStream(key_id, self.inbox)
+		self.polygon._handlers = self._handlers.copy()
+		self.polygon._handler_symbols = self._handler_symbols.copy()
+		await self.polygon.connect()
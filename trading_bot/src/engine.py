@@ -0,0 +1,406 @@
+import math
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from bar_store import MinuteBars
+from indicators import IndicatorState
+from session import SessionState
+from signals import Candidate, entry_signals, exit_signals, stack
+
+
+# The trading strategy as a plain object: feed it bar and trade update events
+# and it returns the orders it wants placed. It never talks to the broker or
+# the stream itself, so it runs the same live, from a recorded event file, or
+# in a benchmark.
+
+# Stop limit to default to
+default_stop = .95
+# How much of our portfolio to allocate to any one position
+max_allocation = 0.01
+# Entry filters: change on the day and shares traded so far
+min_daily_change = .04
+min_volume_today = 30000
+
+# Order intents returned by the engine for an adapter to carry out
+Submit = namedtuple('Submit', ['symbol', 'qty', 'side', 'type', 'limit_price'])
+Cancel = namedtuple('Cancel', ['symbol', 'order_id'])
+# Sell whatever the broker holds in symbol at market
+Liquidate = namedtuple('Liquidate', ['symbol'])
+# Stop streaming symbol; the engine has no further use for it today
+Unwatch = namedtuple('Unwatch', ['symbol'])
+
+# The bar fields the engine reads. start is epoch milliseconds, as in the
+# stream's raw Agg messages, so the engine keys everything by integer epoch
+# minute and never builds a datetime per tick.
+Bar = namedtuple('Bar', ['symbol', 'open', 'high', 'low', 'close', 'volume', 'start'])
+# An order we're waiting on; id is None until the broker acknowledges it.
+# submitted_at is epoch seconds.
+OpenOrder = namedtuple('OpenOrder', ['id', 'submitted_at', 'side', 'limit_price'])
+
+
+def to_bar(raw):
+	# a raw Agg message (the stream entity's _raw) to a Bar
+	return Bar(raw['symbol'], raw['open'], raw['high'], raw['low'], raw['close'], raw['volume'], raw['start'])
+
+
+def to_epoch(ts):
+	# broker timestamps (datetimes or ISO strings) to epoch seconds; numbers
+	# are taken to be epoch seconds already
+	if isinstance(ts, (int, float)):
+		return ts
+	return pd.Timestamp(ts).timestamp()
+
+
+def find_stop(current_value, minute_history, now):
+	# this functions finds the price of the most recent price valley eg. 26 -> {24} -> 25
+	# otherwise limit our loss to 5%
+	series = minute_history.lows(100)
+	diff = np.diff(series)
+	low_index = np.where((diff[:-1] <= 0) & (diff[1:] > 0))[0] + 1
+	if len(low_index) > 0:
+		return series[low_index[-1]] - 0.01
+	return current_value * default_stop
+
+
+def load_indicators(history):
+	indicators = IndicatorState()
+	indicators.load(history.column('minute'), history.closes())
+	return indicators
+
+
+class StaticAccount:
+	# Account figures for replays and tests
+
+	def __init__(self, portfolio_value, cash=None):
+		self.portfolio_value = portfolio_value
+		self.cash = portfolio_value if cash is None else cash
+
+
+class StrategyEngine:
+
+	def __init__(self, clock, account, batch=False):
+		# clock is the day's SessionClock. In batch mode entries and exits are
+		# decided for all symbols together as each minute closes (see
+		# on_minute_close) rather than on every second bar.
+		self.clock = clock
+		self.batch = batch
+		# the newest minute a second bar has been seen for
+		self.last_minute = None
+		self.open_minute = clock.open_minute
+		# anything with portfolio_value and cash attributes
+		self.account = account
+		self.symbols = set()
+		self.minute_history = {}
+		self.indicators = {}
+		# SessionState per symbol: opening range, volume, change on the day
+		self.sessions = {}
+		self.open_orders = {}
+		self.positions = {}
+		self.partial_fills = {}
+		self.stop_prices = {}
+		self.target_prices = {}
+		self.latest_cost_basis = {}
+
+	@property
+	def done(self):
+		return not self.symbols
+
+	def watch(self, symbol, history=None, prev_close=None, volume=0):
+		self.symbols.add(symbol)
+		if history is None:
+			history = self.minute_history.get(symbol) or MinuteBars()
+		self.minute_history[symbol] = history
+		self.indicators[symbol] = load_indicators(history)
+		if prev_close is None and symbol in self.sessions:
+			prev_close = self.sessions[symbol].prev_close
+		self.sessions[symbol] = SessionState(self.open_minute, prev_close, volume, history)
+
+	def add_position(self, symbol, qty, cost_basis, history=None):
+		# a position bought during a previous execution
+		if symbol not in self.symbols or history is not None:
+			volume = self.sessions[symbol].volume_today if symbol in self.sessions else 0
+			self.watch(symbol, history, volume=volume)
+		self.positions[symbol] = qty
+		self.latest_cost_basis[symbol] = cost_basis
+		# limit our loss to 5% from cost basis
+		self.stop_prices[symbol] = cost_basis * default_stop
+
+	def on_second_bar(self, bar):
+		symbol = bar.symbol
+		if symbol not in self.symbols:
+			return []
+		minute = bar.start // 60000
+		if self.batch and (self.last_minute is None or minute > self.last_minute):
+			# the first bar of a new minute closes the one before it, before
+			# this bar lands in its symbol's history
+			closed = self.on_minute_close(self.last_minute) if self.last_minute is not None else []
+			self.last_minute = minute
+			return closed + self._second_bar(symbol, minute, bar)
+		return self._second_bar(symbol, minute, bar)
+
+	def _second_bar(self, symbol, minute, bar):
+		# First, aggregate 1s bars for up-to-date MACD calculations
+		history = self.minute_history[symbol]
+		history.merge_bar(minute, bar.open, bar.high, bar.low, bar.close, bar.volume)
+		if not self.indicators[symbol].update(minute, bar.close):
+			self.indicators[symbol] = load_indicators(history)
+		self.sessions[symbol].on_second_bar(minute, bar.high, bar.low, bar.close, bar.volume)
+
+		# Next, check for existing orders for the stock
+		existing_order = self.open_orders.get(symbol)
+		if existing_order is not None:
+			# Make sure the order's not too old
+			if existing_order.id is not None:
+				order_lifetime = minute * 60 - existing_order.submitted_at
+				if order_lifetime // 60 > 1:
+					# Cancel it so we can try again for a fill
+					return [Cancel(symbol, existing_order.id)]
+			return []
+
+		# Now we check to see if it might be time to buy or sell
+		since_market_open = minute - self.open_minute
+		until_market_close = self.clock.close_minute - minute
+		if self.batch and until_market_close > 15:
+			# entries and exits wait for the minute to close
+			return []
+		if 15 < since_market_open < 60:
+			# See if we've already bought in first
+			if self.positions.get(symbol, 0) > 0:
+				return []
+			return self._check_buy(symbol, bar.close, minute)
+		if since_market_open >= 15 and until_market_close > 15:
+			return self._check_sell(symbol, bar.close, minute)
+		elif until_market_close <= 15:
+			# Trading is over for this symbol
+			return self.retire(symbol)
+		return []
+
+	def retire(self, symbol):
+		self.symbols.discard(symbol)
+		return [Liquidate(symbol), Unwatch(symbol)]
+
+	def needs_ticks(self, symbol, minute):
+		# whether symbol's second bars can still lead to an order from epoch
+		# minute on: during the buy window, or while it has a position or an
+		# open order
+		if self.positions.get(symbol, 0) != 0 or self.open_orders.get(symbol) is not None:
+			return True
+		return minute - self.open_minute < 60
+
+	def on_minute_bar(self, bar):
+		# Replace aggregated 1s bars with the minute bar
+		symbol = bar.symbol
+		if symbol not in self.minute_history:
+			return []
+		minute = bar.start // 60000
+		history = self.minute_history[symbol]
+		history.set_bar(minute, bar.open, bar.high, bar.low, bar.close, bar.volume)
+		if not self.indicators[symbol].commit(minute, bar.close):
+			self.indicators[symbol] = load_indicators(history)
+		self.sessions[symbol].on_minute_bar(minute, bar.high, bar.low, bar.close, bar.volume, history)
+		return []
+
+	def on_minute_close(self, minute):
+		# Evaluate every watched symbol with a bar in `minute` against the
+		# rules in one vectorized pass, with the same windows as the per-tick
+		# checks: entries by score for as long as cash covers them during the
+		# buy window, exits most urgent first after it.
+		since_market_open = minute - self.open_minute
+		until_market_close = self.clock.close_minute - minute
+		if since_market_open < 15 or until_market_close <= 15:
+			return []
+		ready = [
+			symbol for symbol in sorted(self.symbols)
+			if self.open_orders.get(symbol) is None and self.minute_history[symbol].last_minute == minute
+		]
+		if 15 < since_market_open < 60:
+			return self._entries([symbol for symbol in ready if self.positions.get(symbol, 0) <= 0], minute)
+		return self._exits([symbol for symbol in ready if self.positions.get(symbol, 0) != 0], minute)
+
+	def rank_entries(self, symbols):
+		# entry Candidates among symbols, best first
+		symbols = [symbol for symbol in symbols if self.sessions[symbol].prev_close is not None]
+		if not symbols:
+			return []
+		histories = [self.minute_history[symbol] for symbol in symbols]
+		sessions = [self.sessions[symbol] for symbol in symbols]
+		closes = stack(histories, 'close')
+		mask, stops, scores = entry_signals(
+			closes, stack(histories, 'low', closes.shape[1]),
+			np.array([state.prev_close for state in sessions], dtype=float),
+			np.array([state.range_high for state in sessions], dtype=float),
+			np.array([state.volume_today for state in sessions], dtype=float),
+			min_daily_change, min_volume_today, default_stop
+		)
+		candidates = []
+		for i in np.flatnonzero(mask):
+			symbol = symbols[i]
+			price = float(closes[i, -1])
+			shares = self.account.portfolio_value * max_allocation // price or 1
+			shares -= self.positions.get(symbol, 0)
+			if shares < 1:
+				continue
+			stop = float(stops[i])
+			target = price + (price - stop) * 3
+			candidates.append(Candidate(symbol, 'buy', price, shares, stop, target, float(scores[i])))
+		return sorted(candidates, key=lambda c: -c.score)
+
+	def rank_exits(self, symbols):
+		# exit Candidates among symbols holding a position, most urgent first
+		if not symbols:
+			return []
+		histories = [self.minute_history[symbol] for symbol in symbols]
+		closes = stack(histories, 'close')
+		mask, scores = exit_signals(
+			closes,
+			np.array([self.stop_prices[symbol] for symbol in symbols], dtype=float),
+			np.array([self.target_prices.get(symbol, math.inf) for symbol in symbols], dtype=float),
+			np.array([self.latest_cost_basis[symbol] for symbol in symbols], dtype=float)
+		)
+		candidates = [
+			Candidate(symbols[i], 'sell', float(closes[i, -1]), self.positions[symbols[i]], None, None, float(scores[i]))
+			for i in np.flatnonzero(mask)
+		]
+		return sorted(candidates, key=lambda c: c.score)
+
+	def _entries(self, symbols, minute):
+		intents = []
+		cash = self.account.cash
+		for candidate in self.rank_entries(symbols):
+			cost = candidate.qty * candidate.price
+			if cost > cash:
+				continue
+			cash -= cost
+			self.stop_prices[candidate.symbol] = candidate.stop
+			self.target_prices[candidate.symbol] = candidate.target
+			intents.append(self._submit(candidate.symbol, candidate.qty, 'buy', candidate.price, minute))
+		return intents
+
+	def _exits(self, symbols, minute):
+		return [
+			self._submit(candidate.symbol, candidate.qty, 'sell', candidate.price, minute)
+			for candidate in self.rank_exits(symbols)
+		]
+
+	def symbol_state(self, symbol):
+		# symbol's order and position state as plain values, for journal.py
+		order = self.open_orders.get(symbol)
+		return {
+			'position': self.positions.get(symbol, 0),
+			'partial_fill': self.partial_fills.get(symbol, 0),
+			'stop': self.stop_prices.get(symbol),
+			'target': self.target_prices.get(symbol),
+			'cost_basis': self.latest_cost_basis.get(symbol),
+			'order': list(order) if order is not None else None,
+		}
+
+	def restore_symbol_state(self, symbol, state):
+		# the inverse of symbol_state
+		self.positions[symbol] = state['position']
+		self.partial_fills[symbol] = state['partial_fill']
+		for prices, key in ((self.stop_prices, 'stop'), (self.target_prices, 'target'), (self.latest_cost_basis, 'cost_basis')):
+			if state[key] is None:
+				prices.pop(symbol, None)
+			else:
+				prices[symbol] = state[key]
+		self.open_orders[symbol] = OpenOrder(*state['order']) if state['order'] is not None else None
+
+	def on_trade_update(self, event, order):
+		# order is the trade update's order dict
+		symbol = order['symbol']
+		if self.open_orders.get(symbol) is None:
+			return []
+		if event == 'partial_fill' or event == 'fill':
+			qty = int(order['filled_qty'])
+			if order['side'] == 'sell':
+				qty = qty * -1
+			self.positions[symbol] = (
+					self.positions.get(symbol, 0) - self.partial_fills.get(symbol, 0)
+			)
+			self.positions[symbol] += qty
+			if event == 'partial_fill':
+				self.partial_fills[symbol] = qty
+				self.open_orders[symbol] = OpenOrder(
+					order['id'], to_epoch(order['submitted_at']), order['side'],
+					self.open_orders[symbol].limit_price
+				)
+			else:
+				self.partial_fills[symbol] = 0
+				self.open_orders[symbol] = None
+		elif event == 'canceled' or event == 'rejected':
+			self.partial_fills[symbol] = 0
+			self.open_orders[symbol] = None
+		return []
+
+	def on_order_submitted(self, symbol, order):
+		# the broker accepted a Submit; order has id and submitted_at
+		pending = self.open_orders.get(symbol)
+		if pending is None or pending.id is not None:
+			# already filled or cancelled by a trade update
+			return
+		self.open_orders[symbol] = OpenOrder(
+			order.id, to_epoch(order.submitted_at), pending.side, pending.limit_price
+		)
+		self.latest_cost_basis[symbol] = pending.limit_price
+
+	def on_order_rejected(self, symbol):
+		# the broker refused a Submit
+		self.open_orders[symbol] = None
+
+	def _submit(self, symbol, qty, side, price, minute):
+		self.open_orders[symbol] = OpenOrder(None, minute * 60, side, price)
+		return Submit(symbol, qty, side, 'limit', price)
+
+	def _check_buy(self, symbol, price, minute):
+		state = self.sessions[symbol]
+		if state.prev_close is None:
+			return []
+		# Up on the day, above the high of the first 15 minutes, and traded
+		if not (
+				state.change > min_daily_change and
+				price > state.range_high and
+				state.volume_today > min_volume_today
+		):
+			return []
+
+		# check for a positive, increasing MACD
+		hist = self.indicators[symbol].macd[(12, 26)].tail()
+		if hist[-1] < 0 or not (hist[-3] < hist[-2] < hist[-1]):
+			return []
+		hist = self.indicators[symbol].macd[(40, 60)].tail()
+		if hist[-1] < 0 or hist[-1] - hist[-2] < 0:
+			return []
+
+		# Stock has passed all checks; figure out how much to buy
+		history = self.minute_history[symbol]
+		stop_price = find_stop(price, history, minute)
+		self.stop_prices[symbol] = stop_price
+		self.target_prices[symbol] = price + ((price - stop_price) * 3)
+		# buy enough shares to account for 1% of portfolio
+		shares_to_buy = self.account.portfolio_value * max_allocation // price
+		if shares_to_buy == 0:
+			shares_to_buy = 1
+		shares_to_buy -= self.positions.get(symbol, 0)
+		if shares_to_buy < 1 or price - stop_price <= 0 or shares_to_buy * price > self.account.cash:
+			# do not buy if the price is below or stop price
+			# or we do not have enough cash
+			return []
+		return [self._submit(symbol, shares_to_buy, 'buy', price, minute)]
+
+	def _check_sell(self, symbol, price, minute):
+		# We can't liquidate if there's no position
+		if self.positions.get(symbol, 0) == 0:
+			return []
+		# Sell for a loss if it's fallen below our stop price
+		# Sell for a loss if it's below our cost basis and MACD < 0
+		# Sell for a profit if it's above our target price
+		hist = self.indicators[symbol].macd[(12, 21)].tail()
+		if (
+				price <= self.stop_prices[symbol] or
+				(price >= self.target_prices.get(symbol, math.inf) and hist[-1] <= 0) or
+				(price <= self.latest_cost_basis[symbol] and hist[-1] <= 0)
+		):
+			return [self._submit(symbol, self.positions[symbol], 'sell', price, minute)]
+		return []
@@ -0,0 +1,68 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+# Fetch one REST resource per key on a bounded thread pool. Every request
+# takes a token from a shared bucket first, so throughput follows the API's
+# rate limit rather than the number of keys. Failed requests are retried with
+# backoff, honouring Retry-After on a 429.
+
+
+def retry_delay(error, attempt, base=0.5):
+	response = getattr(error, 'response', None)
+	if response is not None and response.status_code == 429:
+		retry_after = response.headers.get('Retry-After')
+		if retry_after is not None:
+			try:
+				return float(retry_after)
+			except ValueError:
+				pass
+	return base * 2 ** attempt
+
+
+def print_progress(label, every=0.1):
+	# progress callback that prints roughly every `every` of the total
+	state = {'next': 0}
+
+	def report(done, total):
+		if done >= state['next'] or done == total:
+			print('{}: {}/{}'.format(label, done, total))
+			state['next'] = done + max(1, int(total * every))
+	return report
+
+
+def fetch_all(keys, fetch, workers=8, bucket=None, retries=3, progress=None, on_result=None):
+	# returns ({key: result}, {key: exception}) for the keys that succeeded
+	# and the ones that still failed after `retries` retries. With on_result,
+	# each result is handed to on_result(key, result) on the calling thread as
+	# it arrives instead of being kept; an exception there counts as a
+	# failure for that key.
+	def attempt(key):
+		for i in range(retries + 1):
+			if bucket is not None:
+				bucket.acquire()
+			try:
+				return fetch(key)
+			except Exception as e:
+				if i == retries:
+					raise
+				time.sleep(retry_delay(e, i))
+
+	results = {}
+	failures = {}
+	keys = list(keys)
+	with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+		futures = {pool.submit(attempt, key): key for key in keys}
+		for done, future in enumerate(as_completed(futures), 1):
+			key = futures[future]
+			try:
+				result = future.result()
+				if on_result is None:
+					results[key] = result
+				else:
+					on_result(key, result)
+			except Exception as e:
+				failures[key] = e
+			if progress is not None:
+				progress(done, len(keys))
+	return results, failures
@@ -0,0 +1,171 @@
+import asyncio
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from scheduler import CANCEL, ENTRY, EXIT, READ
+
+
+# Non-blocking access to the broker for code running on the stream's event
+# loop. The REST client is synchronous, so every call runs on a small thread
+# pool and is awaited; the loop keeps dispatching bars while HTTP is in
+# flight. Account figures come from a snapshot that trade updates keep
+# current between refreshes, so the strategy can read them on every tick
+# without a request.
+#
+# Given a RequestScheduler, requests are rate limited and prioritised by it;
+# repeat cancels and concurrent reads of the same thing are sent once.
+
+
+class AccountSnapshot:
+
+	def __init__(self, portfolio_value, cash, fetched_at):
+		self.portfolio_value = portfolio_value
+		self.cash = cash
+		self.fetched_at = fetched_at
+
+
+class OrderGateway:
+
+	def __init__(self, api, ttl=60.0, workers=4, scheduler=None):
+		self.api = api
+		self.scheduler = scheduler
+		self.ttl = ttl
+		self.executor = ThreadPoolExecutor(max_workers=workers)
+		self.snapshot = None
+		self.refreshes = 0
+		# cash set aside for buys that haven't filled, by symbol
+		self._reserved = {}
+		# (qty, notional) filled so far, by order id
+		self._filled = {}
+		self._refresh_task = None
+		# orders we've already asked the broker to cancel
+		self._cancelling = set()
+
+	async def call(self, method, *args, **kwargs):
+		# run a REST client method off the loop
+		loop = asyncio.get_event_loop()
+		return await loop.run_in_executor(
+			self.executor, functools.partial(getattr(self.api, method), *args, **kwargs)
+		)
+
+	async def request(self, lane, key, method, *args, **kwargs):
+		if self.scheduler is None:
+			return await self.call(method, *args, **kwargs)
+		return await self.scheduler.schedule(lane, self.call, method, *args, key=key, **kwargs)
+
+	# account
+
+	def load(self):
+		# blocking first fetch, for setup before the loop is running
+		self._set_snapshot(self.api.get_account())
+
+	async def refresh(self):
+		self._set_snapshot(await self.request(READ, 'account', 'get_account'))
+
+	@property
+	def portfolio_value(self):
+		self._check_fresh()
+		return self.snapshot.portfolio_value
+
+	@property
+	def cash(self):
+		# cash not already promised to open buy orders
+		self._check_fresh()
+		return self.snapshot.cash - sum(self._reserved.values())
+
+	def _set_snapshot(self, account):
+		self.snapshot = AccountSnapshot(float(account.portfolio_value), float(account.cash), time.monotonic())
+		self.refreshes += 1
+
+	def _check_fresh(self):
+		# Readers get the current snapshot straight away; a stale one is
+		# refreshed in the background
+		if self.snapshot is None:
+			self.load()
+			return
+		if time.monotonic() - self.snapshot.fetched_at < self.ttl:
+			return
+		if self._refresh_task is not None and not self._refresh_task.done():
+			return
+		try:
+			loop = asyncio.get_running_loop()
+		except RuntimeError:
+			# not on the loop; refresh inline
+			self.load()
+			return
+		self._refresh_task = loop.create_task(self._refresh_quietly())
+
+	async def _refresh_quietly(self):
+		try:
+			await self.refresh()
+		except Exception as e:
+			print(e)
+
+	def on_trade_update(self, event, order):
+		# keep the snapshot's cash in step with fills between refreshes
+		if self.snapshot is None:
+			return
+		symbol = order['symbol']
+		if event == 'partial_fill' or event == 'fill':
+			qty = float(order['filled_qty'])
+			notional = qty * float(order['filled_avg_price'])
+			prev_qty, prev_notional = self._filled.get(order['id'], (0, 0))
+			if order['side'] == 'buy':
+				self.snapshot.cash -= notional - prev_notional
+				remaining = float(order['qty']) - qty
+				self._reserved[symbol] = remaining * float(order.get('limit_price') or 0)
+			else:
+				self.snapshot.cash += notional - prev_notional
+			if event == 'fill':
+				self._filled.pop(order['id'], None)
+				self._reserved.pop(symbol, None)
+			else:
+				self._filled[order['id']] = (qty, notional)
+		elif event == 'canceled' or event == 'rejected' or event == 'expired':
+			self._filled.pop(order.get('id'), None)
+			self._reserved.pop(symbol, None)
+
+	# orders
+
+	async def submit_order(self, symbol, qty, side, type, time_in_force='day', limit_price=None, lane=None,
+	                       client_order_id=None):
+		if lane is None:
+			lane = EXIT if side == 'sell' else ENTRY
+		if side == 'buy' and limit_price is not None:
+			self._reserved[symbol] = float(qty) * float(limit_price)
+		kwargs = {}
+		if limit_price is not None:
+			kwargs['limit_price'] = str(limit_price)
+		if client_order_id is not None:
+			kwargs['client_order_id'] = client_order_id
+		try:
+			return await self.request(
+				lane, None, 'submit_order', symbol=symbol, qty=str(qty), side=side,
+				type=type, time_in_force=time_in_force, **kwargs
+			)
+		except Exception:
+			self._reserved.pop(symbol, None)
+			raise
+
+	async def cancel_order(self, order_id):
+		# the strategy asks again on every tick until the cancel shows up in
+		# trade updates; only the first request goes to the broker
+		if order_id in self._cancelling:
+			return
+		self._cancelling.add(order_id)
+		try:
+			await self.request(CANCEL, ('cancel', order_id), 'cancel_order', order_id)
+		except Exception:
+			self._cancelling.discard(order_id)
+			raise
+
+	async def get_position(self, symbol, lane=READ):
+		# None when there's no position; Alpaca answers that with a 404
+		try:
+			return await self.request(lane, ('position', symbol), 'get_position', symbol)
+		except Exception:
+			return None
+
+	def close(self):
+		self.executor.shutdown(wait=False)
@@ -1,4 +1,6 @@
-from stock_data import get_tradable_symbols, get_historical_stock_data, get_alpaca_api
+from stock_data import get_tradable_symbols, get_db_connection
+from ingest import backfill
+from fetcher import print_progress
 from datetime import timedelta, datetime
 from pytz import timezone
 import time
@@ -6,19 +8,23 @@ import time
 
 # READ THIS
 # cron this script to the frequency in which we want data during open market
+# Each run stores the days since a symbol's last stored day, back to
+# history_start for symbols we've never stored
+
+history_start = datetime(2019, 1, 1)
 
 
 def main():
 	tradable = get_tradable_symbols()
-	for i in range(len(tradable)):
-		symbol = tradable[i:i + 1]
-		nyc = timezone('America/New_York')
-		today = datetime.today().astimezone(nyc)
-		yesterday = today - timedelta(days=1)
-		try:
-			get_historical_stock_data(symbols=symbol, sd=yesterday, to_db=True)
-		except:
-			pass
+	nyc = timezone('America/New_York')
+	today = datetime.today().astimezone(nyc)
+	yesterday = today - timedelta(days=1)
+	engine = get_db_connection()
+	try:
+		summary = backfill(tradable, history_start, yesterday, engine, progress=print_progress('Daily'))
+	finally:
+		engine.dispose()
+	print(summary.report())
 
 
 if __name__ == '__main__':
@@ -0,0 +1,59 @@
+from collections import deque
+
+
+# Where stream events wait between the socket and the handlers. When the
+# loop falls behind, a second bar that arrives while an earlier one for the
+# same symbol and minute is still waiting is merged into it, so the
+# strategy runs once on the latest price instead of once per superseded
+# bar. Minute bars and everything else are queued as they come and never
+# merged.
+
+# the one channel whose events may be merged
+CONFLATED = 'A'
+
+
+class ConflatingInbox:
+
+	def __init__(self):
+		# [channel, event] in arrival order
+		self.queue = deque()
+		# symbol: the queue entry of its second bar still waiting
+		self.waiting = {}
+		self.received = 0
+		self.merged = 0
+		self.max_depth = 0
+
+	def __len__(self):
+		return len(self.queue)
+
+	def put(self, channel, event):
+		# second bars need symbol, start (epoch ms) and merge(later)
+		self.received += 1
+		if channel == CONFLATED:
+			entry = self.waiting.get(event.symbol)
+			if entry is not None and entry[1].start // 60000 == event.start // 60000:
+				entry[1].merge(event)
+				self.merged += 1
+				return
+			entry = [channel, event]
+			self.waiting[event.symbol] = entry
+		else:
+			entry = [channel, event]
+			symbol = getattr(event, 'symbol', None)
+			if symbol is not None:
+				# a later second bar mustn't jump ahead of this minute bar
+				self.waiting.pop(symbol, None)
+		self.queue.append(entry)
+		if len(self.queue) > self.max_depth:
+			self.max_depth = len(self.queue)
+
+	def get(self):
+		# (channel, event) of the oldest entry
+		entry = self.queue.popleft()
+		channel, event = entry
+		if channel == CONFLATED and self.waiting.get(event.symbol) is entry:
+			del self.waiting[event.symbol]
+		return channel, event
+
+	def counts(self):
+		return {'received': self.received, 'merged': self.merged, 'depth': len(self.queue), 'max_depth': self.max_depth}
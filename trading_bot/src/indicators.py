@@ -0,0 +1,186 @@
+import math
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+
+# Incremental versions of the ta indicators used by the strategy.
+# ta.trend.macd is ewm(span=n, min_periods=n, adjust=False).mean() of the fast
+# window minus the same for the slow window; ema_step is the recurrence pandas
+# runs for that, so the streaming values match ta exactly, not approximately.
+
+# (n_fast, n_slow) pairs the strategy reads: buy checks and the sell check
+MACD_WINDOWS = ((12, 26), (40, 60), (12, 21))
+
+
+def ema_alpha(span):
+	com = (span - 1) / 2.0
+	return 1. / (1. + com)
+
+
+def ema_step(avg, value, alpha):
+	if avg != avg:
+		return value
+	# pandas skips the update on a constant series to avoid rounding drift
+	if avg != value:
+		old_wt = 1. - alpha
+		avg = ((old_wt * avg) + (alpha * value)) / (old_wt + alpha)
+	return avg
+
+
+class StreamingMACD:
+	# MACD line over a series of minute closes. Closes are committed once their
+	# minute is final; the still-forming minute is held as a provisional close
+	# that only affects the value returned by tail().
+
+	def __init__(self, n_fast=12, n_slow=26, depth=3):
+		self.n_fast = n_fast
+		self.n_slow = n_slow
+		self.depth = depth
+		self._alpha_fast = ema_alpha(n_fast)
+		self._alpha_slow = ema_alpha(n_slow)
+		self.reset()
+
+	def reset(self):
+		# (fast ema, slow ema, observations) over the committed closes
+		self._state = (math.nan, math.nan, 0)
+		# state before the most recent commit, so that close can be amended
+		self._before = self._state
+		self._values = deque([math.nan] * self.depth, maxlen=self.depth)
+		self._pending = None
+
+	def load(self, closes):
+		self.reset()
+		for close in closes:
+			if close == close:
+				self._pending = close
+				self.commit()
+
+	def update(self, close):
+		self._pending = close
+
+	def commit(self):
+		if self._pending is None:
+			return
+		self._before = self._state
+		self._state = self._advance(self._state, self._pending)
+		self._values.append(self._macd(self._state))
+		self._pending = None
+
+	def amend(self, close):
+		# replace the most recently committed close
+		self._state = self._advance(self._before, close)
+		self._values[-1] = self._macd(self._state)
+
+	def tail(self):
+		# the last `depth` MACD values, oldest first, like macd(...)[-depth:]
+		values = list(self._values)
+		if self._pending is not None:
+			values = values[1:]
+			values.append(self._macd(self._advance(self._state, self._pending)))
+		return values
+
+	def _advance(self, state, close):
+		fast, slow, count = state
+		return (
+			ema_step(fast, close, self._alpha_fast),
+			ema_step(slow, close, self._alpha_slow),
+			count + 1
+		)
+
+	def _macd(self, state):
+		fast, slow, count = state
+		if count < self.n_fast or count < self.n_slow:
+			return math.nan
+		return fast - slow
+
+
+class IndicatorState:
+	# Per-symbol MACDs keyed by minute. Second bars update() the forming minute,
+	# minute bars commit() it. Both return False when the minute is older than
+	# anything the state can revise, in which case the caller reloads history.
+
+	def __init__(self, windows=MACD_WINDOWS):
+		self.macd = {window: StreamingMACD(*window) for window in windows}
+		self.last_minute = None
+		self.pending_minute = None
+
+	def load(self, minutes, closes):
+		closes = list(closes)
+		for m in self.macd.values():
+			m.load(closes)
+		minutes = list(minutes)
+		self.last_minute = minutes[-1] if len(minutes) else None
+		self.pending_minute = None
+
+	def update(self, minute, close):
+		self._roll(minute)
+		if not self._is_open(minute):
+			return self._amend(minute, close)
+		self.pending_minute = minute
+		for m in self.macd.values():
+			m.update(close)
+		return True
+
+	def commit(self, minute, close):
+		self._roll(minute)
+		if self._is_open(minute):
+			for m in self.macd.values():
+				m.update(close)
+				m.commit()
+			self.last_minute = minute
+			self.pending_minute = None
+			return True
+		return self._amend(minute, close)
+
+	def _roll(self, minute):
+		# a new minute started before the previous one got its minute bar
+		if self.pending_minute is not None and minute > self.pending_minute:
+			for m in self.macd.values():
+				m.commit()
+			self.last_minute = self.pending_minute
+			self.pending_minute = None
+
+	def _is_open(self, minute):
+		# whether `minute` is the forming minute or a new one after it
+		if self.pending_minute is not None:
+			return minute == self.pending_minute
+		return self.last_minute is None or minute > self.last_minute
+
+	def _amend(self, minute, close):
+		if minute != self.last_minute:
+			return False
+		for m in self.macd.values():
+			m.amend(close)
+		return True
+
+
+# Vectorized versions for many series at once: each row of the input is one
+# series (a symbol), columns are minutes, NaN marks a missing bar.
+
+def macd_2d(closes, n_fast=12, n_slow=26):
+	# ta.trend.macd of every row, skipping NaNs the way .dropna() would; a
+	# missing minute carries the previous value forward
+	frame = pd.DataFrame(np.asarray(closes, dtype=float).T)
+	fast = frame.ewm(span=n_fast, min_periods=n_fast, adjust=False, ignore_na=True).mean()
+	slow = frame.ewm(span=n_slow, min_periods=n_slow, adjust=False, ignore_na=True).mean()
+	return (fast - slow).values.T
+
+
+def valley_lows(lows, lookback=100):
+	# For every column, the low of the most recent valley (a low with a lower
+	# or equal bar before it and a higher bar after it) that find_stop would
+	# see in the `lookback` bars ending there; NaN where there is none.
+	lows = np.asarray(lows, dtype=float)
+	n = lows.shape[1]
+	diff = np.diff(lows, axis=1)
+	valley = np.zeros(lows.shape, dtype=bool)
+	valley[:, 1:-1] = (diff[:, :-1] <= 0) & (diff[:, 1:] > 0)
+	last = np.maximum.accumulate(np.where(valley, np.arange(n), -1), axis=1)
+	# a valley needs the bar after it, so column t sees valleys up to t - 1
+	seen = np.full(lows.shape, -1)
+	seen[:, 1:] = last[:, :-1]
+	found = seen >= np.arange(n) - lookback + 2
+	price = np.take_along_axis(lows, np.maximum(seen, 0), axis=1)
+	return np.where(found & (seen >= 0), price, np.nan)
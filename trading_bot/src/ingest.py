@@ -0,0 +1,394 @@
+import csv
+import sys
+import time
+from datetime import datetime, timedelta
+
+import pandas as pd
+from sqlalchemy import create_engine
+
+from fetcher import fetch_all, print_progress
+from throttle import TokenBucket
+
+
+# Bulk load of daily bars into the stocks table. Symbols are fetched
+# concurrently through one REST client, and rows are written as they arrive
+# in large multi-row upserts over a single pooled engine. A re-run over the
+# same days overwrites rows instead of duplicating them, which needs a
+# unique key on (symbol, timestamp). Before its first write to MySQL the
+# writer checks for one and adds it if it's missing, as on a table created
+# by to_sql:
+#
+#   ALTER TABLE stocks ADD UNIQUE KEY symbol_timestamp (symbol, timestamp);
+#
+# and refuses to write if that fails, e.g. because the table already holds
+# duplicates. SQLite tables are created with the key, so a local file can
+# stand in for MySQL when trying out or benchmarking a run.
+#
+# backfill() keeps a watermark per symbol and timeframe, the last day whose
+# bars are stored, and only asks for what comes after it. It works through
+# the missing range in chunks of symbols and days, advancing watermarks after
+# each chunk is written, so a crashed run picks up where it stopped and a
+# finished one costs a single watermark query.
+
+DAILY_COLUMNS = ('timestamp', 'symbol', 'open', 'high', 'low', 'close', 'volume')
+DAILY_KEYS = ('symbol', 'timestamp')
+WATERMARK_COLUMNS = ('symbol', 'timeframe', 'last_timestamp')
+WATERMARK_KEYS = ('symbol', 'timeframe')
+# Daily history requests per second
+daily_rate = 10
+# prefix length for text columns in a MySQL key, which needs one
+KEY_PREFIX = 32
+
+
+def placeholder(dialect):
+	return '?' if dialect == 'sqlite' else '%s'
+
+
+def upsert_sql(table, columns, keys, rows, dialect):
+	values = ', '.join(['( {} )'.format(', '.join([placeholder(dialect)] * len(columns)))] * rows)
+	if dialect == 'sqlite':
+		return 'INSERT OR REPLACE INTO {} ( {} ) VALUES {}'.format(table, ', '.join(columns), values)
+	updates = ', '.join('{0} = VALUES({0})'.format(column) for column in columns if column not in keys)
+	return 'INSERT INTO {} ( {} ) VALUES {} ON DUPLICATE KEY UPDATE {}'.format(
+		table, ', '.join(columns), values, updates
+	)
+
+
+def frame_rows(symbol, df):
+	# Polygon daily bars to stocks rows; bars are stamped midnight New York
+	return bar_rows(symbol, df.index.date, df)
+
+
+def minute_frame_rows(symbol, df):
+	# minute_stocks keeps naive New York times
+	return bar_rows(symbol, df.index.tz_localize(None).to_pydatetime(), df)
+
+
+def bar_rows(symbol, timestamps, df):
+	return list(zip(
+		timestamps, [symbol] * len(df),
+		df['open'].values.tolist(), df['high'].values.tolist(), df['low'].values.tolist(),
+		df['close'].values.tolist(), df['volume'].values.tolist()
+	))
+
+
+def missing_table(error):
+	# MySQL's 1146 "Table doesn't exist", or sqlite's "no such table"
+	args = getattr(error, 'args', ())
+	return (bool(args) and args[0] == 1146) or 'no such table' in str(error)
+
+
+class UpsertWriter:
+	# Buffers rows and writes them batch_size at a time in multi-row upserts
+
+	def __init__(self, engine, table='stocks', columns=DAILY_COLUMNS, keys=DAILY_KEYS, batch_size=5000):
+		self.engine = engine
+		self.table = table
+		self.columns = columns
+		self.keys = keys
+		self.batch_size = batch_size
+		self.dialect = engine.dialect.name
+		self.written = 0
+		self.batches = 0
+		self._rows = []
+		self._keyed = False
+		if self.dialect == 'sqlite':
+			self._create_sqlite_table()
+			self._keyed = True
+
+	def write(self, rows):
+		self._rows.extend(rows)
+		while len(self._rows) >= self.batch_size:
+			self._flush(self._rows[:self.batch_size])
+			self._rows = self._rows[self.batch_size:]
+
+	def flush(self):
+		if self._rows:
+			self._flush(self._rows)
+			self._rows = []
+
+	def close(self):
+		self.flush()
+
+	def _flush(self, rows):
+		# sqlite caps bound parameters per statement
+		step = max(1, 999 // len(self.columns)) if self.dialect == 'sqlite' else len(rows)
+		conn = self.engine.raw_connection()
+		try:
+			if not self._keyed:
+				self._ensure_unique_key(conn)
+				self._keyed = True
+			cur = conn.cursor()
+			for i in range(0, len(rows), step):
+				chunk = rows[i:i + step]
+				cur.execute(
+					upsert_sql(self.table, self.columns, self.keys, len(chunk), self.dialect),
+					[value for row in chunk for value in row]
+				)
+			conn.commit()
+		finally:
+			conn.close()
+		self.written += len(rows)
+		self.batches += 1
+
+	def _ensure_unique_key(self, conn):
+		# Without a unique key on exactly self.keys, ON DUPLICATE KEY UPDATE
+		# inserts every row again instead of updating it
+		cur = conn.cursor()
+		cur.execute(
+			'SELECT index_name, column_name FROM information_schema.statistics '
+			'WHERE table_schema = DATABASE() AND table_name = %s AND non_unique = 0',
+			[self.table]
+		)
+		indexes = {}
+		for index, column in cur.fetchall():
+			indexes.setdefault(index, set()).add(column)
+		if set(self.keys) in indexes.values():
+			return
+		cur.execute(
+			'SELECT column_name, data_type FROM information_schema.columns '
+			'WHERE table_schema = DATABASE() AND table_name = %s',
+			[self.table]
+		)
+		types = dict(cur.fetchall())
+		columns = []
+		for key in self.keys:
+			kind = types.get(key, '').lower()
+			columns.append('{}({})'.format(key, KEY_PREFIX) if 'text' in kind or 'blob' in kind else key)
+		sql = 'ALTER TABLE {} ADD UNIQUE KEY {} ( {} )'.format(self.table, '_'.join(self.keys), ', '.join(columns))
+		print('Adding the unique key upserts into {} need: {}'.format(self.table, sql))
+		try:
+			cur.execute(sql)
+			conn.commit()
+		except Exception as e:
+			raise RuntimeError(
+				'{} has no unique key on ({}) and adding one failed, so writing to it would duplicate rows. '
+				'Remove any duplicates and run: {}'.format(self.table, ', '.join(self.keys), sql)
+			) from e
+
+	def _create_sqlite_table(self):
+		conn = self.engine.raw_connection()
+		try:
+			conn.execute('CREATE TABLE IF NOT EXISTS {} ( {} )'.format(self.table, ', '.join(self.columns)))
+			conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS {0}_{1} ON {0} ( {2} )'.format(
+				self.table, '_'.join(self.keys), ', '.join(self.keys)
+			))
+			conn.commit()
+		finally:
+			conn.close()
+
+
+class CsvSink:
+	# Rows to a CSV file, for exports or runs without a database
+
+	def __init__(self, path, columns=DAILY_COLUMNS):
+		self.file = open(path, 'w', newline='')
+		self.writer = csv.writer(self.file)
+		self.writer.writerow(columns)
+		self.written = 0
+
+	def write(self, rows):
+		self.writer.writerows(rows)
+		self.written += len(rows)
+
+	def close(self):
+		self.file.close()
+
+
+class Watermarks:
+	# Last stored day per (symbol, timeframe), in a table next to the bars
+
+	def __init__(self, engine, table='watermarks'):
+		self.engine = engine
+		self.table = table
+		self.dialect = engine.dialect.name
+		self._writer = None
+
+	def load(self, timeframe):
+		# {symbol: date}; one query, creating the table the first time
+		conn = self.engine.raw_connection()
+		try:
+			cur = conn.cursor()
+			try:
+				cur.execute(
+					'SELECT symbol, last_timestamp FROM {} WHERE timeframe = {}'.format(
+						self.table, placeholder(self.dialect)
+					),
+					[timeframe]
+				)
+			except Exception as e:
+				# anything but a missing table (a dropped connection, a lock
+				# timeout) must not look like "nothing stored yet"
+				if not missing_table(e):
+					raise
+				conn.rollback()
+				self._create(conn)
+				return {}
+			return {symbol: pd.Timestamp(last).date() for symbol, last in cur.fetchall()}
+		finally:
+			conn.close()
+
+	def advance(self, timeframe, marks):
+		if not marks:
+			return
+		if self._writer is None:
+			self._writer = UpsertWriter(self.engine, self.table, WATERMARK_COLUMNS, WATERMARK_KEYS)
+		self._writer.write([(symbol, timeframe, day.strftime('%Y-%m-%d')) for symbol, day in marks.items()])
+		self._writer.flush()
+
+	def _create(self, conn):
+		conn.cursor().execute(
+			'CREATE TABLE IF NOT EXISTS {} ( symbol VARCHAR(16) NOT NULL, timeframe VARCHAR(8) NOT NULL, '
+			'last_timestamp VARCHAR(10) NOT NULL, PRIMARY KEY (symbol, timeframe) )'.format(self.table)
+		)
+		conn.commit()
+
+
+class IngestSummary:
+
+	def __init__(self, symbols, rows, failures, elapsed):
+		self.symbols = symbols
+		self.rows = rows
+		self.failures = failures
+		self.elapsed = elapsed
+
+	def report(self):
+		lines = ['{} of {} symbols, {} rows in {:.1f}s ({:.1f} symbols/s, {:.0f} rows/s)'.format(
+			self.symbols - len(self.failures), self.symbols, self.rows, self.elapsed,
+			self.symbols / self.elapsed if self.elapsed else 0, self.rows / self.elapsed if self.elapsed else 0
+		)]
+		for symbol, e in sorted(self.failures.items()):
+			lines.append('  failed {}: {}'.format(symbol, e))
+		return '\n'.join(lines)
+
+
+def ingest_daily(symbols, start, end, engine, api=None, workers=8, rate=daily_rate, batch_size=5000,
+                 retries=3, progress=None):
+	# start and end are dates or 'YYYY-MM-DD' strings, both inclusive
+	if api is None:
+		from stock_data import get_alpaca_api
+		api = get_alpaca_api()
+	start = start if isinstance(start, str) else start.strftime('%Y-%m-%d')
+	end = end if isinstance(end, str) else end.strftime('%Y-%m-%d')
+	writer = UpsertWriter(engine, batch_size=batch_size)
+	counts = {'rows': 0}
+
+	def store(symbol, df):
+		rows = frame_rows(symbol, df)
+		writer.write(rows)
+		counts['rows'] += len(rows)
+
+	begin = time.perf_counter()
+	symbols = list(symbols)
+	_, failures = fetch_all(
+		symbols,
+		lambda symbol: api.polygon.historic_agg_v2(symbol, 1, 'day', _from=start, to=end).df,
+		workers=workers,
+		bucket=TokenBucket(rate),
+		retries=retries,
+		progress=progress,
+		on_result=store
+	)
+	writer.close()
+	return IngestSummary(len(symbols), counts['rows'], failures, time.perf_counter() - begin)
+
+
+# timeframe: (table, rows from a Polygon frame, default days per request)
+TIMEFRAMES = {
+	'day': ('stocks', frame_rows, 365),
+	'minute': ('minute_stocks', minute_frame_rows, 5),
+}
+
+
+def as_date(day):
+	return pd.Timestamp(day).date()
+
+
+def backfill(symbols, start, end, engine, timeframe='day', api=None, chunk_days=None, chunk_symbols=500,
+             workers=8, rate=daily_rate, batch_size=5000, retries=3, progress=None):
+	# Store bars from start to end (inclusive) that aren't stored yet. Each
+	# chunk is at most chunk_symbols symbols by chunk_days days; watermarks
+	# move only once a chunk's rows are written. end should be a finished
+	# session, since a watermarked day is never fetched again. progress, if
+	# given, is called as progress(done, total) with the requests of the
+	# whole backfill.
+	if api is None:
+		from stock_data import get_alpaca_api
+		api = get_alpaca_api()
+	table, to_rows, default_days = TIMEFRAMES[timeframe]
+	chunk_days = chunk_days or default_days
+	start = as_date(start)
+	end = as_date(end)
+	watermarks = Watermarks(engine)
+	marks = watermarks.load(timeframe)
+	pending = {}
+	for symbol in symbols:
+		first = start if symbol not in marks else max(start, marks[symbol] + timedelta(days=1))
+		if first <= end:
+			pending[symbol] = first
+	begin = time.perf_counter()
+	symbols = list(symbols)
+	if not pending:
+		return IngestSummary(len(symbols), 0, {}, time.perf_counter() - begin)
+
+	writer = UpsertWriter(engine, table=table, batch_size=batch_size)
+	bucket = TokenBucket(rate)
+	counts = {'rows': 0}
+	failures = {}
+
+	def windows_from(first):
+		# requests left for a symbol whose next window starts at first
+		return -(-((end - first).days + 1) // chunk_days) if first <= end else 0
+
+	# requests so far and in all; a failed symbol's later windows are
+	# taken off the total, since they won't be fetched
+	requests = {'done': 0, 'total': sum(windows_from(first) for first in pending.values())}
+
+	def chunk_progress(done, total):
+		progress(requests['done'] + done, requests['total'])
+
+	def store(symbol, df):
+		rows = to_rows(symbol, df)
+		writer.write(rows)
+		counts['rows'] += len(rows)
+
+	def fetch(symbol):
+		first, last = windows[symbol]
+		return api.polygon.historic_agg_v2(
+			symbol, 1, timeframe, _from=first.strftime('%Y-%m-%d'), to=last.strftime('%Y-%m-%d')
+		).df
+
+	while pending:
+		# the next window of every symbol still behind
+		windows = {
+			symbol: (first, min(end, first + timedelta(days=chunk_days - 1)))
+			for symbol, first in pending.items()
+		}
+		batch = sorted(windows)
+		for i in range(0, len(batch), chunk_symbols):
+			chunk = batch[i:i + chunk_symbols]
+			_, failed = fetch_all(
+				chunk, fetch, workers=workers, bucket=bucket, retries=retries,
+				progress=chunk_progress if progress is not None else None, on_result=store
+			)
+			writer.flush()
+			watermarks.advance(timeframe, {symbol: windows[symbol][1] for symbol in chunk if symbol not in failed})
+			failures.update(failed)
+			requests['done'] += len(chunk)
+			requests['total'] -= sum(windows_from(windows[symbol][1] + timedelta(days=1)) for symbol in failed)
+		pending = {
+			symbol: last + timedelta(days=1)
+			for symbol, (first, last) in windows.items()
+			if symbol not in failures and last < end
+		}
+	return IngestSummary(len(symbols), counts['rows'], failures, time.perf_counter() - begin)
+
+
+if __name__ == '__main__':
+	# python ingest.py day|minute 2019-01-01 [2020-01-01] [sqlite:///stocks.db]
+	from stock_data import get_db_connection, get_tradable_symbols
+	timeframe, start = sys.argv[1:3]
+	end = sys.argv[3] if len(sys.argv) > 3 else (datetime.today() - timedelta(days=1)).strftime('%Y-%m-%d')
+	engine = create_engine(sys.argv[4]) if len(sys.argv) > 4 else get_db_connection()
+	summary = backfill(get_tradable_symbols(), start, end, engine, timeframe, progress=print_progress(timeframe))
+	print(summary.report())
@@ -0,0 +1,150 @@
+import json
+import os
+import time
+
+from bar_cache import DEFAULT_ROOT
+
+
+# An append-only record of the strategy's order state, so a restart picks
+# up exactly where the crash left off: open orders, fills, and the valley
+# stops and targets the entries were made with. Every order intent (written
+# before the order goes out), broker acknowledgement, rejection and trade
+# update appends one JSON line holding the event and the symbol's state
+# after it, as StrategyEngine.symbol_state gives it. The newest line for a
+# symbol is all a restart needs, so every so often the latest states are
+# written to a snapshot and the log starts over.
+#
+#   <root>/journal/2020-01-02.jsonl           events since the last snapshot
+#   <root>/journal/2020-01-02.snapshot.json   {symbol: state} as of then
+#
+# Lines are flushed as they're written, so a crash of the bot loses none;
+# a crash mid-line leaves a partial last line, which load() skips.
+
+JOURNAL_ROOT = os.path.join(DEFAULT_ROOT, 'journal')
+
+# broker order statuses and the trade update event each stands for
+BROKER_EVENTS = {
+	'partially_filled': 'partial_fill',
+	'filled': 'fill',
+	'canceled': 'canceled',
+	'expired': 'canceled',
+	'rejected': 'rejected',
+}
+OPEN_STATUSES = ('new', 'accepted', 'pending_new', 'partially_filled', 'accepted_for_bidding')
+
+
+class Journal:
+
+	def __init__(self, day, root=JOURNAL_ROOT, compact_every=500):
+		# day: the session's date, e.g. '2020-01-02'; one journal per session
+		self.root = root
+		self.path = os.path.join(root, '{}.jsonl'.format(day))
+		self.snapshot_path = os.path.join(root, '{}.snapshot.json'.format(day))
+		self.compact_every = compact_every
+		# symbol: its newest state
+		self.states = {}
+		self.appended = 0
+		self.file = None
+
+	def load(self):
+		# {symbol: state} from the snapshot and the events after it
+		states = {}
+		try:
+			with open(self.snapshot_path) as f:
+				states.update(json.load(f)['states'])
+		except (OSError, ValueError):
+			pass
+		try:
+			with open(self.path) as f:
+				for line in f:
+					try:
+						event = json.loads(line)
+					except ValueError:
+						# cut short by a crash
+						continue
+					states[event['symbol']] = event['state']
+		except OSError:
+			pass
+		self.states = states
+		return dict(states)
+
+	def record(self, ev, symbol, state, **details):
+		if self.file is None:
+			os.makedirs(self.root, exist_ok=True)
+			self.file = open(self.path, 'a')
+		self.states[symbol] = state
+		self.file.write(json.dumps(dict(details, ev=ev, symbol=symbol, state=state, at=time.time())) + '\n')
+		self.file.flush()
+		self.appended += 1
+		if self.appended >= self.compact_every:
+			self.compact()
+
+	def compact(self):
+		# Write the latest states to the snapshot, then empty the log. A crash
+		# in between leaves log lines that are already in the snapshot, which
+		# load() replays to the same states.
+		os.makedirs(self.root, exist_ok=True)
+		tmp = '{}.{}.tmp'.format(self.snapshot_path, os.getpid())
+		with open(tmp, 'w') as f:
+			json.dump({'at': time.time(), 'states': self.states}, f)
+		os.replace(tmp, self.snapshot_path)
+		if self.file is not None:
+			self.file.close()
+		self.file = open(self.path, 'w')
+		self.appended = 0
+
+	def close(self):
+		if self.file is not None:
+			self.compact()
+			self.file.close()
+			self.file = None
+
+
+def active(state):
+	# whether a state still holds anything to restore
+	return state['position'] != 0 or state['order'] is not None
+
+
+def reconcile(engine, states, orders, history_for=None):
+	# Restore journal states into engine and bring them up to date with
+	# orders, the broker's orders since the session opened as returned by a
+	# single list_orders call: fills and cancels that happened while the bot
+	# was down are applied as the trade updates would have been. Symbols
+	# not being watched are watched, with history_for(symbol) as their
+	# history if given. Returns the restored symbols and the ids of open
+	# orders on watched symbols the journal doesn't know, to cancel.
+	by_id = {order.id: order for order in orders}
+	by_client_id = {getattr(order, 'client_order_id', None): order for order in orders}
+	known = set()
+	restored = []
+	for symbol, state in sorted(states.items()):
+		if not active(state):
+			continue
+		if symbol not in engine.symbols:
+			engine.watch(symbol, history_for(symbol) if history_for is not None else None)
+		engine.restore_symbol_state(symbol, state)
+		restored.append(symbol)
+		if state['order'] is None:
+			continue
+		order_id = state['order'][0]
+		if order_id is not None:
+			order = by_id.get(order_id)
+		else:
+			# written ahead of the submit; it may or may not have reached the broker
+			order = by_client_id.get(state.get('client_order_id'))
+			if order is None:
+				engine.on_order_rejected(symbol)
+				continue
+			engine.on_order_submitted(symbol, order)
+		if order is None:
+			# older than the listing; the engine cancels it once stale
+			continue
+		known.add(order.id)
+		event = BROKER_EVENTS.get(order.status)
+		if event is not None:
+			engine.on_trade_update(event, order._raw)
+	cancel = [
+		order.id for order in orders
+		if order.id not in known and order.status in OPEN_STATUSES and order.symbol in engine.symbols
+	]
+	return restored, cancel
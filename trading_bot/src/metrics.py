@@ -0,0 +1,178 @@
+import asyncio
+import bisect
+import json
+import logging
+import os
+import time
+
+from bar_cache import DEFAULT_ROOT
+
+
+# How far behind the market the bot is running. Handlers time themselves
+# into fixed-bucket histograms, a reporter samples event loop lag and queue
+# depths, and every few seconds the whole snapshot is logged as one JSON
+# line and written to a file that the trading_bot app's metrics view serves.
+#
+# Latencies are in seconds:
+#   handler.<channel>   time spent handling one event of the channel
+#   bar_age.<channel>   handler entry minus the bar's end, i.e. how stale the
+#                       bar was when we got to it
+#   order.tick          handler entry to the broker accepting the order
+#   order.bar           bar end to the broker accepting the order
+#   loop_lag            how late the loop woke a sleeping task
+
+METRICS_PATH = os.path.join(DEFAULT_ROOT, 'metrics.json')
+# bucket upper bounds: 1us to ~100s, four per decade
+BOUNDS = [10 ** (e / 4) for e in range(-24, 9)]
+
+logger = logging.getLogger('trading_bot.metrics')
+
+
+class Histogram:
+
+	def __init__(self, bounds=BOUNDS):
+		self.bounds = bounds
+		# the last bucket counts everything above the last bound
+		self.counts = [0] * (len(bounds) + 1)
+		self.count = 0
+		self.total = 0.
+		self.max = 0.
+
+	def observe(self, value):
+		self.counts[bisect.bisect_left(self.bounds, value)] += 1
+		self.count += 1
+		self.total += value
+		if value > self.max:
+			self.max = value
+
+	def merge(self, other):
+		# fold in another histogram with the same bounds
+		for i, n in enumerate(other.counts):
+			self.counts[i] += n
+		self.count += other.count
+		self.total += other.total
+		if other.max > self.max:
+			self.max = other.max
+
+	def percentile(self, q):
+		# upper bound of the bucket holding the q-th percentile
+		if not self.count:
+			return None
+		rank = q / 100 * self.count
+		seen = 0
+		for i, n in enumerate(self.counts):
+			seen += n
+			if seen >= rank and n:
+				return self.bounds[i] if i < len(self.bounds) else self.max
+		return self.max
+
+	def summary(self):
+		return {
+			'count': self.count,
+			'mean': self.total / self.count if self.count else None,
+			'p50': self.percentile(50),
+			'p99': self.percentile(99),
+			'max': self.max,
+			'buckets': {'{:.6g}'.format(bound): n for bound, n in zip(self.bounds + [float('inf')], self.counts) if n},
+		}
+
+
+class Metrics:
+
+	def __init__(self):
+		self.histograms = {}
+		self.gauges = {}
+		# name: callable sampled by the reporter, e.g. a writer's depth
+		self.probes = {}
+		self.started_at = time.time()
+
+	def observe(self, name, seconds):
+		histogram = self.histograms.get(name)
+		if histogram is None:
+			histogram = self.histograms[name] = Histogram()
+		histogram.observe(seconds)
+
+	def merge(self, histograms):
+		# fold in histograms observed elsewhere, e.g. by a shard worker
+		for name, other in histograms.items():
+			histogram = self.histograms.get(name)
+			if histogram is None:
+				histogram = self.histograms[name] = Histogram(other.bounds)
+			histogram.merge(other)
+
+	def gauge(self, name, value):
+		self.gauges[name] = value
+
+	def probe(self, name, fn):
+		self.probes[name] = fn
+
+	def on_event(self, channel, bar_end, entry, handled):
+		# bar_end and entry are epoch seconds, handled is the perf_counter()
+		# seconds the handler took; bar_end is None for trade updates
+		self.observe('handler.' + channel, handled)
+		if bar_end is not None:
+			self.observe('bar_age.' + channel, entry - bar_end)
+
+	def on_order(self, symbol, side, bar_end, entry, submitted):
+		self.observe('order.tick', submitted - entry)
+		self.observe('order.bar', submitted - bar_end)
+		logger.info(json.dumps({
+			'event': 'order', 'symbol': symbol, 'side': side, 'bar_end': bar_end, 'handler_entry': entry,
+			'submitted': submitted, 'tick_to_submit': submitted - entry, 'bar_to_submit': submitted - bar_end,
+		}))
+
+	def sample(self):
+		for name, fn in self.probes.items():
+			try:
+				self.gauges[name] = fn()
+			except Exception as e:
+				self.gauges[name] = repr(e)
+
+	def snapshot(self):
+		return {
+			'at': time.time(),
+			'uptime': time.time() - self.started_at,
+			'gauges': dict(self.gauges),
+			'histograms': {name: histogram.summary() for name, histogram in sorted(self.histograms.items())},
+		}
+
+
+def write_snapshot(snapshot, path=METRICS_PATH):
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+	tmp = '{}.{}.tmp'.format(path, os.getpid())
+	with open(tmp, 'w') as f:
+		json.dump(snapshot, f)
+	os.replace(tmp, path)
+
+
+def read_snapshot(path=METRICS_PATH):
+	# the last snapshot written, or None if there isn't one
+	try:
+		with open(path) as f:
+			return json.load(f)
+	except (OSError, ValueError):
+		return None
+
+
+async def report(metrics, interval=5.0, tick=0.1, path=METRICS_PATH, publish=None):
+	# Run on the bot's loop: measures loop lag as how late a `tick` second
+	# sleep wakes, and every `interval` seconds samples the probes, logs the
+	# snapshot and writes it to path. Given publish, hands metrics to
+	# publish(metrics) instead, e.g. to pass a shard worker's on.
+	loop = asyncio.get_event_loop()
+	next_report = loop.time() + interval
+	while True:
+		start = loop.time()
+		await asyncio.sleep(tick)
+		now = loop.time()
+		metrics.observe('loop_lag', max(0., now - start - tick))
+		if now >= next_report:
+			next_report = now + interval
+			metrics.sample()
+			if publish is not None:
+				publish(metrics)
+				continue
+			snapshot = metrics.snapshot()
+			logger.info(json.dumps(dict(snapshot, event='metrics'), default=str))
+			if path is not None:
+				write_snapshot(snapshot, path)
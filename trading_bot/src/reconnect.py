@@ -0,0 +1,202 @@
+import asyncio
+import functools
+import time
+
+import numpy as np
+import pandas as pd
+
+from bar_cache import NY
+from bar_store import EPOCH, ONE_MINUTE
+from engine import Bar
+from fetcher import fetch_all
+from throttle import TokenBucket
+
+
+# Keeps the stream connected for the whole session. A dropped connection
+# is retried in a flat loop with exponential backoff, and once it is back
+# the minute bars missed while it was down are fetched over REST for the
+# symbols still being watched and merged in, so history has no holes for
+# the indicators or the opening range to trip over.
+
+# statuses the Polygon stream reports before it gives up on a connection
+FAILED_STATUSES = ('disconnected', 'connect failed')
+
+
+class Outage:
+
+	def __init__(self, start, end, bars, symbols):
+		# start is when the last message arrived before the drop, end when the
+		# stream was subscribed again; both epoch seconds
+		self.start = start
+		self.end = end
+		self.bars = bars
+		self.symbols = symbols
+
+	@property
+	def duration(self):
+		return self.end - self.start
+
+	def report(self):
+		return 'Stream was down {:.1f}s; recovered {} minute bars for {} symbols'.format(
+			self.duration, self.bars, self.symbols
+		)
+
+
+class StreamSupervisor:
+
+	def __init__(self, conn, channels, recover=None, base_delay=1.0, max_delay=60.0, stale_after=None,
+	             metrics=None):
+		# channels: callable returning the channels to subscribe, asked again
+		# on every reconnect so retired symbols stay off and movers stay on.
+		# recover: coroutine function (start, end) -> (bars, symbols) run after
+		# a reconnect. stale_after: seconds without a message that count as a
+		# dead connection.
+		self.conn = conn
+		self.channels = channels
+		self.recover = recover
+		self.base_delay = base_delay
+		self.max_delay = max_delay
+		self.stale_after = stale_after
+		self.metrics = metrics
+		self.last_message = None
+		self.outages = []
+		self._failed = None
+		self._down_since = None
+
+	def touch(self):
+		# handlers call this for every message they get
+		self.last_message = time.time()
+
+	def fail(self, reason):
+		# give up on the current connection; run() reconnects
+		if self._failed is None:
+			self._failed = reason
+			self.conn.loop.stop()
+
+	def on_status(self, status):
+		if status in FAILED_STATUSES:
+			self.fail('stream status {}'.format(status))
+
+	def run(self):
+		# returns once the loop is stopped by something other than a failure
+		loop = self.conn.loop
+		loop.set_exception_handler(self._on_loop_error)
+		attempt = 0
+		while True:
+			self._failed = None
+			tasks = []
+			try:
+				loop.run_until_complete(self.conn.subscribe(self.channels()))
+				self.touch()
+				attempt = 0
+				if self._down_since is not None:
+					# backfill while live bars flow again
+					tasks.append(loop.create_task(self._recover()))
+				if self.stale_after:
+					tasks.append(loop.create_task(self._watch()))
+				if self._failed is None:
+					# a failure while subscribing has already stopped the loop,
+					# and run_until_complete swallowed the stop
+					loop.run_forever()
+				if self._failed is None:
+					return
+				print('Stream failed: {}'.format(self._failed))
+			except Exception as e:
+				print(e)
+			finally:
+				for task in tasks:
+					task.cancel()
+			if self._down_since is None:
+				self._down_since = self.last_message or time.time()
+			try:
+				loop.run_until_complete(self.conn.close())
+			except Exception as e:
+				print(e)
+			delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+			attempt += 1
+			print('Reconnecting in {:.0f}s...'.format(delay))
+			time.sleep(delay)
+
+	async def _recover(self):
+		start, end = self._down_since, time.time()
+		self._down_since = None
+		bars = symbols = 0
+		if self.recover is not None:
+			try:
+				bars, symbols = await self.recover(start, end)
+			except Exception as e:
+				print('Backfill failed: {}'.format(e))
+		outage = Outage(start, end, bars, symbols)
+		self.outages.append(outage)
+		print(outage.report())
+		if self.metrics is not None:
+			self.metrics.observe('outage', outage.duration)
+			self.metrics.gauge('outages', len(self.outages))
+			self.metrics.gauge('bars_recovered', sum(o.bars for o in self.outages))
+
+	async def _watch(self):
+		while True:
+			await asyncio.sleep(self.stale_after / 2)
+			if time.time() - self.last_message > self.stale_after:
+				self.fail('no messages for {:.0f}s'.format(time.time() - self.last_message))
+
+	def _on_loop_error(self, loop, context):
+		# An exception escaping a handler or the stream's reader kills the
+		# task consuming the socket, so nothing more would arrive
+		print('Loop error: {}'.format(context.get('exception') or context.get('message')))
+		self.fail(context.get('message'))
+
+
+def missed_minute_bars(api, symbols, first_minute, last_minute, workers=8, rate=10):
+	# {symbol: [Bar, ...]} for epoch minutes first_minute..last_minute,
+	# fetched from Polygon; symbols that fail are left out
+	if last_minute < first_minute:
+		return {}
+	days = [
+		pd.Timestamp(minute * 60, unit='s', tz='UTC').tz_convert(NY).strftime('%Y-%m-%d')
+		for minute in (first_minute, last_minute)
+	]
+
+	def fetch(symbol):
+		df = api.polygon.historic_agg_v2(symbol, 1, 'minute', _from=days[0], to=days[1]).df
+		minutes = np.asarray((df.index - EPOCH) // ONE_MINUTE, dtype=np.int64)
+		keep = (minutes >= first_minute) & (minutes <= last_minute)
+		return [
+			Bar(symbol, o, h, l, c, v, m * 60000)
+			for m, o, h, l, c, v in zip(
+				minutes[keep].tolist(), df['open'].values[keep].tolist(), df['high'].values[keep].tolist(),
+				df['low'].values[keep].tolist(), df['close'].values[keep].tolist(), df['volume'].values[keep].tolist()
+			)
+		]
+
+	bars, failures = fetch_all(symbols, fetch, workers=workers, bucket=TokenBucket(rate), retries=1)
+	for symbol, e in failures.items():
+		print('Failed to backfill {}: {}'.format(symbol, e))
+	return bars
+
+
+def minute_recovery(engine, api, on_bar=None):
+	# A recover coroutine for StreamSupervisor that merges the missed minute
+	# bars of the engine's symbols into it, and passes each to on_bar (e.g.
+	# for the bar writers). The window starts a minute before the last
+	# message, whose minute bar may not have arrived yet; minute bars the
+	# engine already has are replaced, not added again.
+	async def recover(start, end):
+		symbols = sorted(engine.symbols)
+		first = int(start) // 60 - 1
+		# the minute in progress comes from the stream
+		last = int(end) // 60 - 1
+		loop = asyncio.get_event_loop()
+		bars = await loop.run_in_executor(
+			None, functools.partial(missed_minute_bars, api, symbols, first, last)
+		)
+		count = 0
+		for symbol_bars in bars.values():
+			for bar in symbol_bars:
+				engine.on_minute_bar(bar)
+				if on_bar is not None:
+					await on_bar(bar)
+				count += 1
+		return count, sum(1 for symbol_bars in bars.values() if symbol_bars)
+
+	return recover
@@ -0,0 +1,182 @@
+import json
+import sys
+import time
+
+import numpy as np
+
+from engine import Cancel, Liquidate, StaticAccount, StrategyEngine, Submit, to_bar
+from session import SessionClock
+
+
+# Record the live stream to a JSON lines file and play it back through a
+# StrategyEngine as fast as it will go. Each line is one event:
+#
+#   {"ev": "session", "open": "2020-01-02T09:30:00-05:00", "close": ...}
+#   {"ev": "watch", "symbol": "AAPL", "prev_close": 300.35, "volume": 1024}
+#   {"ev": "position", "symbol": "AAPL", "qty": 10, "cost_basis": 3003.5}
+#   {"ev": "A", "symbol": "AAPL", "open": ..., "start": 1577975400000, ...}
+#   {"ev": "AM", ...}
+#   {"ev": "trade_update", "event": "fill", "order": {...}}
+#
+# Bars are the raw fields of the stream's Agg entities, so a replayed bar
+# reaches the engine exactly as the live one did.
+
+CHANNELS = ('A', 'AM', 'trade_update')
+
+
+class EventRecorder:
+
+	def __init__(self, path):
+		self.file = open(path, 'a')
+
+	def record(self, ev, raw):
+		self.file.write(json.dumps(dict(raw, ev=ev), default=str) + '\n')
+
+	def close(self):
+		self.file.close()
+
+
+def read_events(path):
+	with open(path) as f:
+		return [json.loads(line) for line in f if line.strip()]
+
+
+def build_engine(events, account=None, history=None):
+	# An engine set up from the session, watch and position lines of a
+	# recording. history optionally maps symbols to MinuteBars to start from;
+	# otherwise indicators warm up from the replayed bars alone.
+	if account is None:
+		account = StaticAccount(100000.)
+	history = history or {}
+	engine = None
+	for event in events:
+		if event['ev'] == 'session':
+			engine = StrategyEngine(SessionClock.from_datetimes(event['open'], event['close']), account)
+		elif event['ev'] == 'watch':
+			symbol = event['symbol']
+			engine.watch(symbol, history.get(symbol), event['prev_close'], event['volume'])
+		elif event['ev'] == 'position':
+			symbol = event['symbol']
+			engine.add_position(symbol, event['qty'], event['cost_basis'], history.get(symbol))
+	if engine is None:
+		raise ValueError('recording has no session line')
+	return engine
+
+
+class PaperOrder:
+
+	def __init__(self, id, submitted_at):
+		self.id = id
+		self.submitted_at = submitted_at
+
+
+class PaperBroker:
+	# Accepts every order and fills it in full at its limit price as soon as it
+	# is submitted, reporting back through the engine's trade update path
+
+	def __init__(self):
+		self.orders = 0
+		self.cancels = 0
+		self.liquidations = 0
+
+	def execute(self, engine, intents, ts):
+		# ts is the epoch second orders are stamped with
+		for intent in intents:
+			if isinstance(intent, Submit):
+				self.orders += 1
+				order_id = str(self.orders)
+				engine.on_order_submitted(intent.symbol, PaperOrder(order_id, ts))
+				engine.on_trade_update('fill', {
+					'id': order_id,
+					'symbol': intent.symbol,
+					'side': intent.side,
+					'filled_qty': intent.qty,
+					'filled_avg_price': intent.limit_price,
+					'submitted_at': ts,
+				})
+			elif isinstance(intent, Cancel):
+				self.cancels += 1
+				engine.on_trade_update('canceled', {'id': intent.order_id, 'symbol': intent.symbol})
+			elif isinstance(intent, Liquidate):
+				if engine.positions.get(intent.symbol, 0) > 0:
+					self.liquidations += 1
+					engine.positions[intent.symbol] = 0
+
+
+class ReplayStats:
+
+	def __init__(self, latencies, elapsed):
+		# latencies: {channel: array of per-event seconds}
+		self.latencies = latencies
+		self.elapsed = elapsed
+
+	@property
+	def events(self):
+		return sum(len(values) for values in self.latencies.values())
+
+	@property
+	def events_per_second(self):
+		return self.events / self.elapsed if self.elapsed else float('inf')
+
+	def percentile(self, q, channel=None):
+		if channel is None:
+			values = np.concatenate([values for values in self.latencies.values()])
+		else:
+			values = self.latencies[channel]
+		return np.percentile(values, q) if len(values) else np.nan
+
+	def report(self):
+		lines = ['{} events in {:.3f}s, {:.0f} events/s'.format(self.events, self.elapsed, self.events_per_second)]
+		for channel, values in self.latencies.items():
+			if len(values):
+				lines.append('  {:12} {:8} events  p50 {:7.1f}us  p99 {:7.1f}us'.format(
+					channel, len(values), self.percentile(50, channel) * 1e6, self.percentile(99, channel) * 1e6
+				))
+		return '\n'.join(lines)
+
+
+class ReplayAdapter:
+	# Drives an engine from recorded events with a paper broker standing in for
+	# Alpaca. Events are decoded up front so only the engine and the broker's
+	# bookkeeping are timed.
+
+	def __init__(self, engine, broker=None):
+		self.engine = engine
+		self.broker = broker or PaperBroker()
+
+	def run(self, events):
+		decoded = []
+		for event in events:
+			ev = event['ev']
+			if ev == 'A' or ev == 'AM':
+				decoded.append((ev, to_bar(event)))
+			elif ev == 'trade_update':
+				decoded.append((ev, event))
+		return self.play(decoded)
+
+	def play(self, decoded):
+		# decoded: (channel, Bar or trade update event) pairs
+		engine = self.engine
+		latencies = {channel: [] for channel in CHANNELS}
+		ts = None
+		start = time.perf_counter()
+		for ev, data in decoded:
+			t0 = time.perf_counter()
+			if ev == 'A':
+				ts = data.start // 1000
+				self.broker.execute(engine, engine.on_second_bar(data), ts)
+			elif ev == 'AM':
+				ts = data.start // 1000
+				self.broker.execute(engine, engine.on_minute_bar(data), ts)
+			else:
+				self.broker.execute(engine, engine.on_trade_update(data['event'], data['order']), ts)
+			latencies[ev].append(time.perf_counter() - t0)
+		elapsed = time.perf_counter() - start
+		return ReplayStats({channel: np.array(values) for channel, values in latencies.items()}, elapsed)
+
+
+if __name__ == '__main__':
+	# python replay.py events.jsonl
+	events = read_events(sys.argv[1])
+	stats = ReplayAdapter(build_engine(events)).run(events)
+	print(stats.report())
@@ -0,0 +1,122 @@
+import asyncio
+import itertools
+from collections import deque
+
+import numpy as np
+
+from throttle import TokenBucket
+
+
+# Orders every broker request through one token bucket sized to Alpaca's
+# limit of 200 requests a minute. Requests wait in priority lanes, so under a
+# burst the exits that protect capital go out before new entries. Requests
+# sharing a key while one is still queued or in flight are merged: callers
+# all get the result of the first one.
+
+# Lanes, highest priority first
+LIQUIDATE = 0
+EXIT = 1
+CANCEL = 2
+ENTRY = 3
+READ = 4
+LANES = ('liquidate', 'exit', 'cancel', 'entry', 'read')
+
+ALPACA_RATE = 200 / 60
+
+_STOP = (len(LANES), 0)
+
+
+class RequestScheduler:
+
+	def __init__(self, rate=ALPACA_RATE, capacity=1, concurrency=4, window=1000):
+		self.bucket = TokenBucket(rate, capacity)
+		self.concurrency = concurrency
+		self.sent = 0
+		self.merged = 0
+		self.throttled = 0
+		# seconds from schedule() to dispatch for the last `window` requests
+		self.waits = deque(maxlen=window)
+		self._depth = [0] * len(LANES)
+		self._pending = {}
+		self._seq = itertools.count()
+		self._queue = None
+		self._slots = None
+		self._task = None
+
+	@property
+	def depth(self):
+		return sum(self._depth)
+
+	def start(self):
+		# must be called from the loop the scheduler will run on
+		if self._task is None:
+			self._queue = asyncio.PriorityQueue()
+			self._slots = asyncio.Semaphore(self.concurrency)
+			self._task = asyncio.ensure_future(self._run())
+
+	def schedule(self, lane, fn, *args, key=None, **kwargs):
+		# Queue `await fn(*args, **kwargs)` and return a future for its result
+		self.start()
+		if key is not None and key in self._pending:
+			self.merged += 1
+			return self._pending[key]
+		loop = asyncio.get_event_loop()
+		future = loop.create_future()
+		if key is not None:
+			self._pending[key] = future
+			future.add_done_callback(lambda _: self._pending.pop(key, None))
+		self._depth[lane] += 1
+		self._queue.put_nowait((lane, next(self._seq), loop.time(), fn, args, kwargs, future))
+		return future
+
+	async def close(self):
+		if self._task is None:
+			return
+		self._queue.put_nowait(_STOP)
+		await self._task
+		self._task = None
+
+	def metrics(self):
+		waits = np.array(self.waits)
+		return {
+			'depth': self.depth,
+			'lanes': dict(zip(LANES, self._depth)),
+			'sent': self.sent,
+			'merged': self.merged,
+			'throttled': self.throttled,
+			'wait_p50': np.percentile(waits, 50) if len(waits) else 0.,
+			'wait_p99': np.percentile(waits, 99) if len(waits) else 0.,
+			'wait_max': waits.max() if len(waits) else 0.,
+		}
+
+	async def _run(self):
+		loop = asyncio.get_event_loop()
+		while True:
+			item = await self._queue.get()
+			if item is _STOP:
+				break
+			delay = self.bucket.reserve()
+			if delay > 0:
+				self.throttled += 1
+				await asyncio.sleep(delay)
+				# something more urgent may have arrived while we waited
+				self._queue.put_nowait(item)
+				item = self._queue.get_nowait()
+			await self._slots.acquire()
+			lane, _, queued_at, fn, args, kwargs, future = item
+			self._depth[lane] -= 1
+			self.waits.append(loop.time() - queued_at)
+			self.sent += 1
+			asyncio.ensure_future(self._dispatch(fn, args, kwargs, future))
+
+	async def _dispatch(self, fn, args, kwargs, future):
+		try:
+			result = await fn(*args, **kwargs)
+		except Exception as e:
+			if not future.done():
+				future.set_exception(e)
+		else:
+			if not future.done():
+				future.set_result(result)
+		finally:
+			self._slots.release()
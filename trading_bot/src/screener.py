@@ -0,0 +1,94 @@
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from bar_cache import DEFAULT_ROOT
+
+
+# Picks the day's candidates out of Polygon's snapshot of every US ticker.
+# The snapshot is read once into columns and the price, dollar-volume and
+# change filters run as array masks. The tradable asset list changes rarely,
+# so it is kept on disk and refetched once a day.
+
+SNAPSHOT_PATH = '/snapshot/locale/us/markets/stocks/tickers'
+SNAPSHOT_COLUMNS = ['symbol', 'price', 'prev_close', 'prev_volume', 'volume', 'change_pct']
+ASSET_PATH = os.path.join(DEFAULT_ROOT, 'assets.json')
+ASSET_TTL = 24 * 60 * 60
+
+
+def tradable_symbols(api, path=ASSET_PATH, ttl=ASSET_TTL):
+	try:
+		with open(path) as f:
+			cached = json.load(f)
+		if time.time() - cached['fetched_at'] < ttl:
+			return cached['symbols']
+	except (OSError, ValueError, KeyError):
+		pass
+	symbols = sorted(asset.symbol for asset in api.list_assets() if asset.tradable)
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+	tmp = '{}.{}.tmp'.format(path, os.getpid())
+	with open(tmp, 'w') as f:
+		json.dump({'fetched_at': time.time(), 'symbols': symbols}, f)
+	os.replace(tmp, path)
+	return symbols
+
+
+def snapshot_frame(tickers):
+	# raw snapshot tickers to one row per symbol
+	n = len(tickers)
+	empty = {}
+
+	def column(section, key):
+		return np.fromiter((t.get(section, empty).get(key, np.nan) for t in tickers), float, n)
+
+	return pd.DataFrame({
+		'symbol': [t['ticker'] for t in tickers],
+		'price': column('lastTrade', 'p'),
+		'prev_close': column('prevDay', 'c'),
+		'prev_volume': column('prevDay', 'v'),
+		'volume': column('day', 'v'),
+		'change_pct': np.fromiter((t.get('todaysChangePerc', np.nan) for t in tickers), float, n),
+	}, columns=SNAPSHOT_COLUMNS)
+
+
+class Screener:
+
+	def __init__(self, api, min_price=5.0, max_price=50, min_dollar_volume=1000000, min_change=3.5,
+	             asset_path=ASSET_PATH, asset_ttl=ASSET_TTL):
+		self.api = api
+		self.min_price = min_price
+		self.max_price = max_price
+		self.min_dollar_volume = min_dollar_volume
+		self.min_change = min_change
+		self.asset_path = asset_path
+		self.asset_ttl = asset_ttl
+
+	def tradable(self):
+		return tradable_symbols(self.api, self.asset_path, self.asset_ttl)
+
+	def snapshot(self):
+		return snapshot_frame(self.api.polygon.get(SNAPSHOT_PATH, version='v2')['tickers'])
+
+	def screen(self, frame=None):
+		if frame is None:
+			frame = self.snapshot()
+		price = frame['price'].values
+		# NaNs compare False, so tickers missing a field drop out
+		with np.errstate(invalid='ignore'):
+			mask = (
+				frame['symbol'].isin(self.tradable()).values &
+				(price >= self.min_price) &
+				(price <= self.max_price) &
+				(frame['prev_volume'].values * price > self.min_dollar_volume) &
+				(frame['change_pct'].values >= self.min_change)
+			)
+		return frame[mask].reset_index(drop=True)
+
+	def rescreen(self, watched, frame=None):
+		# candidates that weren't in an earlier screen, for adding to a
+		# session that is already running
+		screened = self.screen(frame)
+		return screened[~screened['symbol'].isin(list(watched)).values].reset_index(drop=True)
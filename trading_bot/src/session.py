@@ -0,0 +1,228 @@
+import asyncio
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from bar_cache import DEFAULT_ROOT, NY
+
+
+# Exchange sessions and the clock the bot trades by. The calendar is fetched
+# a year at a time and kept on disk; each session is a pair of epoch seconds,
+# so "how far into the session are we" is integer arithmetic with no
+# timezone work.
+#
+# SessionState holds one symbol's running figures for the day, kept current
+# bar by bar so the entry checks read attributes instead of scanning history.
+
+CALENDAR_ROOT = os.path.join(DEFAULT_ROOT, 'calendar')
+# refetch a cached year after this long, to pick up schedule changes
+CALENDAR_MAX_AGE = 30 * 24 * 60 * 60
+
+
+class TradingCalendar:
+
+	def __init__(self, api=None, root=CALENDAR_ROOT, max_age=CALENDAR_MAX_AGE):
+		self.api = api
+		self.root = root
+		self.max_age = max_age
+		self._years = {}
+
+	def session(self, day):
+		# (open, close) epoch seconds for day's session, or None if the
+		# market is closed that day
+		day = pd.Timestamp(day)
+		if day.tzinfo is not None:
+			day = day.tz_convert(NY)
+		return self._year(day.year).get(day.strftime('%Y-%m-%d'))
+
+	def _year(self, year):
+		if year not in self._years:
+			self._years[year] = {date: (open, close) for date, open, close in self._load(year)}
+		return self._years[year]
+
+	def _load(self, year):
+		path = os.path.join(self.root, '{}.json'.format(year))
+		try:
+			if time.time() - os.path.getmtime(path) < self.max_age:
+				with open(path) as f:
+					return json.load(f)
+		except (OSError, ValueError):
+			pass
+		sessions = self._fetch(year)
+		os.makedirs(self.root, exist_ok=True)
+		tmp = '{}.{}.tmp'.format(path, os.getpid())
+		with open(tmp, 'w') as f:
+			json.dump(sessions, f)
+		os.replace(tmp, path)
+		return sessions
+
+	def _fetch(self, year):
+		if self.api is None:
+			from stock_data import get_alpaca_api
+			self.api = get_alpaca_api()
+		days = self.api.get_calendar(start='{}-01-01'.format(year), end='{}-12-31'.format(year))
+		if not days:
+			return []
+		dates = [day._raw['date'] for day in days]
+		opens = epoch_seconds(['{} {}'.format(day._raw['date'], day._raw['open']) for day in days])
+		closes = epoch_seconds(['{} {}'.format(day._raw['date'], day._raw['close']) for day in days])
+		return [[date, int(open), int(close)] for date, open, close in zip(dates, opens, closes)]
+
+
+def epoch_seconds(times):
+	# New York wall-clock strings to epoch seconds
+	index = pd.DatetimeIndex(pd.to_datetime(times)).tz_localize(NY)
+	return np.asarray((index - pd.Timestamp(0, tz='UTC')) // pd.Timedelta(seconds=1), dtype=np.int64)
+
+
+class SessionClock:
+	# One trading session. Times are epoch seconds; minute arguments are
+	# epoch minutes like MinuteBars keys.
+
+	def __init__(self, open_ts, close_ts):
+		self.open_ts = int(open_ts)
+		self.close_ts = int(close_ts)
+		self.open_minute = self.open_ts // 60
+		self.close_minute = self.close_ts // 60
+
+	@classmethod
+	def for_day(cls, calendar, day=None):
+		# None if the market is closed on day (default today)
+		session = calendar.session(pd.Timestamp.now(tz=NY) if day is None else day)
+		return cls(*session) if session is not None else None
+
+	@classmethod
+	def from_datetimes(cls, market_open_dt, market_close_dt):
+		return cls(pd.Timestamp(market_open_dt).timestamp(), pd.Timestamp(market_close_dt).timestamp())
+
+	@property
+	def market_open_dt(self):
+		return pd.Timestamp(self.open_ts, unit='s', tz='UTC').tz_convert(NY)
+
+	@property
+	def market_close_dt(self):
+		return pd.Timestamp(self.close_ts, unit='s', tz='UTC').tz_convert(NY)
+
+	def is_open(self, now=None):
+		now = time.time() if now is None else now
+		return self.open_ts <= now < self.close_ts
+
+	def minutes_since_open(self, now=None):
+		now = time.time() if now is None else now
+		return int((now - self.open_ts) // 60)
+
+	def minutes_until_close(self, now=None):
+		now = time.time() if now is None else now
+		return int((self.close_ts - now) // 60)
+
+	def sleep_until(self, target):
+		# block until epoch second target; returns at once if it has passed
+		while True:
+			remaining = target - time.time()
+			if remaining <= 0:
+				return
+			time.sleep(remaining)
+
+	async def wait_until(self, target):
+		while True:
+			remaining = target - time.time()
+			if remaining <= 0:
+				return
+			await asyncio.sleep(remaining)
+
+
+# Minutes after the open that make up the opening range, inclusive
+OPENING_RANGE = 15
+
+
+class SessionState:
+	# One symbol's day so far. Second bars fold into the forming minute and
+	# its minute bar replaces them, as in MinuteBars, so volume is never
+	# counted twice, and a minute bar that arrives again (e.g. backfilled
+	# after a reconnect) replaces its earlier figures. The opening range
+	# covers the first OPENING_RANGE minutes and stops moving after them; a
+	# late minute bar for one of those minutes still amends it.
+
+	__slots__ = (
+		'open_minute', 'range_end', 'prev_close', 'range_high', 'range_low', 'close', 'change',
+		'volume', 'notional', 'bar_volume', 'forming_minute', 'forming_volume', 'forming_notional', 'minutes'
+	)
+
+	def __init__(self, open_minute, prev_close=None, volume=0, history=None):
+		# volume is what traded before the first bar we see, e.g. from the
+		# snapshot; history is a MinuteBars that may already cover the open
+		self.open_minute = open_minute
+		self.range_end = open_minute + OPENING_RANGE
+		self.prev_close = prev_close
+		self.range_high = np.nan
+		self.range_low = np.nan
+		self.close = np.nan
+		self.change = np.nan
+		self.volume = volume
+		# notional and bar_volume cover only the bars seen, for the VWAP
+		self.notional = 0.
+		self.bar_volume = 0
+		self.forming_minute = None
+		self.forming_volume = 0
+		self.forming_notional = 0.
+		# (volume, notional) counted for each minute bar
+		self.minutes = {}
+		if history is not None:
+			self.reset_range(history)
+
+	@property
+	def volume_today(self):
+		return self.volume + self.forming_volume
+
+	@property
+	def vwap(self):
+		volume = self.bar_volume + self.forming_volume
+		return (self.notional + self.forming_notional) / volume if volume else np.nan
+
+	def reset_range(self, history):
+		self.range_high = history.high_between(self.open_minute, self.range_end)
+		self.range_low = history.low_between(self.open_minute, self.range_end)
+
+	def on_second_bar(self, minute, high, low, close, volume):
+		if minute != self.forming_minute:
+			self.forming_minute = minute
+			self.forming_volume = 0
+			self.forming_notional = 0.
+		self.forming_volume += volume
+		self.forming_notional += (high + low + close) / 3 * volume
+		if self.open_minute <= minute <= self.range_end:
+			# merged 1s bars only ever widen the minute's range
+			if not high <= self.range_high:
+				self.range_high = high
+			if not low >= self.range_low:
+				self.range_low = low
+		self._set_close(close)
+
+	def on_minute_bar(self, minute, high, low, close, volume, history):
+		# history already holds this bar
+		notional = (high + low + close) / 3 * volume
+		counted = self.minutes.get(minute)
+		if counted is not None:
+			self.volume -= counted[0]
+			self.bar_volume -= counted[0]
+			self.notional -= counted[1]
+		self.minutes[minute] = (volume, notional)
+		self.volume += volume
+		self.bar_volume += volume
+		self.notional += notional
+		if minute == self.forming_minute:
+			self.forming_minute = None
+			self.forming_volume = 0
+			self.forming_notional = 0.
+		if self.open_minute <= minute <= self.range_end:
+			# the minute bar overwrites the aggregated one and may narrow it
+			self.reset_range(history)
+		self._set_close(close)
+
+	def _set_close(self, close):
+		self.close = close
+		if self.prev_close:
+			self.change = (close - self.prev_close) / self.prev_close
@@ -0,0 +1,672 @@
+import asyncio
+import multiprocessing
+import sys
+import time
+import uuid
+import zlib
+from collections import namedtuple
+from multiprocessing.connection import wait
+
+import numpy as np
+import pandas as pd
+
+from bar_cache import NY
+from decode import FastStreamConn
+from engine import Cancel, Liquidate, StaticAccount, StrategyEngine, Submit, Unwatch, to_bar
+from metrics import Metrics, report, write_snapshot
+from reconnect import StreamSupervisor, minute_recovery
+from replay import CHANNELS, PaperBroker, ReplayStats, build_engine, read_events
+from scheduler import LIQUIDATE
+from session import SessionClock
+from subscriptions import MINUTES, SECONDS, SubscriptionManager
+
+
+# Runs the strategy across several processes. Symbols are split into shards
+# by a hash of the symbol; each worker process streams its own symbols and
+# keeps their history, indicators and StrategyEngine. One coordinator
+# process owns the account, positions and the order gateway: workers send it
+# the intents their engine returns, and it answers over the same pipe with
+# order acknowledgements, trade updates for the worker's symbols and fresh
+# account figures. Live workers also pass on their minute bars, for the
+# coordinator's bar writers, and their metrics, which it merges and serves.
+# The coordinator keeps the order journal: it restores and reconciles the
+# order state at startup and hands each worker its symbols' states, and the
+# workers send back every symbol state that changes, with the engine's
+# state behind each Submit, for it to record.
+#
+# Messages are tuples, first the kind.
+#   worker -> coordinator
+#     ('ready', index)
+#     ('intents', index, [Submit | Cancel | Liquidate, ...], epoch seconds, {symbol: state of each Submit})
+#     ('state', index, journal event, symbol, state, {detail: value})
+#     ('done', index, payload)
+#     ('bars', index, [minute_stocks row, ...])
+#     ('metrics', index, {name: Histogram since the last}, {name: gauge})
+#   coordinator -> worker
+#     ('account', portfolio_value, cash)
+#     ('submitted', symbol, order id, submitted_at)
+#     ('rejected', symbol)
+#     ('trade_update', event, order dict)
+#     ('watch', [(symbol, prev_close, volume), ...])
+#     ('start',)
+#     ('stop',)
+
+# What a worker's engine gets back for an accepted Submit
+OrderAck = namedtuple('OrderAck', ['id', 'submitted_at'])
+
+
+def shard_of(symbol, shards):
+	# stable across processes and runs, unlike hash()
+	return zlib.crc32(symbol.encode()) % shards
+
+
+def partition(symbols, shards):
+	parts = [[] for _ in range(shards)]
+	for symbol in symbols:
+		parts[shard_of(symbol, shards)].append(symbol)
+	return parts
+
+
+class RemoteAccount:
+	# The coordinator's account figures as last sent to this worker
+
+	def __init__(self, portfolio_value=0., cash=0.):
+		self.portfolio_value = portfolio_value
+		self.cash = cash
+
+
+class ShardWorker:
+	# The worker's side of the pipe: applies coordinator messages to the
+	# engine and forwards the intents the engine returns. With journaled, the
+	# symbol states the coordinator's journal needs go along too.
+
+	def __init__(self, index, engine, conn, journaled=False):
+		self.index = index
+		self.engine = engine
+		self.conn = conn
+		self.journaled = journaled
+		self.stopped = False
+		self.watched = []
+
+	def send(self, intents, ts):
+		# intents for the coordinator; Unwatch stays with the worker
+		orders = [intent for intent in intents if not isinstance(intent, Unwatch)]
+		if orders:
+			states = {}
+			if self.journaled:
+				states = {
+					intent.symbol: self.engine.symbol_state(intent.symbol)
+					for intent in orders if isinstance(intent, Submit)
+				}
+			self.conn.send(('intents', self.index, orders, ts, states))
+		return [intent.symbol for intent in intents if isinstance(intent, Unwatch)]
+
+	def record(self, ev, symbol, **details):
+		if self.journaled:
+			self.conn.send(('state', self.index, ev, symbol, self.engine.symbol_state(symbol), details))
+
+	def apply(self, message):
+		kind = message[0]
+		engine = self.engine
+		if kind == 'account':
+			engine.account.portfolio_value, engine.account.cash = message[1:]
+		elif kind == 'submitted':
+			_, symbol, order_id, submitted_at = message
+			engine.on_order_submitted(symbol, OrderAck(order_id, submitted_at))
+			self.record('submitted', symbol, order_id=order_id)
+		elif kind == 'rejected':
+			engine.on_order_rejected(message[1])
+			self.record('rejected', message[1])
+		elif kind == 'trade_update':
+			_, event, order = message
+			self.send(engine.on_trade_update(event, order), time.time())
+			if order['symbol'] in engine.sessions:
+				self.record('trade_update', order['symbol'], event=event, order_id=order['id'])
+		elif kind == 'watch':
+			self.watched.extend(message[1])
+		elif kind == 'stop':
+			self.stopped = True
+		return kind
+
+	def drain(self):
+		while self.conn.poll():
+			self.apply(self.conn.recv())
+
+
+class ShardRouter:
+	# The coordinator's side: one pipe per worker, messages routed by symbol
+
+	def __init__(self, conns):
+		self.conns = conns
+		# pipes of workers that have exited; nothing more is sent to them
+		self.closed = set()
+
+	def owner(self, symbol):
+		return self.conns[shard_of(symbol, len(self.conns))]
+
+	def close(self, conn):
+		self.closed.add(conn)
+
+	def send(self, symbol, message):
+		conn = self.owner(symbol)
+		if conn not in self.closed:
+			conn.send(message)
+
+	def broadcast(self, message):
+		for conn in self.conns:
+			if conn not in self.closed:
+				conn.send(message)
+
+
+def start_workers(target, args_by_shard, context=None):
+	# one process per shard running target(index, *args, conn); returns the
+	# processes and the coordinator's ends of their pipes
+	context = context or multiprocessing.get_context()
+	processes = []
+	conns = []
+	for index, args in enumerate(args_by_shard):
+		parent, child = context.Pipe()
+		process = context.Process(target=target, args=(index,) + tuple(args) + (child,), daemon=True)
+		process.start()
+		child.close()
+		processes.append(process)
+		conns.append(parent)
+	return processes, conns
+
+
+# Replay: each worker plays back its shard of a recording, standing in for
+# its own stream, while the coordinator fills orders with a PaperBroker.
+
+def split_events(events, shards):
+	# per-shard event lists; session lines go to every shard
+	parts = [[] for _ in range(shards)]
+	for event in events:
+		ev = event['ev']
+		if ev == 'session':
+			for part in parts:
+				part.append(event)
+			continue
+		symbol = event['order']['symbol'] if ev == 'trade_update' else event['symbol']
+		parts[shard_of(symbol, shards)].append(event)
+	return parts
+
+
+# events a replay worker handles between checks of its pipe; polling on
+# every event costs more than the engine does
+POLL_EVERY = 32
+
+
+def replay_worker(index, events, batch, conn):
+	engine = build_engine(events, RemoteAccount())
+	engine.batch = batch
+	worker = ShardWorker(index, engine, conn)
+	decoded = []
+	for event in events:
+		ev = event['ev']
+		if ev == 'A' or ev == 'AM':
+			decoded.append((ev, to_bar(event)))
+		elif ev == 'trade_update':
+			decoded.append((ev, event))
+	conn.send(('ready', index))
+	while worker.apply(conn.recv()) != 'start':
+		pass
+	latencies = {channel: [] for channel in CHANNELS}
+	start = time.perf_counter()
+	for i, (ev, data) in enumerate(decoded):
+		t0 = time.perf_counter()
+		if i % POLL_EVERY == 0:
+			worker.drain()
+		if ev == 'A':
+			worker.send(engine.on_second_bar(data), data.start // 1000)
+		elif ev == 'AM':
+			worker.send(engine.on_minute_bar(data), data.start // 1000)
+		else:
+			worker.send(engine.on_trade_update(data['event'], data['order']), time.time())
+		latencies[ev].append(time.perf_counter() - t0)
+	elapsed = time.perf_counter() - start
+	conn.send(('done', index, ({channel: np.array(values) for channel, values in latencies.items()}, elapsed)))
+	while not worker.stopped:
+		worker.apply(conn.recv())
+
+
+class PaperCoordinator:
+	# Fills every Submit in full, as PaperBroker does for one engine, and
+	# keeps the positions and cash of all shards
+
+	def __init__(self, router, account):
+		self.router = router
+		self.account = account
+		self.broker = PaperBroker()
+		self.positions = {}
+		self._conn = None
+
+	def execute(self, conn, intents, ts):
+		# PaperBroker calls back into this object as if it were the engine
+		self._conn = conn
+		self.broker.execute(self, intents, ts)
+
+	def on_order_submitted(self, symbol, order):
+		self._conn.send(('submitted', symbol, order.id, order.submitted_at))
+
+	def on_trade_update(self, event, order):
+		if event == 'fill' or event == 'partial_fill':
+			qty = int(order['filled_qty'])
+			notional = qty * float(order['filled_avg_price'])
+			if order['side'] == 'sell':
+				qty, notional = -qty, -notional
+			self.positions[order['symbol']] = self.positions.get(order['symbol'], 0) + qty
+			self.account.cash -= notional
+		self._conn.send(('trade_update', event, order))
+		self.router.broadcast(('account', self.account.portfolio_value, self.account.cash))
+		return []
+
+
+def replay_sharded(events, workers=2, batch=False, account=None):
+	# ReplayStats for playing events through `workers` processes; elapsed is
+	# wall time from the start signal until the last worker finishes
+	account = account or StaticAccount(100000.)
+	processes, conns = start_workers(replay_worker, [(part, batch) for part in split_events(events, workers)])
+	router = ShardRouter(conns)
+	coordinator = PaperCoordinator(router, account)
+	try:
+		for conn in conns:
+			message = conn.recv()
+			if message[0] != 'ready':
+				raise RuntimeError('worker failed to start: {}'.format(message))
+		router.broadcast(('account', account.portfolio_value, account.cash))
+		start = time.perf_counter()
+		router.broadcast(('start',))
+		results = {}
+		while len(results) < len(conns):
+			for conn in wait(conns):
+				message = conn.recv()
+				if message[0] == 'intents':
+					coordinator.execute(conn, message[2], message[3])
+				elif message[0] == 'done':
+					results[message[1]] = message[2]
+		elapsed = time.perf_counter() - start
+		router.broadcast(('stop',))
+	finally:
+		for process in processes:
+			process.join(timeout=5)
+			if process.is_alive():
+				process.terminate()
+	latencies = {
+		channel: np.concatenate([results[i][0][channel] for i in sorted(results)])
+		for channel in CHANNELS
+	}
+	return ReplayStats(latencies, elapsed), coordinator
+
+
+# Live: workers stream their symbols, the coordinator streams trade updates
+# and talks to Alpaca.
+
+def stream_worker(index, rows, states, open_ts, close_ts, batch, conn):
+	# rows: (symbol, prev_close, volume) to watch; states: {symbol: state}
+	# of positions and orders from earlier executions, as reconciled by the
+	# coordinator
+	import algo
+	from bar_cache import BarCache
+	engine = StrategyEngine(SessionClock(open_ts, close_ts), RemoteAccount(), batch)
+	worker = ShardWorker(index, engine, conn, journaled=True)
+	subscriptions = SubscriptionManager(engine)
+	stream = FastStreamConn(base_url=algo.base_url, key_id=algo.api_key_id, secret_key=algo.api_secret)
+	cache = BarCache()
+	# reported to the coordinator, which serves them with its own
+	metrics = Metrics()
+	metrics.probe('symbols', lambda: len(engine.symbols))
+	metrics.probe('subscriptions.seconds', lambda: subscriptions.counts()[SECONDS])
+	metrics.probe('subscriptions.minutes', lambda: subscriptions.counts()[MINUTES])
+	metrics.probe('subscriptions.saved_per_sec', lambda: subscriptions.saved_per_second)
+	metrics.probe('inbox.received', lambda: stream.inbox.received)
+	metrics.probe('inbox.merged', lambda: stream.inbox.merged)
+	metrics.probe('inbox.depth', lambda: len(stream.inbox))
+	metrics.probe('inbox.max_depth', lambda: stream.inbox.max_depth)
+	# minute bars for the coordinator's bar writers, sent once per pass of
+	# the loop rather than one message a bar
+	outbox = []
+
+	def watch(rows, extra=()):
+		history = algo.get_1000m_history_data([row[0] for row in rows] + list(extra), cache=cache)
+		added = []
+		for symbol, prev_close, volume in rows:
+			if symbol in history:
+				engine.watch(symbol, history[symbol], prev_close, volume)
+				added.append(symbol)
+		return added, history
+
+	_, history = watch(rows, list(states))
+	for symbol, state in states.items():
+		if symbol not in engine.symbols:
+			engine.watch(symbol, history.get(symbol))
+		engine.restore_symbol_state(symbol, state)
+
+	def send_bars():
+		if outbox:
+			conn.send(('bars', index, outbox[:]))
+			del outbox[:]
+
+	async def store(bar):
+		if not outbox:
+			stream.loop.call_soon(send_bars)
+		outbox.append((
+			pd.Timestamp(bar.start, unit='ms', tz=NY).to_pydatetime(),
+			bar.symbol, bar.open, bar.high, bar.low, bar.close, bar.volume
+		))
+
+	def publish(metrics):
+		# histograms since the last report, so the coordinator can add them up
+		conn.send(('metrics', index, metrics.histograms, dict(metrics.gauges)))
+		metrics.histograms = {}
+
+	async def dispatch(intents, ts):
+		for symbol in worker.send(intents, ts):
+			channels = subscriptions.unwatch(symbol)
+			if channels:
+				await stream.unsubscribe(channels)
+		if engine.done:
+			send_bars()
+			metrics.sample()
+			publish(metrics)
+			conn.send(('done', index, None))
+			stream.loop.stop()
+
+	async def update_subscriptions():
+		subscribe, unsubscribe, intents = subscriptions.update(int(time.time()) // 60)
+		if subscribe:
+			await stream.subscribe(subscribe)
+		if unsubscribe:
+			await stream.unsubscribe(unsubscribe)
+		await dispatch(intents, time.time())
+
+	async def prune_subscriptions():
+		while not engine.done:
+			await asyncio.sleep(61 - time.time() % 60)
+			await update_subscriptions()
+
+	async def add(rows):
+		added, _ = await stream.loop.run_in_executor(None, watch, rows)
+		if added:
+			await update_subscriptions()
+
+	def on_message():
+		try:
+			worker.drain()
+		except (EOFError, OSError):
+			# the coordinator died; without it there is nothing to trade for,
+			# and an error raised here would only make the supervisor reconnect
+			print('Shard {} lost its coordinator'.format(index))
+			stream.loop.remove_reader(conn.fileno())
+			worker.stopped = True
+		if worker.watched:
+			stream.loop.create_task(add(worker.watched))
+			worker.watched = []
+		if worker.stopped:
+			stream.loop.stop()
+
+	supervisor = StreamSupervisor(
+		stream, subscriptions.channels, minute_recovery(engine, algo.api, store), stale_after=60, metrics=metrics
+	)
+
+	@stream.on(r'status')
+	async def handle_status(conn, channel, data):
+		supervisor.on_status(data._raw.get('status'))
+
+	@stream.on(r'A$')
+	async def handle_second_bar(conn, channel, bar):
+		entry = time.time()
+		t0 = time.perf_counter()
+		supervisor.touch()
+		subscriptions.on_second_bar(bar.symbol)
+		await dispatch(engine.on_second_bar(bar), bar.start // 1000)
+		metrics.on_event('A', bar.end / 1000, entry, time.perf_counter() - t0)
+
+	@stream.on(r'AM$')
+	async def handle_minute_bar(conn, channel, bar):
+		entry = time.time()
+		t0 = time.perf_counter()
+		supervisor.touch()
+		await dispatch(engine.on_minute_bar(bar), bar.start // 1000)
+		await store(bar)
+		metrics.on_event('AM', bar.end / 1000, entry, time.perf_counter() - t0)
+
+	stream.loop.add_reader(conn.fileno(), on_message)
+	subscriptions.update(int(time.time()) // 60)
+	stream.loop.create_task(prune_subscriptions())
+	stream.loop.create_task(report(metrics, path=None, publish=publish))
+	conn.send(('ready', index))
+	try:
+		supervisor.run()
+	finally:
+		stream.loop.run_until_complete(stream.close())
+
+
+def run(tickers, clock, workers=4, batch=False):
+	# algo.run across `workers` stream processes
+	import alpaca_trade_api as tradeapi
+	import algo
+	from bar_cache import BarCache
+	from bar_writer import BarWriter, CacheBackend, MySQLBackend
+	from gateway import OrderGateway
+	from journal import Journal, reconcile
+	from scheduler import RequestScheduler
+	api = algo.api
+	scheduler = RequestScheduler()
+	gateway = OrderGateway(api, scheduler=scheduler)
+	gateway.load()
+	rows = list(zip(tickers['symbol'], tickers['prev_close'], tickers['volume']))
+	# Restore and reconcile order state as algo.run does, into an engine kept
+	# only to work out each symbol's state for the worker that owns it
+	journal = Journal(clock.market_open_dt.strftime('%Y-%m-%d'))
+	states = journal.load()
+	book = StrategyEngine(clock, gateway)
+	if states:
+		start = time.perf_counter()
+		restored, unknown = reconcile(
+			book, states, api.list_orders(status='all', after=clock.market_open_dt.isoformat(), limit=500)
+		)
+		for order_id in unknown:
+			api.cancel_order(order_id)
+		for symbol in restored:
+			journal.record('reconciled', symbol, book.symbol_state(symbol))
+		print('Restored {} symbols from the journal in {:.0f}ms'.format(
+			len(restored), (time.perf_counter() - start) * 1e3
+		))
+	else:
+		# Cancel any existing open orders on watched symbols
+		symbols = set(tickers['symbol'])
+		for order in api.list_orders(limit=500):
+			if order.symbol in symbols:
+				api.cancel_order(order.id)
+		# Track any positions bought during previous executions
+		for position in api.list_positions():
+			book.add_position(position.symbol, float(position.qty), float(position.cost_basis))
+			journal.record('position', position.symbol, book.symbol_state(position.symbol))
+	rows_by_shard = [[] for _ in range(workers)]
+	for row in rows:
+		rows_by_shard[shard_of(row[0], workers)].append(row)
+	states_by_shard = [{} for _ in range(workers)]
+	for symbol in book.symbols:
+		states_by_shard[shard_of(symbol, workers)][symbol] = book.symbol_state(symbol)
+	print('Tracking {} symbols in {} shards.'.format(len(rows), workers))
+	processes, conns = start_workers(stream_worker, [
+		(rows_by_shard[i], states_by_shard[i], clock.open_ts, clock.close_ts, batch) for i in range(workers)
+	])
+	router = ShardRouter(conns)
+
+	conn = tradeapi.StreamConn(base_url=algo.base_url, key_id=algo.api_key_id, secret_key=algo.api_secret)
+	loop = conn.loop
+	running = set(range(workers))
+	# liquidation orders in flight
+	pending = []
+	# the workers' minute bars, persisted as algo.run does
+	bar_writers = [
+		BarWriter(MySQLBackend()),
+		BarWriter(CacheBackend(BarCache()), flush_interval=5.0)
+	]
+	# the coordinator's own metrics and the workers' as they report them,
+	# their gauges under shard<index>.
+	metrics = Metrics()
+	metrics.probe('broker_queue', lambda: scheduler.depth)
+	metrics.probe('shards_running', lambda: len(running))
+	metrics.probe('db_queue.mysql', lambda: bar_writers[0].depth)
+	metrics.probe('db_queue.cache', lambda: bar_writers[1].depth)
+	metrics.probe('db_dropped.mysql', lambda: bar_writers[0].dropped)
+	metrics.probe('db_dropped.cache', lambda: bar_writers[1].dropped)
+
+	def send_account():
+		router.broadcast(('account', gateway.portfolio_value, gateway.cash))
+
+	async def submit(intent, state):
+		# state: the worker engine's state for the symbol behind intent
+		if intent.side == 'buy' and intent.qty * intent.limit_price > gateway.cash:
+			# another shard got to the cash first
+			router.send(intent.symbol, ('rejected', intent.symbol))
+			return
+		# journaled before it goes out, with an id to find it by after a crash
+		client_order_id = uuid.uuid4().hex
+		journal.record(
+			'intent', intent.symbol, dict(state, client_order_id=client_order_id),
+			side=intent.side, qty=intent.qty, limit_price=intent.limit_price
+		)
+		try:
+			o = await gateway.submit_order(
+				intent.symbol, intent.qty, intent.side, intent.type,
+				limit_price=intent.limit_price, client_order_id=client_order_id
+			)
+			router.send(intent.symbol, ('submitted', intent.symbol, o.id, o.submitted_at))
+		except Exception as e:
+			print(e)
+			router.send(intent.symbol, ('rejected', intent.symbol))
+		send_account()
+
+	async def cancel(intent):
+		try:
+			await gateway.cancel_order(intent.order_id)
+		except Exception as e:
+			print(e)
+
+	async def liquidate(intent):
+		position = await gateway.get_position(intent.symbol, lane=LIQUIDATE)
+		if position is None:
+			return
+		print('Trading over, liquidating remaining position in {}'.format(intent.symbol))
+		try:
+			await gateway.submit_order(intent.symbol, position.qty, 'sell', 'market', lane=LIQUIDATE)
+		except Exception as e:
+			print(e)
+
+	async def finish():
+		await asyncio.gather(*pending)
+		for bar_writer in bar_writers:
+			await bar_writer.close()
+		loop.stop()
+
+	def stopped(index):
+		if index in running:
+			running.discard(index)
+			if not running:
+				loop.create_task(finish())
+
+	def handle(message):
+		kind = message[0]
+		if kind == 'intents':
+			for intent in message[2]:
+				if isinstance(intent, Submit):
+					loop.create_task(submit(intent, message[4][intent.symbol]))
+				elif isinstance(intent, Cancel):
+					loop.create_task(cancel(intent))
+				elif isinstance(intent, Liquidate):
+					pending.append(loop.create_task(liquidate(intent)))
+		elif kind == 'bars':
+			for row in message[2]:
+				for bar_writer in bar_writers:
+					bar_writer.put(row)
+		elif kind == 'state':
+			_, _, ev, symbol, state, details = message
+			journal.record(ev, symbol, state, **details)
+		elif kind == 'metrics':
+			_, index, histograms, gauges = message
+			metrics.merge(histograms)
+			for name, value in gauges.items():
+				metrics.gauge('shard{}.{}'.format(index, name), value)
+		elif kind == 'done':
+			stopped(message[1])
+
+	def on_message(worker):
+		try:
+			while worker.poll():
+				handle(worker.recv())
+		except (EOFError, OSError):
+			# the worker exited: after its 'done', or it died
+			index = conns.index(worker)
+			loop.remove_reader(worker.fileno())
+			router.close(worker)
+			if index in running:
+				print('Shard {} exited before finishing its symbols'.format(index))
+			stopped(index)
+
+	@conn.on(r'trade_update')
+	async def handle_trade_update(conn, channel, data):
+		entry = time.time()
+		t0 = time.perf_counter()
+		gateway.on_trade_update(data.event, data.order)
+		router.send(data.order['symbol'], ('trade_update', data.event, data.order))
+		send_account()
+		metrics.on_event('trade_update', None, entry, time.perf_counter() - t0)
+		if data.event == 'partial_fill' or data.event == 'fill':
+			print(f"Filled {'partial ' if data.event == 'partial_fill' else ''}{data.order['side']} order. {data.order['filled_qty']} shares of {data.order['symbol']} @ {data.order['filled_avg_price']} ")
+
+	# Pick up stocks that start moving after the open while we can still buy
+	async def add_movers():
+		watched = {row[0] for row in rows}
+		while clock.minutes_since_open() < 60:
+			await asyncio.sleep(algo.rescreen_interval)
+			try:
+				movers = await loop.run_in_executor(None, algo.screener.rescreen, list(watched))
+			except Exception as e:
+				print(e)
+				continue
+			added = list(zip(movers['symbol'], movers['prev_close'], movers['volume']))
+			watched.update(row[0] for row in added)
+			by_shard = {}
+			for row in added:
+				by_shard.setdefault(shard_of(row[0], workers), []).append(row)
+			for index, shard_rows in by_shard.items():
+				if conns[index] not in router.closed:
+					conns[index].send(('watch', shard_rows))
+
+	try:
+		for worker in conns:
+			if worker.recv()[0] != 'ready':
+				raise RuntimeError('worker failed to start')
+			loop.add_reader(worker.fileno(), on_message, worker)
+		send_account()
+		loop.create_task(add_movers())
+		loop.create_task(report(metrics))
+		StreamSupervisor(conn, lambda: ['trade_updates'], metrics=metrics).run()
+	finally:
+		for worker in conns:
+			try:
+				worker.send(('stop',))
+			except OSError:
+				# it already finished its symbols and exited
+				pass
+		for process in processes:
+			process.join(timeout=30)
+		for bar_writer in bar_writers:
+			loop.run_until_complete(bar_writer.close())
+		loop.run_until_complete(conn.close())
+		loop.run_until_complete(scheduler.close())
+		print('Broker requests: {}'.format(scheduler.metrics()))
+		journal.close()
+		write_snapshot(metrics.snapshot())
+		gateway.close()
+
+
+if __name__ == '__main__':
+	# python shards.py events.jsonl [workers]
+	events = read_events(sys.argv[1])
+	workers = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+	stats, _ = replay_sharded(events, workers)
+	print(stats.report())
@@ -0,0 +1,66 @@
+from collections import namedtuple
+
+import numpy as np
+
+from indicators import macd_2d, valley_lows
+
+
+# The engine's entry and exit rules for every watched symbol at once. Each
+# symbol's recent bars are stacked into a symbols x minutes array, right
+# aligned so the last column is the minute being evaluated, and the MACDs,
+# the find_stop valley and the filters are computed column-wise in a single
+# pass instead of once per symbol.
+
+# A symbol the rules picked out; score orders candidates on the same side
+Candidate = namedtuple('Candidate', ['symbol', 'side', 'price', 'qty', 'stop', 'target', 'score'])
+
+# bars find_stop looks back over
+STOP_LOOKBACK = 100
+
+
+def stack(histories, field, n=None):
+	# the newest n values of field from each MinuteBars as rows, NaN padded
+	# on the left; n defaults to the longest history
+	if n is None:
+		n = max([len(history) for history in histories] or [0])
+	out = np.full((len(histories), n), np.nan)
+	for i, history in enumerate(histories):
+		values = history.column(field, n)
+		if len(values):
+			out[i, n - len(values):] = values
+	return out
+
+
+def entry_signals(closes, lows, prev_close, range_high, volume, min_change, min_volume, default_stop):
+	# (mask, stops, score) for the last column of closes: up more than
+	# min_change on the day, above the opening range, traded more than
+	# min_volume, with a positive rising fast MACD and a non-falling slow one.
+	# score is the fast MACD relative to price, strongest first.
+	price = closes[:, -1]
+	fast = macd_2d(closes, 12, 26)[:, -3:]
+	slow = macd_2d(closes, 40, 60)[:, -2:]
+	with np.errstate(invalid='ignore', divide='ignore'):
+		change = (price - prev_close) / prev_close
+		valley = valley_lows(lows[:, -STOP_LOOKBACK:], STOP_LOOKBACK)[:, -1]
+		stops = np.where(np.isnan(valley), price * default_stop, valley - 0.01)
+		mask = (
+			(change > min_change) &
+			(price > range_high) &
+			(volume > min_volume) &
+			(fast[:, 2] >= 0) & (fast[:, 0] < fast[:, 1]) & (fast[:, 1] < fast[:, 2]) &
+			~((slow[:, 1] < 0) | (slow[:, 1] - slow[:, 0] < 0)) &
+			(price - stops > 0)
+		)
+		score = fast[:, 2] / price
+	return mask, stops, score
+
+
+def exit_signals(closes, stop, target, cost_basis):
+	# (mask, score) for the last column of closes: below the stop, or past the
+	# target or under cost basis with a non-positive exit MACD. score is how
+	# far above the stop the price still is, so stop-outs rank first.
+	price = closes[:, -1]
+	with np.errstate(invalid='ignore'):
+		weak = macd_2d(closes, 12, 21)[:, -1] <= 0
+		mask = (price <= stop) | ((price >= target) & weak) | ((price <= cost_basis) & weak)
+	return mask, (price - stop) / price
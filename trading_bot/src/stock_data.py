@@ -1,22 +1,26 @@
 import pandas as pd
 import pytz
 import time
+import functools
 import aiomysql
 from datetime import datetime, timedelta
 from credentials import td, alpaca, rds
 from sqlalchemy import create_engine
-from pytz import timezone
 import alpaca_trade_api as tradeapi
+from bar_cache import NY, to_ny
+from screener import tradable_symbols
 
 
 # Price History API Documentation
 # https://developer.tdameritrade.com/price-history/apis/get/marketdata/%7Bsymbol%7D/pricehistory
 
+db_host = "db-1.cztzalypzdly.us-east-1.rds.amazonaws.com"
+
 
 def get_db_connection():
 	user = rds['user']
 	password = rds['password']
-	host = "db-1.cztzalypzdly.us-east-1.rds.amazonaws.com"
+	host = db_host
 	connect_str = f"mysql+pymysql://{user}:{password}@{host}:3306/mydb"
 	engine = create_engine(connect_str)
 
@@ -25,7 +29,7 @@ def get_db_connection():
 
 async def a_insert(loop, table, myDict):
 	conn = await aiomysql.connect(user=rds['user'], db='mydb', port=3306,
-	                              host="db-1.cztzalypzdly.us-east-1.rds.amazonaws.com",
+	                              host=db_host,
 	                              password=rds['password'], loop=loop)
 
 	async with conn.cursor() as cur:
@@ -52,33 +56,19 @@ def index_to_timestamp(df):
 
 
 def trading_times():
-	# Get when the market opens or opened today
-	nyc = timezone('America/New_York')
-	today = datetime.today().astimezone(nyc)
-	today_str = datetime.today().astimezone(nyc).strftime('%Y-%m-%d')
-	calendar = get_alpaca_api().get_calendar(start=today_str, end=today_str)[0]
-	market_open = today.replace(
-		hour=calendar.open.hour,
-		minute=calendar.open.minute,
-		second=0
-	)
-	market_open = market_open.astimezone(nyc)
-	market_close = today.replace(
-		hour=calendar.close.hour,
-		minute=calendar.close.minute,
-		second=0
-	)
-	market_close = market_close.astimezone(nyc)
-	return market_open, market_close
+	# Get when the market opens or opened today, from the cached calendar
+	from session import SessionClock, TradingCalendar
+	clock = SessionClock.for_day(TradingCalendar(get_alpaca_api()))
+	return clock.market_open_dt, clock.market_close_dt
 
 
 def get_tradable_symbols():
-	# Get a current list of all the stock symbols
-	assets = get_alpaca_api().list_assets()
-	symbols = [asset.symbol for asset in assets if asset.tradable]
-	return symbols
+	# Get a current list of all the stock symbols, cached for a day
+	return tradable_symbols(get_alpaca_api())
 
 
+# One client, and so one HTTP session, shared by every caller
+@functools.lru_cache(maxsize=1)
 def get_alpaca_api():
 	base_url = 'https://paper-api.alpaca.markets'
 	api_key_id = alpaca['api_key']
@@ -92,19 +82,24 @@ def get_alpaca_api():
 	return api
 
 
-def get_historical_stock_data(symbols=None, sd=datetime(2019, 1, 1), to_db=False):
-	# Only doing one day here as an example
+def get_historical_stock_data(symbols=None, sd=datetime(2019, 1, 1), to_db=False, cache=None, api=None):
+	# Everything in one frame; stream_historical_stock_data writes the same
+	# rows with memory bounded by its batch size
 	if symbols is None:
 		symbols = get_tradable_symbols()
 
-	api = get_alpaca_api()
+	if api is None:
+		api = get_alpaca_api()
 	nyc = pytz.timezone("America/New_York")
 	today_str = datetime.today().astimezone(nyc).strftime('%Y-%m-%d')
 	from_day = sd
 	from_day_fmt = from_day.strftime('%Y-%m-%d')
 	hist_data = []
 	for symbol in symbols:
-		data = api.polygon.historic_agg_v2(symbol, 1, 'day', _from=from_day_fmt, to=today_str).df
+		if cache is None:
+			data = api.polygon.historic_agg_v2(symbol, 1, 'day', _from=from_day_fmt, to=today_str).df
+		else:
+			data = get_cached_daily(api, cache, symbol, from_day, today_str)
 		data.insert(0, column='symbol', value=symbol)
 		hist_data.append(data)
 	if len(hist_data) == 0:
@@ -124,11 +119,113 @@ def get_historical_stock_data(symbols=None, sd=datetime(2019, 1, 1), to_db=False
 	return df
 
 
-def get_minute_historical(symbol, num_minutes=1):
-	api = get_alpaca_api()
-	return api.polygon.historic_agg(
-		size="minute", symbol=symbol, limit=num_minutes
-	).df
+def iter_historical_batches(symbols=None, sd=datetime(2019, 1, 1), batch_size=10000, api=None, cache=None):
+	# Daily bars as lists of at most batch_size stocks rows, (date, symbol,
+	# open, high, low, close, volume). Only one symbol's response and one
+	# batch are held at a time. Without a cache, responses are read as raw
+	# JSON and never go through pandas.
+	if symbols is None:
+		symbols = get_tradable_symbols()
+	if api is None:
+		api = get_alpaca_api()
+	nyc = pytz.timezone("America/New_York")
+	today_str = datetime.today().astimezone(nyc).strftime('%Y-%m-%d')
+	from_day_fmt = sd.strftime('%Y-%m-%d')
+	batch = []
+	for symbol in symbols:
+		if cache is None:
+			results = api.polygon.get(
+				'/aggs/ticker/{}/range/1/day/{}/{}'.format(symbol, from_day_fmt, today_str),
+				{'unadjusted': False}, version='v2'
+			).get('results') or []
+			rows = [(
+				datetime.fromtimestamp(bar['t'] / 1000, nyc).date(), symbol,
+				bar['o'], bar['h'], bar['l'], bar['c'], bar['v']
+			) for bar in results]
+		else:
+			data = get_cached_daily(api, cache, symbol, sd, today_str)
+			rows = list(zip(
+				data.index.date, [symbol] * len(data), data['open'].values.tolist(), data['high'].values.tolist(),
+				data['low'].values.tolist(), data['close'].values.tolist(), data['volume'].values.tolist()
+			))
+		while rows:
+			space = batch_size - len(batch)
+			batch.extend(rows[:space])
+			rows = rows[space:]
+			if len(batch) == batch_size:
+				yield batch
+				batch = []
+	if batch:
+		yield batch
+
+
+def stream_historical_stock_data(sink, symbols=None, sd=datetime(2019, 1, 1), batch_size=10000, api=None, cache=None):
+	# Write daily bars to sink batch by batch; sink is anything with
+	# write(rows) and close(), like ingest.UpsertWriter or ingest.CsvSink
+	rows = 0
+	try:
+		for batch in iter_historical_batches(symbols, sd, batch_size, api, cache):
+			sink.write(batch)
+			rows += len(batch)
+	finally:
+		sink.close()
+	return rows
+
+
+def get_cached_daily(api, cache, symbol, from_day, today_str):
+	# Daily bars since from_day, downloading only from the newest cached day
+	# on. That day is fetched again since it may have been cached while its
+	# session was still open; the fresh bar replaces it. A cache that starts
+	# well after from_day is refetched whole.
+	cached = cache.read('day', symbol, start=from_day)
+	if cached is None or cached.index[0] - to_ny(from_day) > timedelta(days=7):
+		cached = None
+		fetch_from = from_day.strftime('%Y-%m-%d')
+	else:
+		fetch_from = cached.index[-1].strftime('%Y-%m-%d')
+	if fetch_from <= today_str:
+		fresh = api.polygon.historic_agg_v2(symbol, 1, 'day', _from=fetch_from, to=today_str).df
+		cache.write('day', symbol, fresh)
+	else:
+		fresh = cached.iloc[:0]
+	return merge_bars(cached, fresh)
+
+
+def get_minute_historical(symbol, num_minutes=1, api=None, cache=None, bucket=None):
+	# With a cache, read it first and only download the minutes after it.
+	# bucket, if given, is a TokenBucket to take from before each request.
+	if api is None:
+		api = get_alpaca_api()
+	now = pd.Timestamp.now(tz=NY)
+	cached = None
+	if cache is not None:
+		cached = cache.read('minute', symbol, start=now - timedelta(days=10))
+	if cached is None or len(cached) < num_minutes:
+		if bucket is not None:
+			bucket.acquire()
+		fresh = api.polygon.historic_agg(
+			size="minute", symbol=symbol, limit=num_minutes
+		).df
+	elif now - cached.index[-1] > timedelta(minutes=1):
+		if bucket is not None:
+			bucket.acquire()
+		last = cached.index[-1]
+		fresh = api.polygon.historic_agg_v2(
+			symbol, 1, 'minute', _from=last.strftime('%Y-%m-%d'), to=now.strftime('%Y-%m-%d')
+		).df
+		fresh = fresh[fresh.index > last]
+	else:
+		fresh = cached.iloc[:0]
+	if cache is not None:
+		cache.write('minute', symbol, fresh)
+	return merge_bars(cached, fresh).iloc[-num_minutes:]
+
+
+def merge_bars(cached, fresh):
+	if cached is None:
+		return fresh
+	df = pd.concat([cached, fresh])
+	return df[~df.index.duplicated(keep='last')].sort_index()
 
 
 if __name__ == '__main__':
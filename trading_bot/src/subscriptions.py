@@ -0,0 +1,112 @@
+import time
+
+
+# Which stream channels each watched symbol still needs. While it can act,
+# a symbol gets both its second bars (A.) and minute bars (AM.). Once the
+# buy window has closed and it has no position or open order, its second
+# bars can't lead to anything, so it drops to minute bars alone, which keep
+# its history current in case a position turns up (a fill, or a restart
+# picking one up), when it goes back to second bars. Idle symbols that are
+# still watched near the close are retired here, since no second bar will
+# come to retire them.
+
+SECONDS = 'seconds'
+MINUTES = 'minutes'
+
+
+def second_channel(symbol):
+	return 'A.{}'.format(symbol)
+
+
+def minute_channel(symbol):
+	return 'AM.{}'.format(symbol)
+
+
+class SubscriptionManager:
+
+	def __init__(self, engine):
+		self.engine = engine
+		# symbol: SECONDS or MINUTES, as subscribed
+		self.feeds = {}
+		# second bars seen since each symbol's A. channel was subscribed, and
+		# when that was (epoch seconds)
+		self.messages = {}
+		self.since = {}
+		# symbol: second bars per second it was getting when dropped
+		self.saved = {}
+
+	def on_second_bar(self, symbol):
+		# handlers call this for every second bar
+		if symbol in self.messages:
+			self.messages[symbol] += 1
+
+	@property
+	def saved_per_second(self):
+		# second bars a second not streamed because of dropped A. channels
+		return sum(self.saved.values())
+
+	def counts(self):
+		# symbols on each feed
+		counts = {SECONDS: 0, MINUTES: 0}
+		for feed in self.feeds.values():
+			counts[feed] += 1
+		return counts
+
+	def channels(self):
+		# everything that should be subscribed right now, e.g. on a reconnect
+		channels = []
+		for symbol, feed in sorted(self.feeds.items()):
+			if feed == SECONDS:
+				channels.append(second_channel(symbol))
+			channels.append(minute_channel(symbol))
+		return channels
+
+	def update(self, minute, now=None):
+		# Compare what each watched symbol needs at epoch minute with what it
+		# has. Returns (subscribe, unsubscribe, intents): channels to change
+		# and the Liquidate and Unwatch intents of idle symbols retired near
+		# the close, for the caller to carry out like any other intents.
+		now = time.time() if now is None else now
+		engine = self.engine
+		late = engine.clock.close_minute - minute <= 15
+		subscribe = []
+		unsubscribe = []
+		intents = []
+		for symbol in sorted(engine.symbols):
+			want = SECONDS if engine.needs_ticks(symbol, minute) else MINUTES
+			have = self.feeds.get(symbol)
+			if want == MINUTES and late:
+				intents += engine.retire(symbol)
+				continue
+			if want == have:
+				continue
+			if want == SECONDS:
+				subscribe.append(second_channel(symbol))
+				self.messages[symbol] = 0
+				self.since[symbol] = now
+				self.saved.pop(symbol, None)
+			elif have == SECONDS:
+				unsubscribe.append(second_channel(symbol))
+				self.saved[symbol] = self._rate(symbol, now)
+			if have is None:
+				subscribe.append(minute_channel(symbol))
+			self.feeds[symbol] = want
+		return subscribe, unsubscribe, intents
+
+	def unwatch(self, symbol):
+		# channels to unsubscribe for a symbol the engine has retired
+		feed = self.feeds.pop(symbol, None)
+		self.messages.pop(symbol, None)
+		self.since.pop(symbol, None)
+		# it would have stopped streaming now anyway
+		self.saved.pop(symbol, None)
+		if feed is None:
+			return []
+		if feed == SECONDS:
+			return [second_channel(symbol), minute_channel(symbol)]
+		return [minute_channel(symbol)]
+
+	def _rate(self, symbol, now):
+		count = self.messages.pop(symbol, 0)
+		elapsed = now - self.since.pop(symbol, now)
+		return count / elapsed if elapsed > 0 else 0.
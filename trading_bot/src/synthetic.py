@@ -0,0 +1,156 @@
+import numpy as np
+import pandas as pd
+
+from bar_store import MinuteBars
+from engine import Bar
+
+
+# Seeded synthetic market data in the shape the stream delivers it, for
+# benchmarks and tests. Every symbol trades a random walk from the open
+# with second bars arriving at its own rate, a burst of activity in the
+# first minutes, and now and then a minute with no trades at all; minute
+# bars are built from the second bars and arrive just after their minute,
+# interleaved with the next minute's first second bars. A share of the
+# symbols are gappers: up 6-15% on the previous close, choppy through the
+# opening range, then trending up harder and harder through the buy window
+# so the entry rules fire, and giving the run back after it so the exits do.
+#
+# The same arguments always give the same market.
+
+OPEN = pd.Timestamp('2020-01-02 09:30', tz='America/New_York')
+OPENING_MINUTES = 15
+BUY_WINDOW_END = 60
+
+
+class SyntheticMarket:
+
+	def __init__(self, symbols=100, minutes=390, seed=0, gappers=.1, gap_rate=.02, burst=3., rate=8.,
+	             history_minutes=300):
+		# symbols: how many to generate; minutes: session minutes from the
+		# open; gappers: share of symbols that gap up and trend; gap_rate:
+		# chance a minute has no trades; burst: extra activity at the open, as
+		# a multiple of the usual rate, fading over the opening range; rate:
+		# typical second bars a minute
+		rng = np.random.RandomState(seed)
+		self.minutes = minutes
+		self.open_minute = int(OPEN.timestamp()) // 60
+		self.names = ['SYM{}'.format(i) for i in range(symbols)]
+		self.gapper = rng.rand(symbols) < gappers
+		opens = np.exp(rng.uniform(np.log(5), np.log(50), symbols))
+		gap = np.where(self.gapper, rng.uniform(1.06, 1.15, symbols), 1 + rng.normal(0, .01, symbols))
+		self.prev_close = opens / gap
+		# shares traded before the bot starts watching
+		self.volume = np.where(self.gapper, rng.uniform(50000, 500000, symbols), rng.uniform(5000, 100000, symbols))
+		rates = rate * np.exp(rng.normal(0, .5, symbols)) * np.where(self.gapper, 3, 1)
+		sigmas = .0004 * np.exp(rng.normal(0, .3, symbols)) * np.where(self.gapper, .5, 1)
+
+		self.history = {}
+		columns = []
+		for i, name in enumerate(self.names):
+			self.history[name] = self._history(rng, self.prev_close[i], sigmas[i], history_minutes)
+			columns.append(self._session(rng, i, opens[i], sigmas[i], rates[i], gap_rate, burst))
+		# deliver everything in arrival order; at the same ms, minute bars first
+		columns = [np.concatenate(column) for column in zip(*columns)]
+		order = np.lexsort((columns[1], columns[0]))
+		(self.arrivals, self.kinds, self.symbols, self.opens, self.highs, self.lows, self.closes,
+		 self.volumes, self.starts) = [column[order] for column in columns]
+
+	def __len__(self):
+		return len(self.arrivals)
+
+	def _history(self, rng, prev_close, sigma, n):
+		# n minute bars before the open ending at prev_close
+		steps = rng.normal(0, sigma * np.sqrt(60), n)
+		closes = prev_close * np.exp(np.cumsum(steps) - steps.sum())
+		opens = np.concatenate([[closes[0]], closes[:-1]])
+		spread = np.abs(rng.normal(0, sigma * 4, n)) * closes
+		history = MinuteBars()
+		history.load(
+			np.arange(self.open_minute - n, self.open_minute), opens, np.maximum(opens, closes) + spread,
+			np.minimum(opens, closes) - spread, closes, rng.uniform(500, 5000, n).round()
+		)
+		return history
+
+	def _drift(self, gapper):
+		# per-second log drift for each session second
+		minute = np.arange(self.minutes * 60) // 60
+		if not gapper:
+			return np.zeros(len(minute))
+		# rising faster each minute through the buy window, then giving it
+		# all back over as many minutes and going flat
+		run = BUY_WINDOW_END - OPENING_MINUTES
+		rise = np.clip(minute - OPENING_MINUTES, 0, run)
+		fall = np.clip(BUY_WINDOW_END + run - 1 - minute, 0, run - 1)
+		slope = np.where(minute < BUY_WINDOW_END, rise, -fall)
+		return slope * 2e-4 / 60
+
+	def _session(self, rng, i, open, sigma, rate, gap_rate, burst):
+		# this symbol's second and minute bars as columns of (arrival ms,
+		# kind, symbol index, open, high, low, close, volume, start ms); kind
+		# is 0 for minute bars and 1 for second bars
+		n = self.minutes * 60
+		prices = open * np.exp(np.cumsum(rng.normal(0, sigma, n) + self._drift(self.gapper[i])))
+		minute = np.arange(self.minutes)
+		activity = rate * (1 + burst * np.exp(-minute / (OPENING_MINUTES / 3)))
+		counts = np.minimum(rng.poisson(activity), 60)
+		counts[rng.rand(self.minutes) < gap_rate] = 0
+		# which seconds of each minute trade
+		seconds = np.concatenate([
+			m * 60 + np.sort(rng.choice(60, count, replace=False)) for m, count in zip(minute, counts) if count
+		] or [np.zeros(0, dtype=int)])
+		closes = prices[seconds]
+		opens = np.concatenate([[open], prices[seconds[:-1]]]) if len(seconds) else closes
+		wiggle = np.abs(rng.normal(0, sigma, len(seconds))) * closes
+		highs = np.maximum(opens, closes) + wiggle
+		lows = np.minimum(opens, closes) - wiggle
+		volumes = np.round(rng.lognormal(5, 1, len(seconds)) * (3 if self.gapper[i] else 1))
+		starts = (self.open_minute * 60 + seconds) * 1000
+
+		# minute bars from the second bars of each traded minute
+		traded = np.flatnonzero(counts)
+		bounds = np.concatenate([[0], np.cumsum(counts[traded])])
+		first, last = bounds[:-1], bounds[1:] - 1
+		minute_starts = (self.open_minute + traded) * 60000
+		if len(traded):
+			minute_highs = np.maximum.reduceat(highs, first)
+			minute_lows = np.minimum.reduceat(lows, first)
+			minute_volumes = np.add.reduceat(volumes, first)
+		else:
+			minute_highs = minute_lows = minute_volumes = np.zeros(0)
+		# a second bar arrives as its second ends, a minute bar up to two
+		# seconds after its minute does
+		return (
+			np.concatenate([starts + 1000, minute_starts + 60000 + rng.randint(0, 2000, len(traded))]),
+			np.concatenate([np.ones(len(seconds), dtype=int), np.zeros(len(traded), dtype=int)]),
+			np.full(len(seconds) + len(traded), i),
+			np.concatenate([opens, opens[first]]),
+			np.concatenate([highs, minute_highs]),
+			np.concatenate([lows, minute_lows]),
+			np.concatenate([closes, closes[last]]),
+			np.concatenate([volumes, minute_volumes]),
+			np.concatenate([starts, minute_starts]),
+		)
+
+	def header(self):
+		# the session and watch lines of a recording, as replay.build_engine reads them
+		events = [{
+			'ev': 'session', 'open': OPEN.isoformat(), 'close': (OPEN + pd.Timedelta(minutes=390)).isoformat()
+		}]
+		events += [
+			{'ev': 'watch', 'symbol': name, 'prev_close': float(prev_close), 'volume': float(volume)}
+			for name, prev_close, volume in zip(self.names, self.prev_close, self.volume)
+		]
+		return events
+
+	def bars(self):
+		# (channel, Bar) in arrival order
+		names = self.names
+		for kind, symbol, o, h, l, c, v, start in zip(
+				self.kinds.tolist(), self.symbols.tolist(), self.opens.tolist(), self.highs.tolist(),
+				self.lows.tolist(), self.closes.tolist(), self.volumes.tolist(), self.starts.tolist()
+		):
+			yield ('A' if kind else 'AM'), Bar(names[symbol], o, h, l, c, v, start)
+
+	def recording(self):
+		# the whole market as recording lines, e.g. for replay.py
+		return self.header() + [dict(bar._asdict(), ev=channel) for channel, bar in self.bars()]
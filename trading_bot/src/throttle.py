@@ -0,0 +1,33 @@
+import threading
+import time
+
+
+class TokenBucket:
+	# `rate` requests per second with bursts of up to `capacity`; the default
+	# of 1 spaces requests evenly. reserve() books a token and returns how long
+	# the caller has to wait before using it, so threads can sleep on it and
+	# coroutines can await it. Tokens may go negative; later callers then
+	# queue behind the debt.
+
+	def __init__(self, rate, capacity=1):
+		self.rate = float(rate)
+		self.capacity = float(capacity)
+		self._tokens = self.capacity
+		self._last = time.monotonic()
+		self._lock = threading.Lock()
+
+	def reserve(self, n=1):
+		with self._lock:
+			now = time.monotonic()
+			self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+			self._last = now
+			self._tokens -= n
+			if self._tokens >= 0:
+				return 0.
+			return -self._tokens / self.rate
+
+	def acquire(self, n=1):
+		delay = self.reserve(n)
+		if delay > 0:
+			time.sleep(delay)
+		return delay
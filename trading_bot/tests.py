@@ -1,3 +1,1414 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import time
 
-# Create your tests here.
+import numpy as np
+import pandas as pd
+from django.test import RequestFactory, SimpleTestCase
+from ta.trend import macd
+
+# the bot's modules live in src/ and import each other as top-level modules
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src'))
+
+from backtest import Panel, backtest  # noqa: E402
+from bar_cache import BarCache  # noqa: E402
+from bar_store import MinuteBars  # noqa: E402
+from bar_writer import BarWriter, CacheBackend, MemoryBackend, SQLiteBackend  # noqa: E402
+from decode import BarRecord, FastPolygonStream, decode_bars, decode_frame  # noqa: E402
+from engine import Bar, Cancel, Liquidate, StaticAccount, StrategyEngine, Submit, Unwatch  # noqa: E402
+from fetcher import fetch_all, retry_delay  # noqa: E402
+from gateway import OrderGateway  # noqa: E402
+from ingest import DAILY_COLUMNS, CsvSink, UpsertWriter, Watermarks, backfill, ingest_daily  # noqa: E402
+from inbox import ConflatingInbox  # noqa: E402
+from journal import Journal, reconcile  # noqa: E402
+from indicators import IndicatorState, StreamingMACD, macd_2d, valley_lows  # noqa: E402
+from metrics import Histogram, Metrics, read_snapshot, report  # noqa: E402
+from reconnect import StreamSupervisor, minute_recovery  # noqa: E402
+import stock_data  # noqa: E402
+from session import SessionClock, SessionState, TradingCalendar  # noqa: E402
+from screener import Screener, snapshot_frame, tradable_symbols  # noqa: E402
+from scheduler import ENTRY, EXIT, LIQUIDATE, READ, RequestScheduler  # noqa: E402
+from replay import PaperBroker, ReplayAdapter, build_engine  # noqa: E402
+from shards import ShardRouter, ShardWorker, partition, replay_sharded, shard_of  # noqa: E402
+from synthetic import SyntheticMarket  # noqa: E402
+from throttle import TokenBucket  # noqa: E402
+from subscriptions import MINUTES, SECONDS, SubscriptionManager  # noqa: E402
+
+
+def random_closes(n, seed=0):
+    rng = np.random.RandomState(seed)
+    return 20 + np.cumsum(rng.normal(0, 0.05, n))
+
+
+class StreamingMACDTests(SimpleTestCase):
+
+    def assertMatchesTa(self, values, closes, n_fast, n_slow):
+        expected = macd(pd.Series(closes), n_fast=n_fast, n_slow=n_slow).values[-len(values):]
+        np.testing.assert_array_equal(np.array(values), expected)
+
+    def test_load_matches_ta(self):
+        closes = random_closes(1000)
+        for n_fast, n_slow in ((12, 26), (40, 60), (12, 21)):
+            m = StreamingMACD(n_fast, n_slow)
+            m.load(closes)
+            self.assertMatchesTa(m.tail(), closes, n_fast, n_slow)
+
+    def test_short_history_is_nan(self):
+        m = StreamingMACD(40, 60)
+        m.load(random_closes(30))
+        self.assertTrue(all(np.isnan(m.tail())))
+
+    def test_provisional_updates_match_ta(self):
+        # replay history the way the stream delivers it: several second-bar
+        # closes per minute, then the minute bar's close
+        closes = random_closes(400, seed=1)
+        state = IndicatorState()
+        state.load(range(300), closes[:300])
+        rng = np.random.RandomState(2)
+        for minute in range(300, 400):
+            for ticks in range(3):
+                provisional = closes[minute] + rng.normal(0, 0.02)
+                self.assertTrue(state.update(minute, provisional))
+                series = np.append(closes[:minute], provisional)
+                for window, m in state.macd.items():
+                    self.assertMatchesTa(m.tail(), series, *window)
+            self.assertTrue(state.commit(minute, closes[minute]))
+        for window, m in state.macd.items():
+            self.assertMatchesTa(m.tail(), closes, *window)
+
+    def test_late_minute_bar_amends_committed_minute(self):
+        closes = random_closes(200, seed=3)
+        state = IndicatorState()
+        state.load(range(198), closes[:198])
+        # the next minute starts before minute 198's bar arrives
+        state.update(198, closes[198] + 0.1)
+        state.update(199, closes[199])
+        self.assertTrue(state.commit(198, closes[198]))
+        for window, m in state.macd.items():
+            self.assertMatchesTa(m.tail(), closes, *window)
+        self.assertFalse(state.commit(150, closes[150]))
+
+
+class VectorizedIndicatorTests(SimpleTestCase):
+
+    def test_macd_2d_matches_ta_per_row(self):
+        closes = np.vstack([random_closes(300, seed=i) for i in range(3)])
+        closes[1, 100:110] = np.nan
+        values = macd_2d(closes, 12, 26)
+        for row, close in zip(values, closes):
+            expected = macd(pd.Series(close).dropna(), n_fast=12, n_slow=26).values
+            np.testing.assert_array_equal(row[~np.isnan(close)], expected)
+
+    def test_valley_lows_match_find_stop_windows(self):
+        lows = np.round(np.vstack([random_closes(300, seed=i) for i in range(3)]), 1)
+        values = valley_lows(lows, lookback=100)
+        for row, low in zip(values, lows):
+            for t in range(len(low)):
+                series = low[max(0, t - 99):t + 1]
+                diff = np.diff(series)
+                valleys = np.where((diff[:-1] <= 0) & (diff[1:] > 0))[0] + 1
+                if len(valleys):
+                    self.assertEqual(row[t], series[valleys[-1]])
+                else:
+                    self.assertTrue(np.isnan(row[t]))
+
+
+class BacktestTests(SimpleTestCase):
+
+    def test_entry_stop_and_forced_liquidation(self):
+        minute = np.arange(390)
+        quiet = np.full(390, 10.)
+        # a gapper that breaks out, then falls through its stop at 10:40
+        stopped = 10.5 + .0005 * minute ** 2
+        stopped[70:] = 5.
+        # one that breaks out, then has no bars after 11:09
+        halted = 5.5 + .00025 * minute ** 2
+        halted[100:] = np.nan
+        close = np.stack([quiet, stopped, halted])[None]
+        volume = np.where(np.isnan(close), 0., 1000.)
+        days = pd.to_datetime(['2020-01-02', '2020-01-03', '2020-01-06']).values
+        panel = Panel(np.array(['AAA']), days, close, close + .01, close - .01, close, volume)
+        trades = backtest(panel)
+        self.assertEqual(list(trades['day']), list(days[1:]))
+        self.assertEqual(list(trades['entry_minute']), [30, 33])
+        # the stop exit, then the halted one closed at its last bar
+        self.assertEqual(list(trades['exit_minute']), [70, 99])
+        self.assertEqual(list(trades['exit_price']), [5., halted[99]])
+        self.assertLess(trades['exit_price'][0], trades['stop'][0])
+        self.assertAlmostEqual(trades['pnl'][1], trades['shares'][1] * (halted[99] - trades['entry_price'][1]))
+
+
+class MinuteBarsTests(SimpleTestCase):
+
+    def test_ring_keeps_newest_bars(self):
+        bars = MinuteBars(capacity=5)
+        for minute in range(10):
+            bars.set_bar(minute, 1, 2, minute, 1.5, 100)
+        self.assertEqual(list(bars.column('minute')), [5, 6, 7, 8, 9])
+        self.assertEqual(list(bars.lows(3)), [7, 8, 9])
+        self.assertNotIn(4, bars)
+
+    def test_merge_aggregates_partial_bars(self):
+        bars = MinuteBars()
+        self.assertTrue(bars.merge_bar(1, 10, 11, 9, 10.5, 100))
+        self.assertFalse(bars.merge_bar(1, 10.5, 12, 9.5, 11, 50))
+        self.assertEqual(bars.get(1), (10, 12, 9, 11, 150))
+
+    def test_late_bar_is_inserted_in_order(self):
+        bars = MinuteBars()
+        for minute in (1, 2, 5, 6):
+            bars.set_bar(minute, minute, minute, minute, minute, 1)
+        self.assertTrue(bars.set_bar(3, 3, 3, 3, 3, 1))
+        self.assertEqual(list(bars.closes()), [1, 2, 3, 5, 6])
+        self.assertEqual(bars.high_between(2, 5), 5)
+        self.assertTrue(np.isnan(bars.high_between(7, 20)))
+
+
+class BarWriterTests(SimpleTestCase):
+
+    def write(self, writer, rows):
+        async def produce():
+            for row in rows:
+                while writer.depth >= writer.max_queue:
+                    await asyncio.sleep(0)
+                writer.put(row)
+            await writer.close()
+        asyncio.run(produce())
+
+    def test_close_drains_queue_in_batches(self):
+        backend = MemoryBackend()
+        writer = BarWriter(backend, batch_size=10, max_queue=5, flush_interval=60)
+        rows = [(i, 'SYM') for i in range(95)]
+        self.write(writer, rows)
+        self.assertEqual(backend.rows, rows)
+        self.assertEqual(backend.batches, 10)
+        self.assertEqual(writer.written, 95)
+
+    def test_sqlite_backend_writes_multi_row_inserts(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'bars.db')
+            writer = BarWriter(SQLiteBackend(path), table='bars', columns=('minute', 'symbol'), batch_size=1000)
+            rows = [(i, 'SYM') for i in range(2500)]
+            self.write(writer, rows)
+            conn = sqlite3.connect(path)
+            self.assertEqual(conn.execute('SELECT * FROM bars').fetchall(), rows)
+            conn.close()
+
+    def test_cache_backend_writes_each_symbol_to_the_cache(self):
+        with tempfile.TemporaryDirectory() as root:
+            cache = BarCache(root)
+            start = pd.Timestamp('2020-01-02 09:30', tz='America/New_York')
+            rows = [
+                ((start + pd.Timedelta(minutes=i)).to_pydatetime(), symbol, 1., 3., 1., i, 100.)
+                for i in range(5) for symbol in ('AAA', 'BBB')
+            ]
+            self.write(BarWriter(CacheBackend(cache), batch_size=4), rows)
+            for symbol in ('AAA', 'BBB'):
+                cached = cache.read('minute', symbol)
+                self.assertEqual(list(cached.index), [row[0] for row in rows if row[1] == symbol])
+                self.assertEqual(list(cached['close']), [0, 1, 2, 3, 4])
+
+    def test_full_queue_drops_rows_instead_of_waiting(self):
+        backend = MemoryBackend()
+        writer = BarWriter(backend, max_queue=5)
+
+        async def produce():
+            for i in range(20):
+                writer.put((i, 'SYM'))
+            await writer.close()
+        asyncio.run(produce())
+        self.assertEqual(backend.rows, [(i, 'SYM') for i in range(5)])
+        self.assertEqual(writer.dropped, 15)
+
+    def test_unreachable_backend_neither_blocks_nor_hangs_close(self):
+        class DownBackend(MemoryBackend):
+            opens = 0
+
+            async def open(self, loop):
+                self.opens += 1
+                raise OSError('unreachable')
+
+        backend = DownBackend()
+        writer = BarWriter(backend, max_queue=5)
+
+        async def produce():
+            writer.put((0, 'SYM'))
+            # into the backoff after the first failed open
+            await asyncio.sleep(0.01)
+            for i in range(1, 20):
+                writer.put((i, 'SYM'))
+            await asyncio.wait_for(writer.close(), 1)
+        asyncio.run(produce())
+        self.assertEqual(backend.opens, 1)
+        self.assertEqual(backend.rows, [])
+        self.assertEqual(writer.dropped, 20)
+
+
+class FakeResponse:
+
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+class FakeHTTPError(Exception):
+
+    def __init__(self, status_code, retry_after=None):
+        super().__init__(status_code)
+        self.response = FakeResponse(status_code, {} if retry_after is None else {'Retry-After': retry_after})
+
+
+class FetchTests(SimpleTestCase):
+
+    def test_retry_delay_honours_retry_after_on_429(self):
+        self.assertEqual(retry_delay(FakeHTTPError(429, '7'), 0), 7)
+        self.assertEqual(retry_delay(FakeHTTPError(429, 'soon'), 1), 1)
+        self.assertEqual(retry_delay(FakeHTTPError(500, '7'), 2), 2)
+        self.assertEqual(retry_delay(ValueError(), 0), .5)
+
+    def test_retries_until_success(self):
+        calls = {}
+
+        def fetch(key):
+            calls[key] = calls.get(key, 0) + 1
+            if calls[key] < 3:
+                raise FakeHTTPError(429, '0')
+            return key * 2
+        results, failures = fetch_all(['a', 'b'], fetch, workers=2, retries=3)
+        self.assertEqual(results, {'a': 'aa', 'b': 'bb'})
+        self.assertEqual(failures, {})
+        self.assertEqual(calls, {'a': 3, 'b': 3})
+
+    def test_failures_returned_after_retries(self):
+        calls = []
+
+        def fetch(key):
+            calls.append(key)
+            if key == 'bad':
+                raise FakeHTTPError(429, '0')
+            return key
+        progress = []
+        results, failures = fetch_all(
+            ['ok', 'bad'], fetch, retries=2, progress=lambda done, total: progress.append((done, total))
+        )
+        self.assertEqual(results, {'ok': 'ok'})
+        self.assertEqual(list(failures), ['bad'])
+        self.assertIsInstance(failures['bad'], FakeHTTPError)
+        self.assertEqual(calls.count('bad'), 3)
+        self.assertEqual(progress, [(1, 2), (2, 2)])
+
+    def test_on_result_exception_counts_as_failure(self):
+        handled = {}
+
+        def on_result(key, result):
+            if key == 'b':
+                raise ValueError('bad row')
+            handled[key] = result
+        results, failures = fetch_all(['a', 'b', 'c'], str.upper, on_result=on_result)
+        self.assertEqual(results, {})
+        self.assertEqual(handled, {'a': 'A', 'c': 'C'})
+        self.assertEqual(list(failures), ['b'])
+        self.assertIsInstance(failures['b'], ValueError)
+
+    def test_token_bucket_spaces_requests(self):
+        bucket = TokenBucket(100)
+        delays = [bucket.reserve() for _ in range(4)]
+        self.assertEqual(delays[0], 0)
+        for i, delay in enumerate(delays[1:], 1):
+            self.assertAlmostEqual(delay, i / 100, delta=.005)
+
+    def test_token_bucket_allows_bursts_up_to_capacity(self):
+        bucket = TokenBucket(100, capacity=3)
+        delays = [bucket.reserve() for _ in range(5)]
+        self.assertEqual(delays[:3], [0, 0, 0])
+        self.assertAlmostEqual(delays[3], .01, delta=.005)
+        self.assertAlmostEqual(delays[4], .02, delta=.005)
+        # the debt is paid off and the burst refilled at rate
+        time.sleep(.06)
+        self.assertEqual([bucket.reserve() for _ in range(3)], [0, 0, 0])
+
+    def test_token_bucket_acquire_sleeps_off_the_delay(self):
+        bucket = TokenBucket(50)
+        start = time.monotonic()
+        for _ in range(3):
+            bucket.acquire()
+        self.assertGreaterEqual(time.monotonic() - start, .035)
+
+
+class BarCacheTests(SimpleTestCase):
+
+    def frame(self, start, periods, close=2.):
+        index = pd.date_range(start, periods=periods, freq='min', tz='America/New_York')
+        return pd.DataFrame({
+            'open': 1., 'high': 3., 'low': 1., 'close': close, 'volume': 100.
+        }, index=index)
+
+    def test_round_trip_across_partitions(self):
+        with tempfile.TemporaryDirectory() as root:
+            cache = BarCache(root)
+            df = pd.concat([self.frame('2020-01-02 15:55', 5), self.frame('2020-01-03 09:30', 5)])
+            cache.write('minute', 'AAA', df)
+            self.assertEqual(sorted(os.listdir(os.path.join(root, 'minute', 'AAA'))), ['2020-01-02.npy', '2020-01-03.npy'])
+            cached = cache.read('minute', 'AAA')
+            self.assertTrue((cached.index == df.index).all())
+            self.assertTrue((cached.values == df.values).all())
+            self.assertEqual(len(cache.read('minute', 'AAA', start='2020-01-03 09:32')), 3)
+
+    def test_new_rows_replace_cached_ones(self):
+        with tempfile.TemporaryDirectory() as root:
+            cache = BarCache(root)
+            cache.write('minute', 'AAA', self.frame('2020-01-02 09:30', 5))
+            cache.write('minute', 'AAA', self.frame('2020-01-02 09:33', 4, close=5.))
+            self.assertEqual(list(cache.read('minute', 'AAA')['close']), [2, 2, 2, 5, 5, 5, 5])
+            self.assertEqual(cache.evict(), 1)
+
+    def test_daily_bar_cached_mid_session_is_replaced(self):
+        polygon = FakeDailyPolygon()
+        api = type('API', (), {'polygon': polygon})()
+        start = pd.Timestamp('2020-01-02', tz='America/New_York')
+        with tempfile.TemporaryDirectory() as root:
+            cache = BarCache(root)
+            # read while 2020-01-06 is still trading: its bar is partial
+            first = stock_data.get_cached_daily(api, cache, 'AAA', start, '2020-01-06')
+            self.assertEqual(list(first['close']), [1, 2, 3, 4, 5])
+            # the next read fetches that day again and the final bar wins
+            second = stock_data.get_cached_daily(api, cache, 'AAA', start, '2020-01-06')
+            self.assertEqual(polygon.requests[-1], ('AAA', '2020-01-06', '2020-01-06'))
+            self.assertEqual(list(second['close']), [1, 2, 3, 4, 1])
+            self.assertEqual(list(cache.read('day', 'AAA')['close']), [1, 2, 3, 4, 1])
+            stock_data.get_cached_daily(api, cache, 'AAA', start, '2020-01-07')
+            self.assertEqual(polygon.requests[-1], ('AAA', '2020-01-06', '2020-01-07'))
+
+
+class StrategyEngineTests(SimpleTestCase):
+    open_dt = pd.Timestamp('2020-01-02 09:30', tz='America/New_York')
+
+    def engine(self, account=None, batch=False):
+        clock = SessionClock.from_datetimes(self.open_dt, self.open_dt + pd.Timedelta(minutes=390))
+        engine = StrategyEngine(clock, account or StaticAccount(100000.), batch)
+        self.watch_gapper(engine, 'AAA', .0001)
+        return engine
+
+    def watch_gapper(self, engine, symbol, rate):
+        # a gapper climbing faster every minute up to 09:49
+        start = int(self.open_dt.timestamp()) // 60 - 280
+        minutes = np.arange(start, start + 300)
+        closes = 10 + rate * np.arange(300) ** 2
+        history = MinuteBars()
+        history.load(minutes, closes, closes + .01, closes - .01, closes, np.full(300, 1000.))
+        engine.watch(symbol, history, prev_close=10., volume=50000)
+
+    def bar(self, minute, close, second=0, symbol='AAA'):
+        start = (int(self.open_dt.timestamp()) + minute * 60 + second) * 1000
+        return Bar(symbol, close, close, close, close, 100, start)
+
+    def test_buy_fill_and_stop_out(self):
+        engine = self.engine()
+        intents = engine.on_second_bar(self.bar(20, 19.1))
+        self.assertEqual(intents, [Submit('AAA', 52, 'buy', 'limit', 19.1)])
+        self.assertAlmostEqual(engine.stop_prices['AAA'], 19.1 * .95)
+        # nothing more while the order is open
+        self.assertEqual(engine.on_second_bar(self.bar(20, 19.2, 5)), [])
+        broker = PaperBroker()
+        broker.execute(engine, intents, self.bar(20, 19.1).start // 1000)
+        self.assertEqual(engine.positions['AAA'], 52)
+        self.assertIsNone(engine.open_orders['AAA'])
+        # below the stop after the buy window
+        self.assertEqual(engine.on_second_bar(self.bar(61, 18)), [Submit('AAA', 52, 'sell', 'limit', 18)])
+
+    def test_stale_order_is_cancelled(self):
+        engine = self.engine()
+        self.assertEqual(len(engine.on_second_bar(self.bar(20, 19.1))), 1)
+        # the broker's own timestamp type is converted once, on acknowledgement
+        submitted_at = self.open_dt + pd.Timedelta(minutes=20, seconds=30)
+        order = type('Order', (), {'id': 'x1', 'submitted_at': submitted_at})
+        engine.on_order_submitted('AAA', order)
+        self.assertEqual(engine.on_second_bar(self.bar(20, 19.1, 45)), [])
+        self.assertEqual(engine.on_second_bar(self.bar(23, 19.1, 45)), [Cancel('AAA', 'x1')])
+        engine.on_trade_update('canceled', {'symbol': 'AAA'})
+        self.assertIsNone(engine.open_orders['AAA'])
+
+    def test_batch_mode_enters_when_the_minute_closes(self):
+        engine = self.engine(batch=True)
+        self.assertEqual(engine.on_second_bar(self.bar(20, 19.1)), [])
+        self.assertEqual(engine.on_second_bar(self.bar(21, 19.2)), [Submit('AAA', 52, 'buy', 'limit', 19.1)])
+        self.assertAlmostEqual(engine.stop_prices['AAA'], 19.1 * .95)
+
+    def test_batch_entries_ranked_within_cash(self):
+        engine = self.engine(StaticAccount(100000., cash=1000.), batch=True)
+        self.watch_gapper(engine, 'BBB', .0002)
+        engine.on_second_bar(self.bar(20, 19.1))
+        engine.on_second_bar(self.bar(20, 28.2, symbol='BBB'))
+        self.assertEqual([c.symbol for c in engine.rank_entries(['AAA', 'BBB'])], ['BBB', 'AAA'])
+        # both qualify, but cash covers only the stronger one
+        self.assertEqual(engine.on_second_bar(self.bar(21, 19.2)), [Submit('BBB', 35, 'buy', 'limit', 28.2)])
+
+    def test_liquidates_once_at_close(self):
+        engine = self.engine()
+        self.assertEqual(engine.on_second_bar(self.bar(376, 19)), [Liquidate('AAA'), Unwatch('AAA')])
+        self.assertTrue(engine.done)
+        self.assertEqual(engine.on_second_bar(self.bar(377, 19)), [])
+
+    def test_idle_symbols_drop_to_minute_bars(self):
+        engine = self.engine()
+        self.watch_gapper(engine, 'BBB', .0001)
+        subscriptions = SubscriptionManager(engine)
+        open_minute = engine.open_minute
+        subscribe, unsubscribe, intents = subscriptions.update(open_minute + 20, now=0)
+        self.assertEqual(subscribe, ['A.AAA', 'AM.AAA', 'A.BBB', 'AM.BBB'])
+        for _ in range(30):
+            subscriptions.on_second_bar('BBB')
+        # the buy window has closed and only AAA holds a position
+        engine.add_position('AAA', 10, 19.)
+        subscribe, unsubscribe, intents = subscriptions.update(open_minute + 60, now=10)
+        self.assertEqual((subscribe, unsubscribe, intents), ([], ['A.BBB'], []))
+        self.assertEqual(subscriptions.counts(), {SECONDS: 1, MINUTES: 1})
+        self.assertEqual(subscriptions.saved_per_second, 3.)
+        self.assertEqual(subscriptions.channels(), ['A.AAA', 'AM.AAA', 'AM.BBB'])
+        # a position brings the second bars back
+        engine.positions['BBB'] = 5
+        subscribe, unsubscribe, intents = subscriptions.update(open_minute + 61, now=20)
+        self.assertEqual((subscribe, unsubscribe), (['A.BBB'], []))
+        self.assertEqual(subscriptions.saved_per_second, 0)
+        # idle near the close, BBB is retired without waiting for a second bar
+        engine.positions['BBB'] = 0
+        subscribe, unsubscribe, intents = subscriptions.update(open_minute + 380, now=30)
+        self.assertEqual(intents, [Liquidate('BBB'), Unwatch('BBB')])
+        self.assertEqual(subscriptions.unwatch('BBB'), ['A.BBB', 'AM.BBB'])
+        self.assertEqual(engine.symbols, {'AAA'})
+
+    def test_replay_runs_recorded_events(self):
+        start = int(self.open_dt.timestamp()) * 1000
+        events = [
+            {'ev': 'session', 'open': self.open_dt.isoformat(), 'close': (self.open_dt + pd.Timedelta(minutes=390)).isoformat()},
+            {'ev': 'watch', 'symbol': 'AAA', 'prev_close': 10., 'volume': 50000},
+        ]
+        for i in range(30):
+            bar = {'symbol': 'AAA', 'open': 11., 'high': 11., 'low': 11., 'close': 11., 'volume': 100, 'start': start + i * 60000}
+            events.append(dict(bar, ev='A'))
+            events.append(dict(bar, ev='AM'))
+        stats = ReplayAdapter(build_engine(events)).run(events)
+        self.assertEqual(stats.events, 60)
+        self.assertEqual(len(stats.latencies['AM']), 30)
+        self.assertGreater(stats.events_per_second, 0)
+
+
+class FakeBroker:
+
+    def __init__(self, latency=0.05):
+        self.latency = latency
+        self.accounts = 0
+        self.cash = '10000'
+
+    def get_account(self):
+        self.accounts += 1
+        time.sleep(self.latency)
+        return type('Account', (), {'portfolio_value': '20000', 'cash': self.cash})
+
+    def submit_order(self, symbol, qty, side, time_in_force, limit_price=None, **kwargs):
+        time.sleep(self.latency)
+        return type('Order', (), {'id': 'o1', 'symbol': symbol, 'qty': qty})
+
+
+class OrderGatewayTests(SimpleTestCase):
+
+    def test_submit_does_not_block_the_loop(self):
+        gateway = OrderGateway(FakeBroker(latency=0.2))
+        gateway.load()
+        ticks = []
+
+        async def ticker():
+            for _ in range(10):
+                ticks.append(time.monotonic())
+                await asyncio.sleep(0.01)
+
+        async def main():
+            return await asyncio.gather(
+                gateway.submit_order('AAA', 10, 'buy', 'limit', limit_price=20), ticker()
+            )
+
+        order, _ = asyncio.run(main())
+        self.assertEqual(order.id, 'o1')
+        self.assertLess(max(np.diff(ticks)), 0.1)
+        gateway.close()
+
+    def test_cash_tracks_reservations_and_fills(self):
+        gateway = OrderGateway(FakeBroker(latency=0))
+        gateway.load()
+        asyncio.run(gateway.submit_order('AAA', 10, 'buy', 'limit', limit_price=20))
+        self.assertEqual(gateway.cash, 9800)
+        order = {'id': 'o1', 'symbol': 'AAA', 'side': 'buy', 'qty': '10', 'limit_price': '20',
+                 'filled_qty': '4', 'filled_avg_price': '19.5'}
+        gateway.on_trade_update('partial_fill', order)
+        self.assertEqual(gateway.cash, 10000 - 78 - 120)
+        gateway.on_trade_update('fill', dict(order, filled_qty='10', filled_avg_price='19.8'))
+        self.assertEqual(gateway.cash, 10000 - 198)
+        self.assertEqual(gateway.portfolio_value, 20000)
+        gateway.close()
+
+    def test_stale_snapshot_refreshes_in_background(self):
+        broker = FakeBroker(latency=0)
+        gateway = OrderGateway(broker, ttl=0.05)
+        gateway.load()
+
+        async def main():
+            gateway.portfolio_value
+            time.sleep(0.06)
+            broker.cash = '5000'
+            self.assertEqual(gateway.cash, 10000)
+            await gateway._refresh_task
+            return gateway.cash
+
+        self.assertEqual(asyncio.run(main()), 5000)
+        self.assertEqual(broker.accounts, 2)
+        gateway.close()
+
+
+class RequestSchedulerTests(SimpleTestCase):
+
+    def test_exits_jump_queued_entries(self):
+        scheduler = RequestScheduler(rate=50)
+        sent = []
+
+        async def request(name):
+            sent.append(name)
+
+        async def main():
+            futures = [scheduler.schedule(ENTRY, request, 'entry{}'.format(i)) for i in range(3)]
+            futures.append(scheduler.schedule(EXIT, request, 'stop'))
+            futures.append(scheduler.schedule(LIQUIDATE, request, 'liquidate'))
+            await asyncio.gather(*futures)
+            await scheduler.close()
+
+        asyncio.run(main())
+        self.assertEqual(sent, ['liquidate', 'stop', 'entry0', 'entry1', 'entry2'])
+        metrics = scheduler.metrics()
+        self.assertEqual(metrics['sent'], 5)
+        self.assertEqual(metrics['depth'], 0)
+        self.assertGreater(metrics['throttled'], 0)
+        self.assertGreater(metrics['wait_max'], 0.05)
+
+    def test_same_key_is_sent_once(self):
+        scheduler = RequestScheduler(rate=1000)
+        calls = []
+
+        async def request(order_id):
+            calls.append(order_id)
+            await asyncio.sleep(0.01)
+            return 'filled'
+
+        async def main():
+            futures = [scheduler.schedule(READ, request, 'o1', key=('order', 'o1')) for _ in range(5)]
+            results = await asyncio.gather(*futures)
+            await scheduler.close()
+            return results
+
+        self.assertEqual(asyncio.run(main()), ['filled'] * 5)
+        self.assertEqual(calls, ['o1'])
+        self.assertEqual(scheduler.merged, 4)
+
+    def test_gateway_sends_each_cancel_once(self):
+        broker = FakeBroker(latency=0)
+        broker.cancel_order = lambda order_id: broker.__dict__.setdefault('cancels', []).append(order_id)
+        scheduler = RequestScheduler(rate=1000)
+        gateway = OrderGateway(broker, scheduler=scheduler)
+
+        async def main():
+            await asyncio.gather(*[gateway.cancel_order('o1') for _ in range(3)])
+            await gateway.cancel_order('o1')
+            await scheduler.close()
+
+        asyncio.run(main())
+        self.assertEqual(broker.cancels, ['o1'])
+        gateway.close()
+
+
+def raw_tickers(n, seed=0):
+    rng = np.random.RandomState(seed)
+    return [{
+        'ticker': 'SYM{}'.format(i),
+        'lastTrade': {'p': rng.uniform(1, 80)},
+        'prevDay': {'c': 10., 'v': rng.uniform(0, 500000)},
+        'day': {'v': 1000.},
+        'todaysChangePerc': rng.normal(0, 4),
+    } for i in range(n)]
+
+
+class FakeAssetAPI:
+
+    def __init__(self, symbols):
+        self.symbols = symbols
+        self.calls = 0
+
+    def list_assets(self):
+        self.calls += 1
+        return [type('Asset', (), {'symbol': symbol, 'tradable': symbol != 'SYM1'}) for symbol in self.symbols]
+
+
+class ScreenerTests(SimpleTestCase):
+
+    def test_masks_match_the_per_ticker_filter(self):
+        tickers = raw_tickers(2000)
+        api = FakeAssetAPI([t['ticker'] for t in tickers])
+        with tempfile.TemporaryDirectory() as root:
+            screener = Screener(api, asset_path=os.path.join(root, 'assets.json'))
+            screened = screener.screen(snapshot_frame(tickers))
+        tradable = {t['ticker'] for t in tickers} - {'SYM1'}
+        expected = [t['ticker'] for t in tickers if (
+            t['ticker'] in tradable and
+            5.0 <= t['lastTrade']['p'] <= 50 and
+            t['prevDay']['v'] * t['lastTrade']['p'] > 1000000 and
+            t['todaysChangePerc'] >= 3.5
+        )]
+        self.assertGreater(len(expected), 0)
+        self.assertEqual(list(screened['symbol']), expected)
+        self.assertEqual(list(screener.rescreen(expected[:1], snapshot_frame(tickers))['symbol']), expected[1:])
+
+    def test_asset_list_is_cached_for_a_day(self):
+        api = FakeAssetAPI(['AAA', 'BBB'])
+        with tempfile.TemporaryDirectory() as root:
+            path = os.path.join(root, 'assets.json')
+            self.assertEqual(tradable_symbols(api, path), ['AAA', 'BBB'])
+            self.assertEqual(tradable_symbols(api, path), ['AAA', 'BBB'])
+            self.assertEqual(api.calls, 1)
+            tradable_symbols(api, path, ttl=0)
+            self.assertEqual(api.calls, 2)
+
+
+class FakeDailyPolygon:
+
+    def __init__(self):
+        self.requests = []
+        self.broken = set()
+
+    def historic_agg_v2(self, symbol, multiplier, timespan, _from, to, unadjusted=False, limit=None):
+        self.requests.append((symbol, _from, to))
+        if symbol == 'BAD' or (symbol, _from) in self.broken:
+            raise ValueError('no data')
+        index = pd.date_range(_from, to, freq='D', tz='America/New_York', name='timestamp')
+        close = np.arange(len(index), dtype=float) + 1
+        df = pd.DataFrame({'open': close, 'high': close, 'low': close, 'close': close, 'volume': 100.}, index=index)
+        return type('Aggs', (), {'df': df})
+
+    def get(self, path, params=None, version='v1'):
+        _, _, _, symbol, _, _, timespan, _from, to = path.split('/')
+        df = self.historic_agg_v2(symbol, 1, timespan, _from, to).df
+        return {'results': [
+            {'t': int(ts.timestamp() * 1000), 'o': row.open, 'h': row.high, 'l': row.low, 'c': row.close, 'v': row.volume}
+            for ts, row in zip(df.index, df.itertuples())
+        ]}
+
+
+class FakeMySQL:
+    # an engine whose raw connections record SQL; information_schema
+    # answers with `indexes` and `types`
+
+    def __init__(self, indexes=(), types=(), alter_fails=False, select_error=None):
+        self.dialect = type('Dialect', (), {'name': 'mysql'})()
+        self.indexes = list(indexes)
+        self.types = list(types)
+        self.alter_fails = alter_fails
+        # raised by the next SELECT
+        self.select_error = select_error
+        self.statements = []
+
+    def raw_connection(self):
+        return self
+
+    def cursor(self):
+        return self
+
+    def execute(self, sql, params=None):
+        self.statements.append(sql)
+        if sql.startswith('ALTER') and self.alter_fails:
+            raise ValueError('Duplicate entry')
+        if sql.startswith('SELECT') and self.select_error is not None:
+            error, self.select_error = self.select_error, None
+            raise error
+
+    def fetchall(self):
+        return self.indexes if 'statistics' in self.statements[-1] else self.types
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class IngestTests(SimpleTestCase):
+
+    def test_mysql_writer_adds_a_missing_unique_key_first(self):
+        engine = FakeMySQL(
+            indexes=[('PRIMARY', 'id')], types=[('symbol', 'text'), ('timestamp', 'datetime')]
+        )
+        writer = UpsertWriter(engine, batch_size=1)
+        writer.write([('2020-01-02', 'AAA', 1, 1, 1, 1, 1), ('2020-01-03', 'AAA', 1, 1, 1, 1, 1)])
+        alter = [sql for sql in engine.statements if sql.startswith('ALTER')]
+        self.assertEqual(alter, ['ALTER TABLE stocks ADD UNIQUE KEY symbol_timestamp ( symbol(32), timestamp )'])
+        # checked once per writer, before the first insert
+        self.assertEqual([sql.split()[0] for sql in engine.statements], ['SELECT', 'SELECT', 'ALTER', 'INSERT', 'INSERT'])
+
+        engine = FakeMySQL(indexes=[('symbol_timestamp', 'timestamp'), ('symbol_timestamp', 'symbol')])
+        UpsertWriter(engine, batch_size=1).write([('2020-01-02', 'AAA', 1, 1, 1, 1, 1)])
+        self.assertFalse(any(sql.startswith('ALTER') for sql in engine.statements))
+
+    def test_watermarks_create_the_table_only_when_it_is_missing(self):
+        engine = FakeMySQL(select_error=Exception(1146, "Table 'mydb.watermarks' doesn't exist"))
+        self.assertEqual(Watermarks(engine).load('day'), {})
+        self.assertTrue(engine.statements[-1].startswith('CREATE TABLE IF NOT EXISTS watermarks'))
+
+        engine = FakeMySQL(select_error=Exception(2013, 'Lost connection to MySQL server during query'))
+        with self.assertRaises(Exception):
+            Watermarks(engine).load('day')
+        self.assertFalse(any(sql.startswith('CREATE') for sql in engine.statements))
+
+    def test_mysql_writer_refuses_a_table_it_cannot_key(self):
+        engine = FakeMySQL(types=[('symbol', 'varchar'), ('timestamp', 'datetime')], alter_fails=True)
+        with self.assertRaises(RuntimeError):
+            UpsertWriter(engine, batch_size=1).write([('2020-01-02', 'AAA', 1, 1, 1, 1, 1)])
+        self.assertFalse(any(sql.startswith('INSERT') for sql in engine.statements))
+
+    def test_rerun_upserts_and_reports_failures(self):
+        from sqlalchemy import create_engine
+        api = type('API', (), {'polygon': FakeDailyPolygon()})()
+        with tempfile.TemporaryDirectory() as root:
+            path = os.path.join(root, 'stocks.db')
+            engine = create_engine('sqlite:///' + path)
+            symbols = ['AAA', 'BAD', 'CCC']
+            summary = ingest_daily(symbols, '2020-01-01', '2020-01-10', engine, api=api, rate=1000, batch_size=7, retries=0)
+            self.assertEqual(summary.rows, 20)
+            self.assertEqual(list(summary.failures), ['BAD'])
+            ingest_daily(symbols, '2020-01-05', '2020-01-12', engine, api=api, rate=1000, retries=0)
+            conn = sqlite3.connect(path)
+            count, = conn.execute('SELECT COUNT(*) FROM stocks').fetchone()
+            close, = conn.execute("SELECT close FROM stocks WHERE symbol = 'AAA' AND timestamp = '2020-01-05'").fetchone()
+            conn.close()
+            engine.dispose()
+        self.assertEqual(count, 24)
+        self.assertEqual(close, 1)
+
+    def test_backfill_resumes_from_watermarks(self):
+        from sqlalchemy import create_engine
+        polygon = FakeDailyPolygon()
+        api = type('API', (), {'polygon': polygon})()
+        with tempfile.TemporaryDirectory() as root:
+            path = os.path.join(root, 'stocks.db')
+            engine = create_engine('sqlite:///' + path)
+            symbols = ['AAA', 'BBB', 'CCC']
+            # BBB's second window fails, as if the run died there
+            polygon.broken.add(('BBB', '2020-01-08'))
+            progress = []
+            summary = backfill(symbols, '2020-01-01', '2020-01-20', engine, api=api,
+                               chunk_days=7, chunk_symbols=2, rate=1000, retries=0,
+                               progress=lambda done, total: progress.append((done, total)))
+            self.assertEqual(list(summary.failures), ['BBB'])
+            # counted across chunks; BBB's last window is dropped once it fails
+            self.assertEqual([done for done, total in progress], list(range(1, 9)))
+            self.assertEqual([total for done, total in progress], [9] * 5 + [8] * 3)
+            marks = Watermarks(engine).load('day')
+            self.assertEqual(str(marks['AAA']), '2020-01-20')
+            self.assertEqual(str(marks['BBB']), '2020-01-07')
+
+            polygon.broken.clear()
+            polygon.requests = []
+            summary = backfill(symbols, '2020-01-01', '2020-01-20', engine, api=api, chunk_days=7, rate=1000)
+            self.assertEqual(polygon.requests, [('BBB', '2020-01-08', '2020-01-14'), ('BBB', '2020-01-15', '2020-01-20')])
+            self.assertEqual(summary.rows, 13)
+
+            polygon.requests = []
+            backfill(symbols, '2020-01-01', '2020-01-20', engine, api=api, rate=1000)
+            self.assertEqual(polygon.requests, [])
+            conn = sqlite3.connect(path)
+            count, = conn.execute('SELECT COUNT(*) FROM stocks').fetchone()
+            conn.close()
+            engine.dispose()
+        self.assertEqual(count, 60)
+
+    def test_streamed_batches_match_the_frame(self):
+        api = type('API', (), {'polygon': FakeDailyPolygon()})()
+        start = pd.Timestamp.now(tz='America/New_York').normalize() - pd.Timedelta(days=30)
+        symbols = ['AAA', 'BBB', 'CCC']
+        batches = list(stock_data.iter_historical_batches(symbols, start, batch_size=40, api=api))
+        self.assertEqual([len(batch) for batch in batches[:-1]], [40] * (len(batches) - 1))
+        df = stock_data.get_historical_stock_data(symbols, start, api=api)
+        rows = [row for batch in batches for row in batch]
+        self.assertEqual(rows, [tuple(row) for row in df[list(DAILY_COLUMNS)].values.tolist()])
+        with tempfile.TemporaryDirectory() as root:
+            path = os.path.join(root, 'stocks.csv')
+            written = stock_data.stream_historical_stock_data(CsvSink(path), symbols, start, batch_size=40, api=api)
+            with open(path) as f:
+                self.assertEqual(len(f.readlines()), written + 1)
+        self.assertEqual(written, len(df))
+
+
+class FakeCalendarAPI:
+
+    def __init__(self):
+        self.calls = 0
+
+    def get_calendar(self, start, end):
+        self.calls += 1
+        days = [('2020-01-02', '09:30', '16:00'), ('2020-07-03', '09:30', '13:00')]
+        return [type('Calendar', (), {'_raw': {'date': d, 'open': o, 'close': c}}) for d, o, c in days]
+
+
+class SessionClockTests(SimpleTestCase):
+
+    def test_calendar_year_is_cached_on_disk(self):
+        api = FakeCalendarAPI()
+        with tempfile.TemporaryDirectory() as root:
+            self.assertEqual(
+                TradingCalendar(api, root).session('2020-01-02'),
+                (int(pd.Timestamp('2020-01-02 09:30', tz='America/New_York').timestamp()),
+                 int(pd.Timestamp('2020-01-02 16:00', tz='America/New_York').timestamp()))
+            )
+            calendar = TradingCalendar(api, root)
+            self.assertIsNone(calendar.session('2020-01-03'))
+            self.assertIsNone(SessionClock.for_day(calendar, '2020-01-04'))
+            clock = SessionClock.for_day(calendar, pd.Timestamp('2020-07-03 12:00', tz='America/New_York'))
+        self.assertEqual(api.calls, 1)
+        self.assertEqual(clock.market_close_dt, pd.Timestamp('2020-07-03 13:00', tz='America/New_York'))
+
+    def test_minutes_from_epoch_offsets(self):
+        open_dt = pd.Timestamp('2020-01-02 09:30', tz='America/New_York')
+        clock = SessionClock.from_datetimes(open_dt, open_dt + pd.Timedelta(minutes=390))
+        now = clock.open_ts + 15 * 60 + 59
+        self.assertTrue(clock.is_open(now))
+        self.assertEqual(clock.minutes_since_open(now), 15)
+        self.assertEqual(clock.minutes_until_close(now), 374)
+        self.assertEqual(clock.minutes_since_open(clock.open_ts - 1), -1)
+        self.assertFalse(clock.is_open(clock.close_ts))
+
+    def test_sleep_until_target(self):
+        clock = SessionClock(0, 1)
+        target = time.time() + 0.05
+        clock.sleep_until(target)
+        self.assertGreaterEqual(time.time(), target)
+        asyncio.run(clock.wait_until(time.time() + 0.01))
+
+
+class SessionStateTests(SimpleTestCase):
+
+    def test_opening_range_freezes_after_fifteen_minutes(self):
+        history = MinuteBars()
+        state = SessionState(100, prev_close=10., volume=1000, history=history)
+        for minute, price in [(100, 10.5), (110, 11.), (115, 10.2), (116, 12.)]:
+            history.merge_bar(minute, price, price, price, price, 10)
+            state.on_second_bar(minute, price, price, price, 10)
+        self.assertEqual((state.range_high, state.range_low), (11., 10.2))
+        self.assertAlmostEqual(state.change, .2)
+        # a late minute bar for a range minute replaces its 1s aggregate
+        history.set_bar(110, 10.8, 10.8, 10.4, 10.8, 50)
+        state.on_minute_bar(110, 10.8, 10.4, 10.8, 50, history)
+        self.assertEqual((state.range_high, state.range_low), (10.8, 10.2))
+
+    def test_minute_bar_replaces_forming_volume(self):
+        state = SessionState(100, prev_close=10., volume=1000)
+        state.on_second_bar(101, 11., 9., 10., 100)
+        state.on_second_bar(101, 11., 9., 10., 100)
+        self.assertEqual(state.volume_today, 1200)
+        state.on_minute_bar(101, 11., 9., 10., 250, MinuteBars())
+        self.assertEqual(state.volume_today, 1250)
+        state.on_second_bar(102, 13., 11., 12., 250)
+        self.assertEqual(state.volume_today, 1500)
+        self.assertAlmostEqual(state.vwap, 11.)
+
+
+class ShardTests(SimpleTestCase):
+    open_dt = pd.Timestamp('2020-01-02 09:30', tz='America/New_York')
+
+    def events(self, symbols, minutes):
+        start = int(self.open_dt.timestamp()) * 1000
+        events = [{'ev': 'session', 'open': self.open_dt.isoformat(), 'close': (self.open_dt + pd.Timedelta(minutes=390)).isoformat()}]
+        events += [{'ev': 'watch', 'symbol': symbol, 'prev_close': 10., 'volume': 50000} for symbol in symbols]
+        for i in range(minutes):
+            for symbol in symbols:
+                bar = {'symbol': symbol, 'open': 11., 'high': 11., 'low': 11., 'close': 11., 'volume': 100, 'start': start + i * 60000}
+                events.append(dict(bar, ev='A'))
+                events.append(dict(bar, ev='AM'))
+        return events
+
+    def test_partition_is_stable(self):
+        symbols = ['SYM{}'.format(i) for i in range(50)]
+        parts = partition(symbols, 3)
+        self.assertEqual(sorted(sum(parts, [])), sorted(symbols))
+        for index, part in enumerate(parts):
+            self.assertTrue(all(shard_of(symbol, 3) == index for symbol in part))
+
+    def test_sharded_replay_plays_every_event(self):
+        symbols = ['SYM{}'.format(i) for i in range(6)]
+        stats, coordinator = replay_sharded(self.events(symbols, 20), workers=2)
+        self.assertEqual(stats.events, 6 * 20 * 2)
+        self.assertEqual(len(stats.latencies['AM']), 6 * 20)
+        self.assertEqual(coordinator.positions, {})
+
+    def test_router_skips_exited_workers(self):
+        import multiprocessing
+        pipes = [multiprocessing.Pipe() for _ in range(2)]
+        router = ShardRouter([parent for parent, _ in pipes])
+        # the first worker has exited
+        pipes[0][1].close()
+        router.close(pipes[0][0])
+        router.broadcast(('account', 1., 1.))
+        symbol = next(symbol for symbol in ('AAA', 'BBB', 'CCC', 'DDD') if shard_of(symbol, 2) == 0)
+        router.send(symbol, ('rejected', symbol))
+        self.assertEqual(pipes[1][1].recv(), ('account', 1., 1.))
+        self.assertFalse(pipes[1][1].poll())
+        for parent, child in pipes:
+            parent.close()
+            child.close()
+
+
+class MetricsTests(SimpleTestCase):
+
+    def test_histogram_percentiles(self):
+        histogram = Histogram()
+        for _ in range(1000):
+            histogram.observe(.001)
+        for _ in range(10):
+            histogram.observe(1.)
+        self.assertAlmostEqual(histogram.percentile(50), .001)
+        self.assertAlmostEqual(histogram.percentile(99.5), 1.)
+        self.assertEqual(histogram.max, 1.)
+
+    def test_report_samples_lag_and_probes(self):
+        metrics = Metrics()
+        metrics.probe('db_queue', lambda: 7)
+        metrics.on_event('A', 100., 100.25, .0001)
+        with tempfile.TemporaryDirectory() as root:
+            path = os.path.join(root, 'metrics.json')
+
+            async def run():
+                try:
+                    await asyncio.wait_for(report(metrics, interval=.03, tick=.01, path=path), .1)
+                except asyncio.TimeoutError:
+                    pass
+
+            asyncio.run(run())
+            snapshot = read_snapshot(path)
+        self.assertEqual(snapshot['gauges']['db_queue'], 7)
+        self.assertGreater(snapshot['histograms']['loop_lag']['count'], 0)
+        self.assertEqual(snapshot['histograms']['bar_age.A']['max'], .25)
+
+    def test_published_metrics_merge_into_the_coordinators(self):
+        worker = Metrics()
+        worker.probe('symbols', lambda: 3)
+        sent = []
+
+        def publish(metrics):
+            sent.append((metrics.histograms, dict(metrics.gauges)))
+            metrics.histograms = {}
+
+        async def run():
+            worker.on_event('A', 100., 100.5, .001)
+            try:
+                await asyncio.wait_for(report(worker, interval=.02, tick=.01, publish=publish), .05)
+            except asyncio.TimeoutError:
+                pass
+
+        asyncio.run(run())
+        coordinator = Metrics()
+        coordinator.on_event('A', 100., 100.25, .002)
+        for histograms, gauges in sent:
+            coordinator.merge(histograms)
+        snapshot = coordinator.snapshot()
+        self.assertGreater(len(sent), 0)
+        self.assertEqual(sent[-1][1], {'symbols': 3})
+        self.assertEqual(snapshot['histograms']['handler.A']['count'], 2)
+        self.assertEqual(snapshot['histograms']['bar_age.A']['max'], .5)
+        self.assertIn('loop_lag', snapshot['histograms'])
+
+    def test_metrics_view(self):
+        from trading_bot import views
+        request = RequestFactory().get('/trading_bot/metrics/')
+        read = views.read_snapshot
+        try:
+            views.read_snapshot = lambda: None
+            self.assertEqual(views.metrics(request).status_code, 503)
+            views.read_snapshot = lambda: {'at': time.time() - 2, 'gauges': {}, 'histograms': {}}
+            response = views.metrics(request)
+        finally:
+            views.read_snapshot = read
+        self.assertEqual(response.status_code, 200)
+        self.assertGreaterEqual(json.loads(response.content)['age'], 2)
+
+
+class SyntheticMarketTests(SimpleTestCase):
+
+    def test_same_seed_same_market(self):
+        a, b = SyntheticMarket(5, 30, seed=1), SyntheticMarket(5, 30, seed=1)
+        self.assertEqual(list(a.bars()), list(b.bars()))
+        self.assertNotEqual(list(a.bars()), list(SyntheticMarket(5, 30, seed=2).bars()))
+
+    def test_minute_bars_sum_up_their_second_bars(self):
+        market = SyntheticMarket(5, 30, seed=0)
+        seconds = {}
+        arrivals = market.arrivals.tolist()
+        self.assertEqual(arrivals, sorted(arrivals))
+        for channel, bar in market.bars():
+            key = (bar.symbol, bar.start // 60000)
+            if channel == 'A':
+                seconds.setdefault(key, []).append(bar)
+                continue
+            parts = seconds.pop(key)
+            self.assertEqual(bar.open, parts[0].open)
+            self.assertEqual(bar.close, parts[-1].close)
+            self.assertEqual(bar.high, max(part.high for part in parts))
+            self.assertEqual(bar.volume, sum(part.volume for part in parts))
+
+    def test_gappers_trade(self):
+        market = SyntheticMarket(6, 90, seed=0, gappers=.5)
+        adapter = ReplayAdapter(build_engine(market.header(), history=market.history))
+        adapter.play(list(market.bars()))
+        self.assertGreater(market.gapper.sum(), 0)
+        gappers = {symbol for symbol, gapper in zip(market.names, market.gapper) if gapper}
+        # every gapper entered and was out again by the end of its fade
+        self.assertGreaterEqual(adapter.broker.orders, 2 * len(gappers))
+        self.assertFalse(any(adapter.engine.positions.get(symbol) for symbol in gappers))
+
+
+class FakeStream:
+    # subscribe fails `failures` times, then each connection runs the next of `sessions` shortly after subscribing
+
+    def __init__(self, failures=0, sessions=()):
+        self.loop = asyncio.new_event_loop()
+        self.failures = failures
+        self.sessions = list(sessions)
+        self.subscribes = []
+        self.closes = 0
+
+    async def subscribe(self, channels):
+        self.subscribes.append(channels)
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError('refused')
+        self.loop.call_later(.01, self.sessions.pop(0))
+
+    async def close(self):
+        self.closes += 1
+
+
+class FakeMinuteAPI:
+
+    def __init__(self, first_minute, n):
+        index = pd.to_datetime(np.arange(first_minute, first_minute + n) * 60, unit='s', utc=True)
+        index = index.tz_convert('America/New_York').rename('timestamp')
+        closes = 20. + np.arange(n)
+        df = pd.DataFrame({'open': closes, 'high': closes, 'low': closes, 'close': closes, 'volume': 1000.}, index=index)
+        self.polygon = type('Polygon', (), {'historic_agg_v2': lambda *args, **kwargs: type('Aggs', (), {'df': df})})()
+
+
+class DecodeTests(SimpleTestCase):
+
+    frame = json.dumps([
+        {'ev': 'status', 'status': 'success', 'message': 'subscribed to: A.AAA'},
+        {'ev': 'A', 'sym': 'AAA', 'v': 100, 'av': 5000, 'o': 20., 'c': 20.1, 'h': 20.2, 'l': 19.9,
+         's': 1577975400000, 'e': 1577975401000},
+        {'ev': 'AM', 'sym': 'AAA', 'v': 900, 'o': 19.8, 'c': 20.1, 'h': 20.2, 'l': 19.7, 's': 1577975340000},
+    ])
+
+    def test_bars_match_the_library_entities(self):
+        from alpaca_trade_api.polygon.streamconn import StreamConn as PolygonStreamConn
+        decoded = decode_frame(self.frame)
+        self.assertEqual([ev for ev, _ in decoded], ['status', 'A', 'AM'])
+        for (ev, record), msg in zip(decoded[1:], json.loads(self.frame)[1:]):
+            raw = PolygonStreamConn._cast(None, ev, msg)._raw
+            for name in ('symbol', 'open', 'high', 'low', 'close', 'volume', 'start'):
+                self.assertEqual(getattr(record, name), raw[name])
+        # a minute bar without an end lasts a minute
+        self.assertEqual(decoded[2][1].end - decoded[2][1].start, 60000)
+        rows = decode_bars(self.frame)
+        self.assertEqual(list(rows['ev']), ['A', 'AM'])
+        self.assertEqual(rows['start'].dtype, np.int64)
+        self.assertEqual(rows[0]['close'], 20.1)
+
+    def test_stream_hands_records_to_bar_handlers(self):
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        stream = FastPolygonStream('key')
+        got = []
+
+        async def on_bar(conn, channel, data):
+            got.append((channel, data))
+
+        async def on_status(conn, channel, data):
+            got.append((channel, data._raw['status']))
+
+        stream.register(r'A$', on_bar)
+        stream.register(r'status', on_status)
+
+        async def feed():
+            for msg in json.loads(self.frame):
+                await stream._dispatch(msg)
+
+        stream.loop.run_until_complete(feed())
+        stream.loop.close()
+        self.assertEqual([channel for channel, _ in got], ['status', 'A'])
+        self.assertEqual(got[0][1], 'success')
+        self.assertEqual((got[1][1].symbol, got[1][1].close, got[1][1].start), ('AAA', 20.1, 1577975400000))
+
+    def test_dropped_connection_is_left_to_the_supervisor(self):
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        stream = FastPolygonStream('key')
+        frame = self.frame
+
+        class DroppingSocket:
+            closed = False
+            frames = [frame]
+
+            async def recv(self):
+                if self.frames:
+                    return self.frames.pop()
+                raise ConnectionResetError('gone')
+
+            async def close(self):
+                self.closed = True
+
+        ws = stream._ws = DroppingSocket()
+        statuses = []
+        reconnects = []
+
+        async def on_status(conn, channel, data):
+            statuses.append(data._raw['status'])
+
+        async def ensure_ws():
+            reconnects.append(True)
+
+        stream.register(r'status', on_status)
+        stream._ensure_ws = ensure_ws
+
+        async def read():
+            received = [msg async for msg in stream._recv()]
+            await asyncio.sleep(0)
+            return received
+
+        received = stream.loop.run_until_complete(read())
+        stream.loop.close()
+        self.assertEqual(len(received), 3)
+        self.assertEqual(statuses, ['disconnected'])
+        self.assertTrue(ws.closed)
+        self.assertIsNone(stream._ws)
+        self.assertEqual(reconnects, [])
+
+
+class ConflatingInboxTests(SimpleTestCase):
+
+    def record(self, second, close, symbol='AAA', volume=100):
+        start = 1577975400000 + second * 1000
+        return BarRecord(symbol, close, close, close, close, volume, start, start + 1000)
+
+    def test_waiting_second_bars_merge(self):
+        inbox = ConflatingInbox()
+        inbox.put('A', self.record(0, 20.))
+        inbox.put('A', self.record(0, 30., symbol='BBB'))
+        inbox.put('A', self.record(1, 21.))
+        inbox.put('A', self.record(2, 19.5, volume=50))
+        # a new minute starts a new bar
+        inbox.put('A', self.record(60, 22.))
+        self.assertEqual((inbox.received, inbox.merged, len(inbox)), (5, 2, 3))
+        channel, bar = inbox.get()
+        self.assertEqual((bar.open, bar.high, bar.low, bar.close, bar.volume), (20., 21., 19.5, 19.5, 250))
+        self.assertEqual(bar.end - bar.start, 3000)
+        self.assertEqual(inbox.get()[1].symbol, 'BBB')
+        self.assertEqual(inbox.get()[1].close, 22.)
+        # once dispatched, a bar takes no more merges
+        inbox.put('A', self.record(61, 23.))
+        self.assertEqual(inbox.merged, 2)
+
+    def test_minute_bars_and_updates_are_never_merged(self):
+        inbox = ConflatingInbox()
+        inbox.put('A', self.record(0, 20.))
+        minute = BarRecord('AAA', 20., 20., 20., 20., 900, 1577975400000, 1577975460000)
+        inbox.put('AM', minute)
+        inbox.put('AM', minute)
+        inbox.put('A', self.record(1, 21.))
+        inbox.put('status', {'ev': 'status'})
+        self.assertEqual([inbox.get()[0] for _ in range(len(inbox))], ['A', 'AM', 'AM', 'A', 'status'])
+        self.assertEqual(inbox.merged, 0)
+        self.assertEqual(inbox.max_depth, 5)
+
+    def test_stream_merges_bars_queued_behind_the_handlers(self):
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        stream = FastPolygonStream('key')
+        got = []
+
+        async def on_bar(conn, channel, bar):
+            got.append((channel, bar.symbol, bar.close, bar.volume))
+
+        stream.register(r'A$', on_bar)
+        stream.register(r'AM$', on_bar)
+
+        def msg(ev, symbol, second, close):
+            return {'ev': ev, 'sym': symbol, 'o': close, 'h': close, 'l': close, 'c': close, 'v': 100,
+                    's': 1577975400000 + second * 1000}
+
+        async def frames():
+            # one frame's worth, read before the dispatcher gets a turn
+            for m in (msg('A', 'AAA', 0, 20.), msg('A', 'BBB', 0, 30.), msg('A', 'AAA', 1, 21.),
+                      msg('AM', 'AAA', 0, 21.), msg('A', 'AAA', 2, 22.)):
+                yield m
+            await asyncio.sleep(.05)
+
+        stream._stream = frames()
+        stream.loop.run_until_complete(stream._consume_msg())
+        stream.loop.close()
+        self.assertEqual(got, [
+            ('A', 'AAA', 21., 200), ('A', 'BBB', 30., 100), ('AM', 'AAA', 21., 100), ('A', 'AAA', 22., 100)
+        ])
+        self.assertEqual(stream.inbox.counts(), {'received': 5, 'merged': 1, 'depth': 0, 'max_depth': 4})
+
+
+class FakeOrder:
+
+    def __init__(self, id, symbol, status, side='buy', filled_qty=0, client_order_id=None):
+        self.id = id
+        self.symbol = symbol
+        self.status = status
+        self.client_order_id = client_order_id
+        self.submitted_at = 1577977000
+        self._raw = {
+            'id': id, 'symbol': symbol, 'side': side, 'filled_qty': str(filled_qty), 'submitted_at': 1577977000
+        }
+
+
+class JournalTests(SimpleTestCase):
+
+    def engine(self):
+        open_dt = pd.Timestamp('2020-01-02 09:30', tz='America/New_York')
+        return StrategyEngine(SessionClock.from_datetimes(open_dt, open_dt + pd.Timedelta(minutes=390)), StaticAccount(1e5))
+
+    def test_restores_the_latest_state_after_compaction(self):
+        with tempfile.TemporaryDirectory() as root:
+            engine = self.engine()
+            engine.watch('AAA')
+            journal = Journal('2020-01-02', root, compact_every=3)
+            engine._submit('AAA', 50, 'buy', 20., 26330000)
+            engine.stop_prices['AAA'], engine.target_prices['AAA'] = 19.37, 21.89
+            journal.record('intent', 'AAA', engine.symbol_state('AAA'))
+            engine.on_order_submitted('AAA', FakeOrder('o1', 'AAA', 'new'))
+            journal.record('submitted', 'AAA', engine.symbol_state('AAA'))
+            engine.on_trade_update('fill', FakeOrder('o1', 'AAA', 'filled', filled_qty=50)._raw)
+            # the third record compacts
+            journal.record('trade_update', 'AAA', engine.symbol_state('AAA'))
+            engine.positions['BBB'] = 5
+            journal.record('position', 'BBB', engine.symbol_state('BBB'))
+            # a crash mid-line
+            journal.file.write('{"ev": "trade_up')
+            journal.file.flush()
+            states = Journal('2020-01-02', root).load()
+            self.assertEqual(states['AAA'], engine.symbol_state('AAA'))
+            self.assertEqual(states['AAA']['stop'], 19.37)
+            self.assertEqual(states['AAA']['target'], 21.89)
+            self.assertEqual(states['BBB']['position'], 5)
+            restored = self.engine()
+            reconcile(restored, states, [])
+            self.assertEqual(restored.symbol_state('AAA'), engine.symbol_state('AAA'))
+            journal.close()
+
+    def test_reconcile_applies_what_happened_while_down(self):
+        engine = self.engine()
+        for symbol in ('AAA', 'BBB', 'CCC', 'DDD'):
+            engine.watch(symbol)
+            engine._submit(symbol, 50, 'buy', 20., 26330000)
+            engine.stop_prices[symbol] = 19.
+        engine.on_order_submitted('AAA', FakeOrder('o1', 'AAA', 'new'))
+        engine.on_order_submitted('BBB', FakeOrder('o2', 'BBB', 'new'))
+        states = {symbol: engine.symbol_state(symbol) for symbol in ('AAA', 'BBB', 'CCC', 'DDD')}
+        states['CCC']['client_order_id'] = 'c3'
+        states['DDD']['client_order_id'] = 'c4'
+        orders = [
+            FakeOrder('o1', 'AAA', 'filled', filled_qty=50),
+            FakeOrder('o2', 'BBB', 'partially_filled', filled_qty=20),
+            # CCC's submit got through before the crash, DDD's didn't
+            FakeOrder('o3', 'CCC', 'canceled', client_order_id='c3'),
+            FakeOrder('o9', 'EEE', 'new'),
+            FakeOrder('o8', 'ZZZ', 'new'),
+        ]
+        restored = self.engine()
+        restored.watch('EEE')
+        symbols, cancel = reconcile(restored, states, orders)
+        self.assertEqual(symbols, ['AAA', 'BBB', 'CCC', 'DDD'])
+        self.assertEqual(cancel, ['o9'])
+        self.assertEqual((restored.positions['AAA'], restored.open_orders['AAA']), (50, None))
+        self.assertEqual((restored.positions['BBB'], restored.open_orders['BBB'].id), (20, 'o2'))
+        self.assertEqual((restored.positions['CCC'], restored.open_orders['CCC']), (0, None))
+        self.assertIsNone(restored.open_orders['DDD'])
+        self.assertEqual(restored.stop_prices['AAA'], 19.)
+
+    def test_shard_worker_sends_the_states_to_journal(self):
+        import multiprocessing
+        coordinator, pipe = multiprocessing.Pipe()
+        engine = self.engine()
+        engine.watch('AAA')
+        worker = ShardWorker(0, engine, pipe, journaled=True)
+        engine.stop_prices['AAA'] = 19.
+        worker.send([engine._submit('AAA', 50, 'buy', 20., 26330000)], 1577977000)
+        worker.apply(('submitted', 'AAA', 'o1', 1577977000))
+        worker.apply(('trade_update', 'fill', FakeOrder('o1', 'AAA', 'filled', filled_qty=50)._raw))
+        with tempfile.TemporaryDirectory() as root:
+            journal = Journal('2020-01-02', root)
+            kind, _, intents, _, states = coordinator.recv()
+            self.assertEqual((kind, [intent.symbol for intent in intents]), ('intents', ['AAA']))
+            self.assertIsNone(states['AAA']['order'][0])
+            journal.record('intent', 'AAA', states['AAA'])
+            events = []
+            while coordinator.poll():
+                kind, _, ev, symbol, state, details = coordinator.recv()
+                self.assertEqual(kind, 'state')
+                events.append((ev, details))
+                journal.record(ev, symbol, state, **details)
+            journal.close()
+            self.assertEqual(events, [
+                ('submitted', {'order_id': 'o1'}), ('trade_update', {'event': 'fill', 'order_id': 'o1'})
+            ])
+            restored = self.engine()
+            reconcile(restored, Journal('2020-01-02', root).load(), [])
+        self.assertEqual(restored.symbol_state('AAA'), engine.symbol_state('AAA'))
+        self.assertEqual((restored.positions['AAA'], restored.stop_prices['AAA']), (50, 19.))
+        coordinator.close()
+        pipe.close()
+
+
+class ReconnectTests(SimpleTestCase):
+
+    def test_retries_flat_with_backoff_then_recovers(self):
+        conn = FakeStream(failures=2)
+        recovered = []
+
+        async def recover(start, end):
+            recovered.append((start, end))
+            return 12, 3
+
+        supervisor = StreamSupervisor(conn, lambda: ['trade_updates'], recover, base_delay=.01)
+        # the first connection drops, the second runs until stopped
+        conn.sessions = [lambda: supervisor.fail('dropped'), conn.loop.stop]
+        supervisor.run()
+        conn.loop.close()
+        self.assertEqual(len(conn.subscribes), 4)
+        self.assertEqual(conn.closes, 3)
+        # one backfill after the refusals, one after the drop
+        self.assertEqual(len(recovered), 2)
+        self.assertEqual([(o.bars, o.symbols) for o in supervisor.outages], [(12, 3), (12, 3)])
+        self.assertTrue(all(end >= start for start, end in recovered))
+
+    def test_recovery_merges_missed_minutes_once(self):
+        tests = StrategyEngineTests()
+        engine = tests.engine()
+        open_minute = engine.open_minute
+        api = FakeMinuteAPI(open_minute + 15, 15)
+        recover = minute_recovery(engine, api)
+        start, end = (open_minute + 20) * 60 + 30, (open_minute + 25) * 60 + 10
+        self.assertEqual(asyncio.run(recover(start, end)), (6, 1))
+        history = engine.minute_history['AAA']
+        self.assertEqual(history.last_minute, open_minute + 24)
+        self.assertEqual(history.get(open_minute + 19)[3], 24.)
+        volume = engine.sessions['AAA'].volume_today
+        asyncio.run(recover(start, end))
+        self.assertEqual(engine.sessions['AAA'].volume_today, volume)
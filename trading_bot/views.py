@@ -1,6 +1,25 @@
+import os
+import sys
+import time
+
 from django.shortcuts import render
-from django.http import HttpResponse
+from django.http import HttpResponse, JsonResponse
+
+# the bot's modules live in src/ and import each other as top-level modules
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src'))
+
+from metrics import read_snapshot  # noqa: E402
 
 
 def index(request):
-    return HttpResponse("Hello, world. You're at the index.")
\ No newline at end of file
+    return HttpResponse("Hello, world. You're at the index.")
+
+
+def metrics(request):
+    # the running bot's latest metrics snapshot; age says how long ago it
+    # was written, so a stalled bot shows up as a growing age
+    snapshot = read_snapshot()
+    if snapshot is None:
+        return JsonResponse({'error': 'no metrics written yet'}, status=503)
+    snapshot['age'] = time.time() - snapshot['at']
+    return JsonResponse(snapshot)